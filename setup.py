@@ -19,7 +19,8 @@ setup(name="snfpipe",
                      "Topic :: Scientific/Engineering",
                      "Topic :: Scientific/Engineering :: Astronomy",
                      "Intended Audience :: Science/Research"],
-      packages=["snfpipe"],
+      packages=["snfpipe", "snfpipe.tests"],
+      install_requires=["numpy"],
       url="http://github.com/snfactory/pipeline",
       author="Kyle Barbary",
       author_email="kylebarbary@gmail.com")
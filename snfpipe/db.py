@@ -0,0 +1,453 @@
+"""Access to the raw image database created by snf-sync-db."""
+
+import numbers
+import os
+import re
+import sqlite3
+
+import numpy as np
+
+from .tables import EXPOSURE_COLUMNS, RUN_COLUMNS
+
+__all__ = ["connect", "create_indexes", "query_rawimages", "keyword_counts",
+           "files_with_keyword", "file_header", "create_run_tables",
+           "insert_run_logfile", "rawimage_run_ids", "link_rawimages",
+           "files_for_run", "files_for_exposure"]
+
+DBNAME = "/project/projectdirs/snfactry/processing/db/images.db"
+
+# Header keywords stored in the rawimages table and their SQLITE type
+# affinity.
+RAWIMAGE_KEYS = [('RUNID', 'text'),
+                 ('OBSID', 'text'),
+                 ('EXPTIME', 'real'),
+                 ('DARKTIME', 'real'),
+                 ('AIRMASS', 'real'),
+                 ('PI_NAME', 'text'),
+                 ('OBSERVER', 'text'),
+                 ('CHANNEL', 'text'),
+                 ('FCLASS', 'integer'),
+                 ('FILTER', 'text'),
+                 ('FILTERID', 'integer'),
+                 ('JD', 'real'),
+                 ('DATE-OBS', 'text'),
+                 ('INSTTEMP', 'real'),
+                 ('HA', 'real'),
+                 ('RADECSYS', 'text'),
+                 ('EQUINOX', 'real'),
+                 ('OBJRA', 'real'),
+                 ('OBJDEC', 'real'),
+                 ('POP', 'integer')]
+
+# File name patterns of the raw images synced into the rawimages table.
+RAWIMAGE_PATTERNS = ["*vid.fits",
+                     "*acq*fits",
+                     "??_???_???_???_??_B.fits",
+                     "??_???_???_???_??_R.fits",
+                     "??_???_???_???_??_P.fits"]
+
+# SQL column name and type of each column of rawimages
+RAWIMAGE_COLUMNS = ([('filepath', 'text')] +
+                    [(k.replace('-', '_'), t) for k, t in RAWIMAGE_KEYS])
+
+# Indexes on rawimages: (name, columns)
+RAWIMAGE_INDEXES = [("rawimages_jd", "JD"),
+                    ("rawimages_runid", "RUNID"),
+                    ("rawimages_channel_fclass", "CHANNEL, FCLASS"),
+                    ("rawimages_fclass", "FCLASS"),
+                    ("rawimages_objdec_objra", "OBJDEC, OBJRA")]
+
+# Connection settings: WAL lets readers run concurrently with a writer.
+PRAGMAS = [("synchronous", "NORMAL"),
+           ("cache_size", -65536),  # KiB
+           ("mmap_size", 1 << 30),
+           ("temp_store", "MEMORY")]
+
+
+def connect(dbname=DBNAME, readonly=False, timeout=60.):
+    """Open the database with settings suited to concurrent access.
+
+    The database is put in WAL journal mode (unless `readonly`), so that
+    readers are not blocked by a sync job writing to it, and page cache
+    and memory-mapping sizes are increased.
+
+    Parameters
+    ----------
+    dbname : str, optional
+        Database file name.
+    readonly : bool, optional
+        Open the database read-only.
+    timeout : float, optional
+        Seconds to wait for a lock before raising an error.
+
+    Returns
+    -------
+    conn : `sqlite3.Connection`
+    """
+    if readonly:
+        conn = sqlite3.connect("file:{}?mode=ro".format(dbname), uri=True,
+                               timeout=timeout)
+    else:
+        conn = sqlite3.connect(dbname, timeout=timeout)
+        conn.execute("PRAGMA journal_mode=WAL")
+    for name, value in PRAGMAS:
+        conn.execute("PRAGMA {}={}".format(name, value))
+    return conn
+
+
+def create_indexes(conn):
+    """Create indexes on the rawimages table, if they don't exist."""
+    for name, columns in RAWIMAGE_INDEXES:
+        conn.execute("CREATE INDEX IF NOT EXISTS {} ON rawimages ({})"
+                     .format(name, columns))
+    conn.commit()
+
+
+def _to_structured(rows, columns):
+    """Convert rows of SQL results to a structured array.
+
+    Text columns become unicode strings ('' for NULL), real columns
+    float64 (NaN for NULL) and integer columns int64 (-1 for NULL).
+    """
+    types = dict(RAWIMAGE_COLUMNS)
+    dtype = []
+    converters = []
+    for i, name in enumerate(columns):
+        t = types.get(name, 'text')
+        if t == 'real':
+            dtype.append((name, 'f8'))
+            converters.append(lambda v: np.nan if v is None else v)
+        elif t == 'integer':
+            dtype.append((name, 'i8'))
+            converters.append(lambda v: -1 if v is None else v)
+        else:
+            width = max([len(str(row[i])) for row in rows
+                         if row[i] is not None] + [1])
+            dtype.append((name, 'U%d' % width))
+            converters.append(lambda v: '' if v is None else str(v))
+
+    return np.array([tuple(c(v) for c, v in zip(converters, row))
+                     for row in rows], dtype=dtype)
+
+
+def _range_clause(column, bounds, clauses, params):
+    """Add a `lo <= column < hi` clause (either bound may be None)."""
+    lo, hi = bounds
+    if lo is not None:
+        clauses.append("{} >= ?".format(column))
+        params.append(lo)
+    if hi is not None:
+        clauses.append("{} < ?".format(column))
+        params.append(hi)
+
+
+def _in_clause(column, values, clauses, params):
+    """Add a `column = value` or `column IN (...)` clause."""
+    if isinstance(values, (str, numbers.Integral, np.integer)):
+        values = [values]
+    # sqlite3 can't bind numpy integers (e.g., from the run tables).
+    values = [int(v) if isinstance(v, (numbers.Integral, np.integer))
+              else v for v in values]
+    clauses.append("{} IN ({})".format(column, ", ".join("?" * len(values))))
+    params.extend(values)
+
+
+def query_rawimages(conn, jd=None, runid=None, channel=None, fclass=None,
+                    ra=None, dec=None, columns=None):
+    """Query the rawimages table.
+
+    All given criteria must be satisfied. Each criterion can use one of the
+    indexes created by `create_indexes`.
+
+    Parameters
+    ----------
+    conn : `sqlite3.Connection`
+    jd : (float, float), optional
+        Range ``(min, max)`` of JD; ``min <= JD < max``. Either bound may be
+        None.
+    runid : str or list of str, optional
+        Run id(s).
+    channel : str or list of str, optional
+        Channel(s), e.g. 'B', 'R' or 'P'.
+    fclass : int or list of int, optional
+        FCLASS value(s).
+    ra, dec : (float, float), optional
+        Box in OBJRA and OBJDEC (in the units stored in the headers). If
+        the RA minimum is larger than the maximum, the box wraps around
+        zero.
+    columns : list of str, optional
+        Columns to return. Default is all columns.
+
+    Returns
+    -------
+    result : `~numpy.ndarray`
+        Structured array with one field per column, ordered by filepath.
+        NULL values are '' for text, NaN for real and -1 for integer
+        columns.
+
+    Examples
+    --------
+    >>> conn = connect(readonly=True)
+    >>> images = query_rawimages(conn, jd=(2454466.5, 2454467.5),
+    ...                          channel='B', fclass=[17, 52])
+    >>> images['filepath']
+    """
+    if columns is None:
+        columns = [name for name, _ in RAWIMAGE_COLUMNS]
+
+    clauses = []
+    params = []
+    if jd is not None:
+        _range_clause("JD", jd, clauses, params)
+    if runid is not None:
+        _in_clause("RUNID", runid, clauses, params)
+    if channel is not None:
+        _in_clause("CHANNEL", channel, clauses, params)
+    if fclass is not None:
+        _in_clause("FCLASS", fclass, clauses, params)
+    if dec is not None:
+        _range_clause("OBJDEC", dec, clauses, params)
+    if ra is not None:
+        lo, hi = ra
+        if lo is not None and hi is not None and lo > hi:
+            clauses.append("(OBJRA >= ? OR OBJRA < ?)")
+            params.extend([lo, hi])
+        else:
+            _range_clause("OBJRA", ra, clauses, params)
+
+    query = "SELECT {} FROM rawimages".format(", ".join(columns))
+    if clauses:
+        query += " WHERE " + " AND ".join(clauses)
+    query += " ORDER BY filepath"
+
+    rows = conn.execute(query, params).fetchall()
+    return _to_structured(rows, columns)
+
+
+def keyword_counts(conn, pattern=None, nights=False):
+    """Number of files (or nights) in which each header keyword appears.
+
+    Parameters
+    ----------
+    conn : `sqlite3.Connection`
+    pattern : str, optional
+        Only count files whose path (relative to the image root, e.g.
+        '08/001/08_001_012_003_17_B.fits') matches this SQLite GLOB
+        pattern.
+    nights : bool, optional
+        Count distinct night directories rather than files.
+
+    Returns
+    -------
+    counts : dict
+        Mapping of keyword to count.
+    """
+    if nights:
+        count = "count(DISTINCT substr(f.filepath, 1, 6))"
+    else:
+        count = "count(*)"
+    query = ("SELECT k.key, {} FROM header_values v "
+             "JOIN header_keys k ON v.key_id = k.key_id "
+             "JOIN rawfiles f ON f.rowid = v.file_id".format(count))
+    params = []
+    if pattern is not None:
+        query += " WHERE f.filepath GLOB ?"
+        params.append(pattern)
+    query += " GROUP BY k.key"
+    return dict(conn.execute(query, params).fetchall())
+
+
+def files_with_keyword(conn, key, value=None):
+    """Paths of files whose primary header contains a keyword.
+
+    Parameters
+    ----------
+    conn : `sqlite3.Connection`
+    key : str
+        Header keyword.
+    value : optional
+        If given, only files where the keyword has this value.
+
+    Returns
+    -------
+    filepaths : list of str
+    """
+    query = ("SELECT f.filepath FROM header_values v "
+             "JOIN rawfiles f ON f.rowid = v.file_id "
+             "WHERE v.key_id = (SELECT key_id FROM header_keys WHERE key = ?)")
+    params = [key]
+    if value is not None:
+        query += " AND v.value = ?"
+        params.append(value)
+    query += " ORDER BY f.filepath"
+    return [t[0] for t in conn.execute(query, params)]
+
+
+def file_header(conn, filepath):
+    """All primary header keywords of a file, as stored in the database.
+
+    Returns
+    -------
+    header : dict
+        Mapping of keyword to value (empty if the file is not known).
+    """
+    query = ("SELECT k.key, v.value FROM header_values v "
+             "JOIN header_keys k ON v.key_id = k.key_id "
+             "WHERE v.file_id = (SELECT rowid FROM rawfiles "
+             "WHERE filepath = ?)")
+    return dict(conn.execute(query, (filepath,)).fetchall())
+
+
+# SQLITE type affinity of column kinds in snfpipe.tables
+_KIND_AFFINITY = {'f': 'real', 'i': 'integer', 'U': 'text'}
+
+# Indexes on the runs and exposures tables: (name, table, columns)
+RUN_INDEXES = [("runs_date", "runs", "date"),
+               ("runs_type", "runs", "type_"),
+               ("exposures_idrun", "exposures", "idrun"),
+               ("exposures_date", "exposures", "Date"),
+               ("exposures_fclass", "exposures", "Fclass"),
+               ("rawimage_runs_idrun", "rawimage_runs", "idrun"),
+               ("rawimage_runs_idexp", "rawimage_runs", "idexp")]
+
+
+def create_run_tables(conn):
+    """Create tables for runs and exposures parsed from run logs.
+
+    Tables are:
+
+    - ``runs``: one row per `~snfpipe.logs.Run`, keyed by ``idrun``.
+    - ``exposures``: one row per `~snfpipe.logs.Exposure`, keyed by
+      ``IdExp``, with the ``idrun`` of its run.
+    - ``logfiles``: size and mtime of each log file when it was loaded.
+    - ``rawimage_runs``: run id and exposure id of each file in
+      ``rawimages`` (see `rawimage_run_ids`).
+    """
+    conn.execute("CREATE TABLE IF NOT EXISTS runs (" +
+                 ", ".join("{} {}{}".format(name, _KIND_AFFINITY[kind],
+                                            " PRIMARY KEY" if i == 0 else "")
+                           for i, (name, kind) in enumerate(RUN_COLUMNS)) +
+                 ")")
+    conn.execute("CREATE TABLE IF NOT EXISTS exposures (" +
+                 ", ".join("{} {}{}".format(name, _KIND_AFFINITY[kind],
+                                            " PRIMARY KEY" if i == 0 else "")
+                           for i, (name, kind)
+                           in enumerate(EXPOSURE_COLUMNS)) +
+                 ", idrun text)")
+    conn.execute("CREATE TABLE IF NOT EXISTS logfiles "
+                 "(filepath text PRIMARY KEY, size integer, mtime integer)")
+    conn.execute("CREATE TABLE IF NOT EXISTS rawimage_runs "
+                 "(filepath text PRIMARY KEY, idrun text, idexp text)")
+    for name, table, columns in RUN_INDEXES:
+        conn.execute("CREATE INDEX IF NOT EXISTS {} ON {} ({})"
+                     .format(name, table, columns))
+    conn.commit()
+
+
+def insert_run_logfile(conn, year, day, runs, exposures):
+    """Replace the runs and exposures of one night in the database.
+
+    Existing rows for the night are deleted first. The caller is
+    responsible for committing, so that many nights can be written in a
+    single transaction.
+
+    Parameters
+    ----------
+    conn : `sqlite3.Connection`
+    year, day : int
+        Night (2-digit year and day of year).
+    runs : list of Run
+    exposures : list of Exposure
+    """
+    prefix = "%02d%03d" % (year, day)
+    conn.execute("DELETE FROM runs WHERE idrun >= ? AND idrun < ?",
+                 (prefix, prefix + ":"))
+    conn.execute("DELETE FROM exposures WHERE IdExp >= ? AND IdExp < ?",
+                 (prefix, prefix + ":"))
+
+    names = [name for name, _ in RUN_COLUMNS]
+    conn.executemany("INSERT OR REPLACE INTO runs VALUES ({})"
+                     .format(", ".join("?" * len(names))),
+                     [tuple(getattr(r, name) for name in names)
+                      for r in runs])
+
+    names = [name for name, _ in EXPOSURE_COLUMNS]
+    conn.executemany("INSERT OR REPLACE INTO exposures VALUES ({})"
+                     .format(", ".join("?" * (len(names) + 1))),
+                     [tuple(getattr(e, name) for name in names) +
+                      (e.IdExp[:8],) for e in exposures])
+
+
+_RAW_FNAME_RE = re.compile(r'(\d\d)_(\d\d\d)_(\d\d\d)_(\d\d\d)_')
+
+
+def rawimage_run_ids(filepath, runid, obsid):
+    """Get (idrun, idexp) of a raw image.
+
+    The ids have the formats of `Run.idrun` ('YYDDDRRR') and
+    `Exposure.IdExp` ('YYDDDRRREEE'). They are taken from the RUNID and
+    OBSID header values if these contain the right number of digits, and
+    otherwise from file names of the form 'YY_DDD_RRR_EEE_*.fits'.
+    Either may be None if it cannot be determined.
+    """
+    idrun = None
+    idexp = None
+    if runid:
+        digits = re.sub(r'\D', '', str(runid))
+        if len(digits) == 8:
+            idrun = digits
+    if obsid:
+        digits = re.sub(r'\D', '', str(obsid))
+        if len(digits) == 11:
+            idexp = digits
+
+    m = _RAW_FNAME_RE.match(os.path.basename(filepath))
+    if m is not None:
+        if idrun is None:
+            idrun = "".join(m.groups()[:3])
+        if idexp is None:
+            idexp = "".join(m.groups())
+    if idexp is not None and idrun is None:
+        idrun = idexp[:8]
+
+    return idrun, idexp
+
+
+def link_rawimages(conn, refresh=False):
+    """Fill the rawimage_runs table for rawimages not yet linked.
+
+    Parameters
+    ----------
+    conn : `sqlite3.Connection`
+    refresh : bool, optional
+        Recompute the link for all rawimages.
+
+    Returns
+    -------
+    n : int
+        Number of files linked.
+    """
+    query = "SELECT r.filepath, r.RUNID, r.OBSID FROM rawimages r"
+    if not refresh:
+        query += (" LEFT JOIN rawimage_runs l ON l.filepath = r.filepath "
+                  "WHERE l.filepath IS NULL")
+    rows = [(f,) + rawimage_run_ids(f, runid, obsid)
+            for f, runid, obsid in conn.execute(query).fetchall()]
+    conn.executemany("INSERT OR REPLACE INTO rawimage_runs VALUES (?, ?, ?)",
+                     rows)
+    conn.commit()
+    return len(rows)
+
+
+def files_for_run(conn, idrun):
+    """Paths of raw images belonging to a run ('YYDDDRRR')."""
+    return [t[0] for t in conn.execute(
+        "SELECT filepath FROM rawimage_runs WHERE idrun = ? "
+        "ORDER BY filepath", (idrun,))]
+
+
+def files_for_exposure(conn, idexp):
+    """Paths of raw images belonging to an exposure ('YYDDDRRREEE')."""
+    return [t[0] for t in conn.execute(
+        "SELECT filepath FROM rawimage_runs WHERE idexp = ? "
+        "ORDER BY filepath", (idexp,))]
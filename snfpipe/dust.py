@@ -0,0 +1,155 @@
+"""E(B-V) from the Schlegel, Finkbeiner & Davis (1998) dust maps.
+
+The maps are two 4096x4096 FITS images in a Lambert azimuthal equal-area
+projection, one per Galactic hemisphere (``SFD_dust_4096_ngp.fits`` and
+``SFD_dust_4096_sgp.fits``). `SFDMap` memory-maps the image data, so a
+lookup only reads the pages holding the requested pixels rather than
+the full 64 MB images.
+"""
+
+import os
+
+import numpy as np
+
+from .fitsheader import read_primary_header, primary_data_offset
+from .utils import catalog_radec, radec_to_galactic
+
+__all__ = ["SFDMap"]
+
+DUST_DIR = "/project/projectdirs/snfactry/raw/dust"
+
+# File names of the maps, by hemisphere sign (LAM_NSGP).
+SFD_FNAMES = {1: "SFD_dust_4096_ngp.fits", -1: "SFD_dust_4096_sgp.fits"}
+
+_BITPIX_DTYPES = {-32: '>f4', -64: '>f8', 16: '>i2', 32: '>i4'}
+
+
+class _LambertMap(object):
+    """Memory-mapped image of one hemisphere and its projection."""
+
+    def __init__(self, fname):
+        hdr = read_primary_header(fname, keys=("BITPIX", "NAXIS1", "NAXIS2",
+                                               "CRPIX1", "CRPIX2",
+                                               "LAM_NSGP", "LAM_SCAL"))
+        if hdr is None:
+            raise ValueError("not a FITS file: " + fname)
+        self.nsgp = hdr["LAM_NSGP"]
+        self.scale = float(hdr["LAM_SCAL"])
+        self.crpix1 = float(hdr["CRPIX1"])
+        self.crpix2 = float(hdr["CRPIX2"])
+        self.data = np.memmap(fname, dtype=_BITPIX_DTYPES[hdr["BITPIX"]],
+                              mode='r', offset=primary_data_offset(fname),
+                              shape=(hdr["NAXIS2"], hdr["NAXIS1"]))
+
+    def pixel(self, l, b):
+        """Zero-based (x, y) pixel coordinates of Galactic l, b (deg)."""
+        r = self.scale * np.sqrt(1. - self.nsgp * np.sin(np.radians(b)))
+        x = self.crpix1 - 1. + r * np.cos(np.radians(l))
+        y = self.crpix2 - 1. - self.nsgp * r * np.sin(np.radians(l))
+        return x, y
+
+    def values(self, l, b, interpolate=True):
+        x, y = self.pixel(l, b)
+        ny, nx = self.data.shape
+        if not interpolate:
+            ix = np.clip(np.round(x).astype(np.intp), 0, nx - 1)
+            iy = np.clip(np.round(y).astype(np.intp), 0, ny - 1)
+            return self.data[iy, ix].astype(np.float64)
+
+        # bilinear interpolation between the 4 surrounding pixels,
+        # clamped at the image edges.
+        x = np.clip(x, 0., nx - 1.)
+        y = np.clip(y, 0., ny - 1.)
+        x0 = np.minimum(np.floor(x).astype(np.intp), nx - 2)
+        y0 = np.minimum(np.floor(y).astype(np.intp), ny - 2)
+        fx = x - x0
+        fy = y - y0
+        data = self.data
+        return ((1. - fx) * (1. - fy) * data[y0, x0] +
+                fx * (1. - fy) * data[y0, x0 + 1] +
+                (1. - fx) * fy * data[y0 + 1, x0] +
+                fx * fy * data[y0 + 1, x0 + 1])
+
+
+class SFDMap(object):
+    """Schlegel, Finkbeiner & Davis (1998) E(B-V) map.
+
+    Parameters
+    ----------
+    mapdir : str, optional
+        Directory containing the NGP and SGP map files. Default is
+        `DUST_DIR`.
+    scaling : float, optional
+        Factor applied to the map values (e.g., 0.86 for the Schlafly &
+        Finkbeiner 2011 recalibration). Default is 1.
+
+    Examples
+    --------
+    >>> dustmap = SFDMap()
+    >>> ebv = dustmap.ebv(ra, dec)
+    >>> ebv = dustmap.ebv_catalog(snf_targets)
+    """
+
+    def __init__(self, mapdir=DUST_DIR, scaling=1.):
+        self.mapdir = mapdir
+        self.scaling = scaling
+        self._maps = {}
+
+    def __repr__(self):
+        return "SFDMap({!r}, scaling={!r})".format(self.mapdir, self.scaling)
+
+    def _map(self, nsgp):
+        # maps are opened on first use, so queries in one hemisphere
+        # don't touch the other file.
+        m = self._maps.get(nsgp)
+        if m is None:
+            m = _LambertMap(os.path.join(self.mapdir, SFD_FNAMES[nsgp]))
+            self._maps[nsgp] = m
+        return m
+
+    def ebv_galactic(self, l, b, interpolate=True):
+        """E(B-V) at Galactic coordinates.
+
+        Parameters
+        ----------
+        l, b : array_like
+            Galactic longitude and latitude in degrees.
+        interpolate : bool, optional
+            Bilinearly interpolate between pixels (default) rather than
+            taking the nearest pixel.
+
+        Returns
+        -------
+        ebv : `~numpy.ndarray`
+            E(B-V) in magnitudes, with the broadcast shape of `l` and `b`.
+        """
+        l, b = np.broadcast_arrays(np.asarray(l, dtype=np.float64),
+                                   np.asarray(b, dtype=np.float64))
+        shape = l.shape
+        l = l.ravel()
+        b = b.ravel()
+        ebv = np.full(len(l), np.nan)
+        for nsgp, mask in ((1, b >= 0.), (-1, b < 0.)):
+            if mask.any():
+                ebv[mask] = self._map(nsgp).values(l[mask], b[mask],
+                                                   interpolate)
+        return (self.scaling * ebv).reshape(shape)
+
+    def ebv(self, ra, dec, interpolate=True):
+        """E(B-V) at J2000 RA, Dec (degrees). See `ebv_galactic`."""
+        l, b = radec_to_galactic(ra, dec)
+        return self.ebv_galactic(l, b, interpolate)
+
+    def ebv_catalog(self, catalog, interpolate=True):
+        """E(B-V) for all entries of a catalog.
+
+        Parameters
+        ----------
+        catalog : sequence or (ra, dec) tuple
+            Sequence of objects with ``Ra`` and ``Dec`` attributes (e.g., a
+            list of `SNFTarget` or `IAUCTarget`) or a tuple of arrays.
+        interpolate : bool, optional
+            See `ebv_galactic`.
+        """
+        ra, dec = catalog_radec(catalog)
+        return self.ebv(ra, dec, interpolate)
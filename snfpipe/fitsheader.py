@@ -0,0 +1,150 @@
+"""Minimal pure-Python reader for FITS primary headers.
+
+Only the 2880-byte header blocks of the primary HDU are read, so reading a
+header costs a few small reads regardless of the size of the file.
+"""
+
+import re
+
+__all__ = ["read_primary_header", "parse_card", "primary_data_offset"]
+
+BLOCK_SIZE = 2880
+CARD_SIZE = 80
+
+# Number of blocks read at a time. Most raw image headers fit in this.
+_READ_BLOCKS = 4
+
+_STRING_RE = re.compile(r"\s*'((?:[^']|'')*)'")
+_INT_RE = re.compile(r"[+-]?\d+$")
+
+# Keywords without a value, whose text is accumulated.
+_COMMENTARY = ("COMMENT", "HISTORY", "")
+
+
+def _parse_value(s):
+    """Parse the value part (after '= ') of a card."""
+    m = _STRING_RE.match(s)
+    if m is not None:
+        return m.group(1).replace("''", "'").rstrip()
+
+    # strip comment
+    i = s.find('/')
+    if i >= 0:
+        s = s[:i]
+    s = s.strip()
+
+    if s == 'T':
+        return True
+    if s == 'F':
+        return False
+    if s == '':
+        return None
+    if _INT_RE.match(s):
+        return int(s)
+    try:
+        return float(s.replace('D', 'E').replace('d', 'e'))
+    except ValueError:
+        return s
+
+
+def parse_card(card):
+    """Parse an 80-character header card into (keyword, value).
+
+    Commentary cards (COMMENT, HISTORY, blank) give their text as value.
+    ``HIERARCH`` keywords are returned without the ``HIERARCH`` prefix.
+    """
+    key = card[:8].rstrip()
+    if key == "HIERARCH":
+        i = card.find('=')
+        if i < 0:
+            return key, card[8:].strip()
+        return card[8:i].strip(), _parse_value(card[i+1:])
+    if key in _COMMENTARY or card[8:10] != '= ':
+        return key, card[8:].rstrip()
+    return key, _parse_value(card[10:])
+
+
+def read_primary_header(fname, keys=None):
+    """Read keywords of the primary HDU of a FITS file.
+
+    Parameters
+    ----------
+    fname : str
+        File name.
+    keys : iterable of str, optional
+        Keywords to read. If given, reading stops as soon as all of them
+        have been found, and other keywords are not parsed. Default is to
+        read all keywords.
+
+    Returns
+    -------
+    header : dict or None
+        Mapping of keyword to value. Values are `str`, `int`, `float` or
+        `bool` (or None for keywords with an empty value). Text of COMMENT
+        and HISTORY cards is joined with newlines. None is returned if the
+        file is empty, is not a FITS file or ends before the END card.
+    """
+    if keys is not None:
+        wanted = set(keys)
+        if not wanted:
+            return {}
+
+    header = {}
+    first = True
+    with open(fname, 'rb') as f:
+        while True:
+            data = f.read(_READ_BLOCKS * BLOCK_SIZE)
+
+            # incomplete blocks mean the header is truncated
+            n = len(data) - len(data) % BLOCK_SIZE
+            if n == 0:
+                return None
+
+            text = data[:n].decode('ascii', 'replace')
+            if first and not text.startswith('SIMPLE  ='):
+                return None
+            first = False
+
+            for i in range(0, n, CARD_SIZE):
+                card = text[i:i+CARD_SIZE]
+                key = card[:8].rstrip()
+                if key == 'END':
+                    return header
+                if key == '' or (keys is not None and key not in wanted and
+                                 key != "HIERARCH"):
+                    continue
+                key, value = parse_card(card)
+                if keys is not None and key not in wanted:
+                    continue
+                if key in ("COMMENT", "HISTORY") and key in header:
+                    header[key] += "\n" + value
+                else:
+                    header[key] = value
+                if keys is not None:
+                    wanted.discard(key)
+                    if not wanted:
+                        return header
+
+            if n < len(data):
+                return None
+
+
+def primary_data_offset(fname):
+    """Byte offset of the primary HDU data in a FITS file.
+
+    This is the size of the primary header (a multiple of 2880 bytes), so
+    the data can be memory-mapped without a FITS library. Raises
+    ValueError if the file is not FITS or has no END card.
+    """
+    with open(fname, 'rb') as f:
+        offset = 0
+        while True:
+            block = f.read(BLOCK_SIZE)
+            if len(block) < BLOCK_SIZE:
+                raise ValueError("no END card in primary header of " + fname)
+            if offset == 0 and not block.startswith(b'SIMPLE  ='):
+                raise ValueError("not a FITS file: " + fname)
+            offset += BLOCK_SIZE
+            for i in range(0, BLOCK_SIZE, CARD_SIZE):
+                if block[i:i+8] == b'END     ':
+                    return offset
@@ -1,3 +1,13 @@
+"""Parsing of SNIFS run log files (snifs_run_YY_DDD)."""
+
+import functools
+import gzip
+import os
+import re
+
+from .utils import utc_to_jd
+
+
 class Run(object):
     """
     Parameters
@@ -149,48 +159,22 @@ class Exposure(object):
                     PcE      : Main shutter exposure (fclas = 17,12,52 ) without P channel ????
     """
 
-    def __init__(self, words, run, event):
-        if words[6] == 'init':
-            raise ValueError("Expected to not find 'init' in 7th word")
-
-        year = int(words[0])
-        day = int(words[1])
-        run_ = int(words[2])
+    def __init__(self, words, run, event, fields=None):
+        # `fields` is the result of exposure_line_fields(words, run), which
+        # may be given to avoid re-parsing the same line for each event.
+        if fields is None:
+            fields = exposure_line_fields(words, run)
+        self.Channel, self.Date = fields
 
-        # check that run is consistent
-        if run.year != year or run.day != day or run.run != run_:
-            raise ValueError("run year/day/run does not match words")
-
-        self.IdExp = "%02d%03d%03d%03d" % (year, day, run_, event)
+        self.IdExp = "%02d%03d%03d%03d" % (run.year, run.day, run.run, event)
         self.Event = event
         self.Quality = 1
         self.QualityS = ""
-
-        # get the self.Channel # we can have up to 5 channel: R B P S T
-        # So they will be from pos 6 to pos 11 at max
-        i_max = 11
-        self.Channel = 0
-        for i in range(6, min(len(words), 11)):
-            if len(words[i]) > 1:
-                i_max = i
-                break
-            # analyse the channels found
-            if words[i] == "P":
-                self.Channel += 1
-            elif words[i] == "R":
-                self.Channel += 2
-            elif words[i] == "B":
-                self.Channel += 4
-
-        # We fill the date , for B channel alone this could be usefull
-        # for 2004 and 2005 data
-        self.Date = utc_to_jd(re.search('==>(.*)',
-                                        ' '.join(words[i_max:])).group(1))
         self.MidTime = self.Date
 
         # self.Date=None
         # self.MidTime=None
-        self.Run = run_
+        self.Run = run.run
         run.exp.append(self)
         self.Pose  = []
         # Exposure type
@@ -266,22 +250,123 @@ class Exposure(object):
         self.TelWind =None
 
 
-def read_run_line(line):
-    """Parse a Run from a line of a log file.
-
-    Such lines should have 'init' as the 7th word.
+def exposure_line_fields(words, run):
+    """Parse the fields of an exposure line shared by all its events.
 
     Parameters
     ----------
-    line : str
+    words : list of str
+        Split exposure line from a log file.
+    run : Run
+        The run this line belongs to.
 
     Returns
     -------
+    channel : int
+        Binary pattern of channels: B(4), R(2), P(1).
+    date : float
+        Julian date of the line.
+    """
+    if words[6] == 'init':
+        raise ValueError("Expected to not find 'init' in 7th word")
+
+    # check that run is consistent
+    if (run.year != int(words[0]) or run.day != int(words[1]) or
+            run.run != int(words[2])):
+        raise ValueError("run year/day/run does not match words")
+
+    # get the channel # we can have up to 5 channel: R B P S T
+    # So they will be from pos 6 to pos 11 at max
+    i_max = 11
+    channel = 0
+    for i in range(6, min(len(words), 11)):
+        if len(words[i]) > 1:
+            i_max = i
+            break
+        # analyse the channels found
+        if words[i] == "P":
+            channel += 1
+        elif words[i] == "R":
+            channel += 2
+        elif words[i] == "B":
+            channel += 4
+
+    # We fill the date , for B channel alone this could be usefull
+    # for 2004 and 2005 data
+    date = utc_to_jd(_TIME_RE.search(' '.join(words[i_max:])).group(1))
+
+    return channel, date
+
+
+class ExposureRange(object):
+    """Events ``start`` to ``stop - 1`` of a run, from a single log line.
+
+    All exposures represented by an ExposureRange share the fields derived
+    from the log line (channel and date); they are only created, and
+    appended to the ``exp`` attribute of the parent run, the first time
+    `expand` is called (or the range is iterated over).
+
+    Parameters
+    ----------
     run : Run
+        Parent run.
+    start, stop : int
+        Event numbers, as for ``range(start, stop)``.
+    words : list of str
+        Split exposure line from the log file.
+    fields : tuple, optional
+        Result of ``exposure_line_fields(words, run)``, if already known.
     """
 
-    # Mapping from script to type_ for some scripts
-    TYPES = {"do_object": "OBJECT",
+    __slots__ = ("run", "start", "stop", "words", "Channel", "Date",
+                 "_exposures")
+
+    def __init__(self, run, start, stop, words, fields=None):
+        if fields is None:
+            fields = exposure_line_fields(words, run)
+        self.run = run
+        self.start = start
+        self.stop = stop
+        self.words = words
+        self.Channel, self.Date = fields
+        self._exposures = None
+
+    def __len__(self):
+        return max(0, self.stop - self.start)
+
+    def __iter__(self):
+        return iter(self.expand())
+
+    def __repr__(self):
+        return ("ExposureRange(run={!r}, start={!r}, stop={!r}, "
+                "Channel={!r}, Date={!r})"
+                .format(self.run.idrun, self.start, self.stop, self.Channel,
+                        self.Date))
+
+    @property
+    def events(self):
+        return range(self.start, self.stop)
+
+    def expand(self):
+        """Create the individual exposures.
+
+        The exposures are created (and appended to the ``exp`` attribute
+        of the parent run, as when Exposure is called directly) on the
+        first call only; later calls return the same exposures.
+
+        Returns
+        -------
+        exposures : list of Exposure
+        """
+        if self._exposures is None:
+            fields = (self.Channel, self.Date)
+            self._exposures = [Exposure(self.words, self.run, n, fields)
+                               for n in range(self.start, self.stop)]
+        return list(self._exposures)
+
+
+# Mapping from script to type_ for some scripts
+RUN_TYPES = {"do_object": "OBJECT",
              "do_photo": "PHOTO",
              "do_target": "OBJECT",
              "do_screen": "SCREEN",
@@ -289,8 +374,8 @@ def read_run_line(line):
              "do_acqref": "ACQREF",
              "point_object": "ACQUISITION"}
 
-    # Mapping from script to (target, kind, type_)
-    TKT = {"visual_acq":    ("unknown",        "unknown", "ACQUISITION"),
+# Mapping from script to (target, kind, type_)
+RUN_TKT = {"visual_acq":    ("unknown",        "unknown", "ACQUISITION"),
            "visual_setup":  ("unknown",        "unknown", "ACQUISITION"),
            "imaging_setup": ("unknown",        "unknown", "ACQUISITION"),
            "grabit":        ("",               "grabit",  "ACQUISITION"),
@@ -311,9 +396,9 @@ def read_run_line(line):
            "SNIFS_kill":    ("no light",       "SDSU",    "KILL"),
            "SNIFS_on":      ("no light",       "SDSU",    "ON")}
 
-    # Mapping from etype.lower() to (target, kind, type_),
-    # only for script == "take_expo". Default to all "unknown" if key missing.
-    TKT_TAKE_EXPO = {"arc":       ("internal light", "Calib",   "ARC"),
+# Mapping from etype.lower() to (target, kind, type_),
+# only for script == "take_expo". Default to all "unknown" if key missing.
+RUN_TKT_TAKE_EXPO = {"arc":       ("internal light", "Calib",   "ARC"),
                      "continuum": ("internal light", "Calib",   "CONTINUUM"),
                      "flat":      ("internal light", "Calib",   "CONTINUUM"),
                      "dome":      ("external light", "Calib",   "DOME"),
@@ -322,7 +407,43 @@ def read_run_line(line):
                      "bias":      ("no light ",      "Calib",   "BIAS"),
                      "dark":      ("no light",       "Calib",   "DARK")}
 
-    words = line.split()
+# Precompiled patterns used when parsing log lines.
+_SCRIPT_RE = re.compile(r'([^/]\w+)$')
+_OPTION_RE = re.compile(r'(?=\().*(?=\))')
+_OPTION_STRIP_RE = re.compile(r'[^(].*')
+_TIME_RE = re.compile(r'==>(.*)')
+_ETYPE_RE = re.compile(r'-e (.*?)(?: -[a-z].*)?$')
+
+# Mapping from script to (target_re, kind_re) for scripts in RUN_TYPES.
+_TARGET_KIND_RE = {}
+for _script in ("do_object", "do_photo"):
+    _TARGET_KIND_RE[_script] = (re.compile(r'-o (.*?)(?: -[a-zA-Z].*)?$'),
+                                re.compile(r'-d (.*?)(?: -[a-z] .*)?$'))
+for _script in ("point_object", "do_fchart", "do_target", "do_screen",
+                "do_acqref"):
+    _TARGET_KIND_RE[_script] = (re.compile(r'-o (.*?)(?: -[a-z].*)?$'),
+                                re.compile(r'-k (.*?)(?: -[a-z] .*)?$'))
+del _script
+
+
+def read_run_line(line, words=None):
+    """Parse a Run from a line of a log file.
+
+    Such lines should have 'init' as the 7th word.
+
+    Parameters
+    ----------
+    line : str
+    words : list of str, optional
+        ``line.split()``, if already available.
+
+    Returns
+    -------
+    run : Run
+    """
+
+    if words is None:
+        words = line.split()
 
     # check that the line is really a run
     if words[6] != 'init':
@@ -335,88 +456,107 @@ def read_run_line(line):
     nbexp = int(words[4])
 
     # get script and option
-    try:
-        script = re.search('([^/]\w+)$', words[3]).group(1).strip()
-    except AttributeError:
-        script = words[3]
-
-    try:
-        option = re.search('[^(].*',
-                           re.search('(?=\().*(?=\))', line).group(0)).group(0)
-    except AttributeError:
-        option = ""
+    m = _SCRIPT_RE.search(words[3])
+    script = words[3] if m is None else m.group(1).strip()
 
+    m = _OPTION_RE.search(line)
+    if m is not None:
+        m = _OPTION_STRIP_RE.search(m.group(0))
+    option = "" if m is None else m.group(0)
 
-    if script in TYPES:
-        type_ = TYPES[script]
+    if script in RUN_TYPES:
+        type_ = RUN_TYPES[script]
 
         # For this set of scripts, `target` and `kind` are parsed from
         # the options differently depending on the specific script.
-        if script in ("do_object", "do_photo"):
-            target_re = '-o (.*?)(?: -[a-zA-Z].*)?$'
-            kind_re = '-d (.*?)(?: -[a-z] .*)?$'
-        elif script in ("point_object", "do_fchart", "do_target", "do_screen",
-                        "do_acqref"):
-            target_re = '-o (.*?)(?: -[a-z].*)?$'
-            kind_re = '-k (.*?)(?: -[a-z] .*)?$'
-        else:
-            raise ValueError("unknown script type")
-
+        target_re, kind_re = _TARGET_KIND_RE[script]
+        m = target_re.search(option)
+        target = "unknown" if m is None else m.group(1).strip()
+        m = kind_re.search(option)
+        kind = "unknown" if m is None else m.group(1).strip()
 
-        try:
-            target = re.search(target_re, option).group(1).strip()
-        except AttributeError:
-            target = "unknown"
-        try:
-            kind = re.search(kind_re, option).group(1).strip()
-        except AttributeError:
-            kind = "unknown"
-            
-    elif script in TKT:
-        target, kind, type_ = TKT[script]
+    elif script in RUN_TKT:
+        target, kind, type_ = RUN_TKT[script]
 
     elif script == "take_expo":
-        etype = re.search('-e (.*?)(?: -[a-z].*)?$',option).group(1).strip()
-        if etype in TKT_TAKE_EXPO:
-            target, kind, type_ = TKT_TAKE_EXPO[etype]
-        else:
-            target, kind, type_ = ("unknown", "unknown", "unknown")
+        etype = _ETYPE_RE.search(option).group(1).strip()
+        target, kind, type_ = RUN_TKT_TAKE_EXPO.get(
+            etype, ("unknown", "unknown", "unknown"))
+
+    else:
+        target, kind, type_ = ("unknown", "unknown", "unknown")
 
     # Julian date of the exposure
-    date = utc_to_jd(re.search('==>(.*)', line).group(1))
+    date = utc_to_jd(_TIME_RE.search(line).group(1))
 
     return Run(year, day, run, nbexp, target, kind, type_, date, script,
                option)
 
-def read_run_logfile(fname):
-    """Parse a snifs_run_YY_DDD log file.
 
-    Returns
-    -------
-    runs : list of Run
-    exposures : list of Exposure
+def _open_logfile(fname):
+    """Open a log file for reading text, transparently handling gzip."""
+    if fname.endswith(".gz"):
+        return gzip.open(fname, "rt")
+    return open(fname)
+
+
+def iter_run_logfile(f, ranges=False):
+    """Iterate over the records in a snifs_run_YY_DDD log file.
+
+    Records are yielded one at a time in file order, so that arbitrarily
+    large (or concatenated) log files can be processed in constant memory.
+
+    Parameters
+    ----------
+    f : str or file-like
+        File name or an open file-like object. File names ending in
+        ``.gz`` are decompressed on the fly. File objects may yield
+        either ``str`` or ``bytes`` lines.
+    ranges : bool, optional
+        If True, yield one `ExposureRange` per exposure line instead of
+        one Exposure per event, which avoids creating Exposure objects
+        that aren't needed. Default is False.
+
+    Yields
+    ------
+    record : Run, Exposure or ExposureRange
+        Each Run is yielded before any of its exposures. Exposures are
+        appended to the ``exp`` attribute of their Run when they are
+        created: as they are yielded if `ranges` is False, and when an
+        ExposureRange is first expanded (or iterated over) otherwise.
     """
 
-    f = open(fname)
-    runs = []
-    exposures = []
+    if isinstance(f, str):
+        with _open_logfile(f) as fh:
+            for record in iter_run_logfile(fh, ranges=ranges):
+                yield record
+        return
+
+    run = None
+    event_old = 1
 
     for line in f:
+        if isinstance(line, bytes):
+            line = line.decode("ascii", "replace")
         line = line.strip()
 
         # check that the first thing on the line is a year like "08" or "14".
         # (This actually only checks that the first digit is either "0" or "1".)
-        if re.search('^[01]',line) is None:
+        if line[:1] not in ("0", "1"):
             continue
 
         words = line.split()
 
         if words[6] == 'init':
             # This is a new run
-            runs.append(read_run_line(line))
+            run = read_run_line(line, words)
             event_old = 1
-            event_max = int(words[4])
+            yield run
         else:
+            if run is None:
+                raise ValueError("log file line {!r} precedes any run"
+                                 .format(line))
+
             # NC 31-03-2015
             # The number of event is always set to 1 for do_scala
             # This will create 100 exposures, and some of them
@@ -426,9 +566,15 @@ def read_run_logfile(fname):
                 event = 100
             else:
                 event = int(words[5])+1
-            for n in range(event_old, event):
-                # This is a pose in this run ,
-                exposures.append(Exposure(words, runs[-1], n))
+            if event > event_old:
+                # Per-line parsing is done once for all events of the line.
+                fields = exposure_line_fields(words, run)
+                if ranges:
+                    yield ExposureRange(run, event_old, event, words, fields)
+                else:
+                    for n in range(event_old, event):
+                        # This is a pose in this run ,
+                        yield Exposure(words, run, n, fields)
             event_old = event
 
         # TODO: check for incomplet run
@@ -438,11 +584,193 @@ def read_run_logfile(fname):
         # TODO: we should check than event_old <= event_max + 1 ,
         # and complain if it's not the case
 
-    f.close()
+
+def read_run_logfile(fname):
+    """Parse a snifs_run_YY_DDD log file.
+
+    Parameters
+    ----------
+    fname : str or file-like
+        See `iter_run_logfile`.
+
+    Returns
+    -------
+    runs : list of Run
+    exposures : list of Exposure
+    """
+
+    runs = []
+    exposures = []
+
+    for record in iter_run_logfile(fname):
+        if isinstance(record, Run):
+            runs.append(record)
+        else:
+            exposures.append(record)
 
     return runs, exposures
 
 
+def find_run_logs(root, years=None, nights=None):
+    """Find snifs_run_YY_DDD log files in a ``root/YY/DDD`` directory tree.
+
+    Parameters
+    ----------
+    root : str
+        Top-level log directory, containing 2-digit year directories.
+    years : iterable of int, optional
+        Years to include. Both 2- and 4-digit years are accepted. Default
+        is all years.
+    nights : iterable of int, optional
+        Days of year to include. Default is all days.
+
+    Returns
+    -------
+    fnames : list of (int, int, str)
+        (year, day, filename) tuples sorted by year and day.
+    """
+
+    if years is not None:
+        years = set(int(y) % 100 for y in years)
+    if nights is not None:
+        nights = set(int(d) for d in nights)
+
+    result = []
+    for yy in os.listdir(root):
+        if not (len(yy) == 2 and yy.isdigit()):
+            continue
+        year = int(yy)
+        if years is not None and year not in years:
+            continue
+        yeardir = os.path.join(root, yy)
+        if not os.path.isdir(yeardir):
+            continue
+        for ddd in os.listdir(yeardir):
+            if not (len(ddd) == 3 and ddd.isdigit()):
+                continue
+            day = int(ddd)
+            if nights is not None and day not in nights:
+                continue
+            base = os.path.join(yeardir, ddd,
+                                "snifs_run_{}_{}".format(yy, ddd))
+            for fname in (base, base + ".gz"):
+                if os.path.isfile(fname):
+                    result.append((year, day, fname))
+                    break
+
+    result.sort()
+    return result
+
+
+def _read_run_logfile_safe(fname, cache=None):
+    """Worker for read_run_logs: return (runs, exposures, error)."""
+    try:
+        if cache is None:
+            runs, exposures = read_run_logfile(fname)
+        else:
+            runs, exposures = cache.read_run_logfile(fname)
+    except Exception as e:
+        return [], [], "{}: {}".format(type(e).__name__, e)
+    return runs, exposures, None
+
+
+def iter_run_logfiles(fnames, workers=None, cache=None):
+    """Parse several snifs_run_YY_DDD log files in parallel.
+
+    Parameters
+    ----------
+    fnames : list of str
+        Log file names.
+    workers : int, optional
+        Number of worker processes. Default is the number of CPUs. If 1,
+        files are parsed serially in this process.
+    cache : `~snfpipe.runcache.RunLogCache`, optional
+        If given, only files that changed since they were last cached are
+        parsed; others are loaded from the cache. The cache is trimmed to
+        its size limit afterwards.
+
+    Yields
+    ------
+    fname : str
+        Log file name, in the order of `fnames`.
+    runs : list of Run
+        Sorted by run number.
+    exposures : list of Exposure
+        Sorted by (run, event).
+    error : str or None
+        Error message if the file could not be parsed (in which case
+        `runs` and `exposures` are empty).
+    """
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    worker = functools.partial(_read_run_logfile_safe, cache=cache)
+    if workers == 1 or len(fnames) <= 1:
+        results = map(worker, fnames)
+        executor = None
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        chunksize = max(1, len(fnames) // (8 * workers))
+        executor = ProcessPoolExecutor(max_workers=workers)
+        results = executor.map(worker, fnames, chunksize=chunksize)
+
+    try:
+        # results are in the order of fnames.
+        for fname, (runs, exposures, error) in zip(fnames, results):
+            runs.sort(key=lambda r: r.run)
+            exposures.sort(key=lambda e: (e.Run, e.Event))
+            yield fname, runs, exposures, error
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    if cache is not None:
+        cache.evict()
+
+
+def read_run_logs(root, years=None, nights=None, workers=None, cache=None):
+    """Parse all snifs_run_YY_DDD log files under a directory in parallel.
+
+    Parameters
+    ----------
+    root : str
+        Top-level log directory, containing ``YY/DDD/snifs_run_YY_DDD``.
+    years, nights : iterable of int, optional
+        Restrict to these years and days of year. See `find_run_logs`.
+    workers : int, optional
+        Number of worker processes. Default is the number of CPUs. If 1,
+        files are parsed serially in this process.
+    cache : `~snfpipe.runcache.RunLogCache`, optional
+        See `iter_run_logfiles`.
+
+    Returns
+    -------
+    runs : list of Run
+        Sorted by (year, day, run).
+    exposures : list of Exposure
+        Sorted by (year, day, run, event).
+    failures : list of (str, str)
+        (filename, error message) for each file that could not be parsed.
+        Records from these files are omitted from `runs` and `exposures`.
+    """
+
+    fnames = [fname for _, _, fname in find_run_logs(root, years, nights)]
+
+    runs = []
+    exposures = []
+    failures = []
+    for fname, file_runs, file_exposures, error in iter_run_logfiles(
+            fnames, workers=workers, cache=cache):
+        if error is not None:
+            failures.append((fname, error))
+            continue
+        runs.extend(file_runs)
+        exposures.extend(file_exposures)
+
+    return runs, exposures, failures
+
+
 # testing
 def __main__():
 
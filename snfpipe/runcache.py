@@ -0,0 +1,199 @@
+"""On-disk cache of parsed snifs_run_YY_DDD log files."""
+
+import hashlib
+import os
+import pickle
+import tempfile
+import zlib
+
+from .logs import read_run_logfile
+
+__all__ = ["RunLogCache"]
+
+# Bump when the cached content (or the Run/Exposure classes) change
+# incompatibly. Entries with a different version are re-parsed.
+CACHE_VERSION = 1
+
+# Read size used when hashing log files.
+_HASH_BLOCKSIZE = 1 << 20
+
+
+def _file_hash(fname):
+    """Fast content hash of a file (hex string)."""
+    h = hashlib.blake2b(digest_size=16)
+    with open(fname, 'rb') as f:
+        while True:
+            block = f.read(_HASH_BLOCKSIZE)
+            if not block:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+
+class RunLogCache(object):
+    """Cache of parsed run log files, one compressed file per log file.
+
+    Each cache entry stores the parsed runs and exposures of one log file
+    together with the size, mtime and content hash of the source file.
+    A log file is re-parsed only if its size or mtime changed *and* its
+    content hash differs from the cached one. Unchanged files therefore
+    cost one ``stat`` plus loading the entry.
+
+    Parameters
+    ----------
+    cachedir : str
+        Directory holding cache entries. Created if it doesn't exist.
+    max_bytes : int, optional
+        Maximum total size of the cache entries. When exceeded, the least
+        recently used entries are removed by `evict`. Default is no limit.
+
+    Examples
+    --------
+    >>> cache = RunLogCache("/tmp/snf-run-cache", max_bytes=2**30)
+    >>> runs, exposures = cache.read_run_logfile(fname)
+    """
+
+    suffix = ".runs.z"
+
+    def __init__(self, cachedir, max_bytes=None):
+        self.cachedir = cachedir
+        self.max_bytes = max_bytes
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+
+    def __repr__(self):
+        return "RunLogCache({!r}, max_bytes={!r})".format(self.cachedir,
+                                                          self.max_bytes)
+
+    def entry_path(self, fname):
+        """Cache entry file name for a given log file."""
+        fname = os.path.abspath(fname)
+        key = hashlib.blake2b(fname.encode('utf-8'),
+                              digest_size=8).hexdigest()
+        return os.path.join(self.cachedir,
+                            "{}-{}{}".format(os.path.basename(fname), key,
+                                             self.suffix))
+
+    def _load(self, path):
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        try:
+            entry = pickle.loads(zlib.decompress(data))
+        except Exception:
+            # corrupt, or pickled against an older layout of the classes:
+            # a cache miss, the log file is parsed again.
+            return None
+        if (not isinstance(entry, dict) or
+                entry.get("version") != CACHE_VERSION):
+            return None
+        return entry
+
+    def _store(self, path, entry):
+        data = zlib.compress(pickle.dumps(entry, pickle.HIGHEST_PROTOCOL), 1)
+
+        # write to a temporary file and rename, so that concurrent readers
+        # (e.g., other worker processes) never see a partial entry.
+        fd, tmpname = tempfile.mkstemp(dir=self.cachedir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmpname, path)
+        except BaseException:
+            os.remove(tmpname)
+            raise
+
+    def read_run_logfile(self, fname):
+        """Same as `snfpipe.logs.read_run_logfile`, but using the cache.
+
+        Returns
+        -------
+        runs : list of Run
+        exposures : list of Exposure
+        """
+
+        st = os.stat(fname)
+        path = self.entry_path(fname)
+        entry = self._load(path)
+
+        if entry is not None:
+            if (entry["size"] == st.st_size and
+                    entry["mtime"] == st.st_mtime_ns):
+                # mark entry as recently used.
+                os.utime(path)
+                return entry["runs"], entry["exposures"]
+
+            # stat changed: check whether content actually changed.
+            h = _file_hash(fname)
+            if h == entry["hash"]:
+                entry["size"] = st.st_size
+                entry["mtime"] = st.st_mtime_ns
+                self._store(path, entry)
+                return entry["runs"], entry["exposures"]
+        else:
+            h = _file_hash(fname)
+
+        runs, exposures = read_run_logfile(fname)
+        self._store(path, {"version": CACHE_VERSION,
+                           "size": st.st_size,
+                           "mtime": st.st_mtime_ns,
+                           "hash": h,
+                           "runs": runs,
+                           "exposures": exposures})
+        return runs, exposures
+
+    def entries(self):
+        """List of (path, size, last use time) for all cache entries."""
+        result = []
+        for entry in os.scandir(self.cachedir):
+            if entry.name.endswith(self.suffix):
+                st = entry.stat()
+                result.append((entry.path, st.st_size, st.st_mtime))
+        return result
+
+    def size(self):
+        """Total size of cache entries in bytes."""
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self, max_bytes=None):
+        """Remove least recently used entries until under the size limit.
+
+        Parameters
+        ----------
+        max_bytes : int, optional
+            Size limit. Default is the ``max_bytes`` given at construction;
+            if both are None, nothing is removed.
+
+        Returns
+        -------
+        nremoved : int
+            Number of entries removed.
+        """
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        if max_bytes is None:
+            return 0
+
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        entries.sort(key=lambda e: e[2])  # oldest first
+
+        nremoved = 0
+        for path, size, _ in entries:
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            nremoved += 1
+
+        return nremoved
+
+    def clear(self):
+        """Remove all cache entries."""
+        for path, _, _ in self.entries():
+            os.remove(path)
@@ -0,0 +1,332 @@
+"""Vectorized observing-circumstance calculations (a la skycalc).
+
+Computes, for arrays of (Julian date, RA, Dec), the quantities that
+`snfpipe.logs.Exposure` reserves for skycalc output: sun and moon
+altitude, moon illuminated fraction, object-moon distance, airmass, hour
+angle, parallactic angle and the lunar sky brightness.
+
+Solar and lunar positions use the low-precision formulas of the
+Astronomical Almanac (about 0.01 deg for the sun and 0.3 deg for the
+moon), with topocentric parallax for the moon. They are computed once per
+night on a fine JD grid, cached, and interpolated, so that annotating many
+exposures costs a few array operations per exposure.
+"""
+
+import functools
+
+import numpy as np
+
+__all__ = ["skycalc", "annotate_exposures", "true_airmass",
+           "sun_moon_positions"]
+
+# Mauna Kea site (as in skycalc): degrees (east longitude) and meters.
+LATITUDE = 19.8283
+LONGITUDE = -155.4783
+ELEVATION = 4215.
+
+# Spacing (days) of the cached ephemeris grid, and the V-band extinction
+# coefficient used for the lunar sky brightness.
+EPHEM_STEP = 1. / 144.
+EXTINCTION_V = 0.172
+
+_EPHEM_NSTEP = int(round(1. / EPHEM_STEP))
+_J2000 = 2451545.0
+_EARTH_RADIUS = 6378140.  # m
+_AU = 23454.78  # Earth radii
+
+
+def _sind(x):
+    return np.sin(np.radians(x))
+
+
+def _cosd(x):
+    return np.cos(np.radians(x))
+
+
+def _ecliptic_to_equatorial(lam, beta, eps):
+    """Unit vectors (n, 3) of date from ecliptic longitude and latitude."""
+    cb = _cosd(beta)
+    sb = _sind(beta)
+    sl = _sind(lam)
+    return np.column_stack((cb * _cosd(lam),
+                            _cosd(eps) * cb * sl - _sind(eps) * sb,
+                            _sind(eps) * cb * sl + _cosd(eps) * sb))
+
+
+def _sun(jd):
+    """Geocentric position of the sun (n, 3) in Earth radii."""
+    n = jd - _J2000
+    L = 280.460 + 0.9856474 * n
+    g = 357.528 + 0.9856003 * n
+    lam = L + 1.915 * _sind(g) + 0.020 * _sind(2. * g)
+    eps = 23.439 - 0.0000004 * n
+    r = 1.00014 - 0.01671 * _cosd(g) - 0.00014 * _cosd(2. * g)
+    vec = _ecliptic_to_equatorial(lam, np.zeros_like(lam), eps)
+    return vec * (r * _AU)[:, None]
+
+
+def _moon(jd):
+    """Geocentric position of the moon (n, 3) in Earth radii."""
+    T = (jd - _J2000) / 36525.
+    lam = (218.32 + 481267.881 * T
+           + 6.29 * _sind(135.0 + 477198.87 * T)
+           - 1.27 * _sind(259.3 - 413335.36 * T)
+           + 0.66 * _sind(235.7 + 890534.22 * T)
+           + 0.21 * _sind(269.9 + 954397.74 * T)
+           - 0.19 * _sind(357.5 + 35999.05 * T)
+           - 0.11 * _sind(186.5 + 966404.03 * T))
+    beta = (5.13 * _sind(93.3 + 483202.02 * T)
+            + 0.28 * _sind(228.2 + 960400.89 * T)
+            - 0.28 * _sind(318.3 + 6003.15 * T)
+            - 0.17 * _sind(217.6 - 407332.21 * T))
+    parallax = (0.9508
+                + 0.0518 * _cosd(135.0 + 477198.87 * T)
+                + 0.0095 * _cosd(259.3 - 413335.36 * T)
+                + 0.0078 * _cosd(235.7 + 890534.22 * T)
+                + 0.0028 * _cosd(269.9 + 954397.74 * T))
+    eps = 23.439291 - 0.0130042 * T
+    vec = _ecliptic_to_equatorial(lam, beta, eps)
+    return vec / _sind(parallax)[:, None]
+
+
+@functools.lru_cache(maxsize=1024)
+def _ephemeris_day(day):
+    """Sun and moon positions on the grid of one day (starting at JD
+    `day`), including the first point of the next day."""
+    jd = day + EPHEM_STEP * np.arange(_EPHEM_NSTEP + 1)
+    return _sun(jd), _moon(jd)
+
+
+def sun_moon_positions(jd):
+    """Geocentric sun and moon positions, interpolated from a cached grid.
+
+    Parameters
+    ----------
+    jd : array_like
+        Julian dates (1-d).
+
+    Returns
+    -------
+    sun, moon : `~numpy.ndarray`
+        Arrays of shape (n, 3) of equatorial (mean equinox of date)
+        Cartesian positions in Earth radii.
+    """
+    jd = np.asarray(jd, dtype=np.float64)
+    days = np.floor(jd)
+    udays, inverse = np.unique(days, return_inverse=True)
+    blocks = [_ephemeris_day(float(day)) for day in udays]
+    sun_grid = np.stack([b[0] for b in blocks])
+    moon_grid = np.stack([b[1] for b in blocks])
+
+    x = (jd - days) / EPHEM_STEP
+    k = np.minimum(x.astype(np.intp), _EPHEM_NSTEP - 1)
+    frac = (x - k)[:, None]
+    sun = ((1. - frac) * sun_grid[inverse, k] +
+           frac * sun_grid[inverse, k + 1])
+    moon = ((1. - frac) * moon_grid[inverse, k] +
+            frac * moon_grid[inverse, k + 1])
+    return sun, moon
+
+
+def _gmst(jd):
+    """Greenwich mean sidereal time in degrees."""
+    return (280.46061837 + 360.98564736629 * (jd - _J2000)) % 360.
+
+
+def _precess_from_j2000(ra, dec, jd):
+    """Precess J2000 RA, Dec (degrees) to the mean equinox of date."""
+    T = (jd - _J2000) / 36525.
+    zeta = (0.6406161 + (0.0000839 + 0.0000050 * T) * T) * T
+    z = (0.6406161 + (0.0003041 + 0.0000051 * T) * T) * T
+    theta = (0.5567530 - (0.0001185 + 0.0000116 * T) * T) * T
+
+    cd = _cosd(dec)
+    sd = _sind(dec)
+    ca = _cosd(ra + zeta)
+    A = cd * _sind(ra + zeta)
+    B = _cosd(theta) * cd * ca - _sind(theta) * sd
+    C = _sind(theta) * cd * ca + _cosd(theta) * sd
+    return ((np.degrees(np.arctan2(A, B)) + z) % 360.,
+            np.degrees(np.arcsin(np.clip(C, -1., 1.))))
+
+
+def _unit(ra, dec):
+    cd = _cosd(dec)
+    return np.column_stack((cd * _cosd(ra), cd * _sind(ra), _sind(dec)))
+
+
+def _radec(vec):
+    r = np.sqrt((vec**2).sum(axis=1))
+    return (np.degrees(np.arctan2(vec[:, 1], vec[:, 0])) % 360.,
+            np.degrees(np.arcsin(np.clip(vec[:, 2] / r, -1., 1.))))
+
+
+def _angle(v1, v2):
+    """Angle in degrees between arrays of vectors."""
+    cross = np.sqrt((np.cross(v1, v2)**2).sum(axis=1))
+    return np.degrees(np.arctan2(cross, (v1 * v2).sum(axis=1)))
+
+
+def _altitude(ha, dec, lat):
+    return np.degrees(np.arcsin(np.clip(
+        _sind(dec) * _sind(lat) + _cosd(dec) * _cosd(lat) * _cosd(ha),
+        -1., 1.)))
+
+
+def true_airmass(secz):
+    """Airmass from sec(z), with the Hardie (1962) polynomial correction.
+
+    Values are NaN for objects below the horizon (``secz <= 0``).
+    """
+    secz = np.asarray(secz, dtype=np.float64)
+    x = secz - 1.
+    airmass = secz - x * (0.0018167 + x * (0.002875 + 0.0008083 * x))
+    return np.where(secz > 0., airmass, np.nan)
+
+
+def _lunar_sky_brightness(alpha, rho, kzen, moondist, zmoon, zobj):
+    """Moonlight sky brightness (V mag / arcsec^2), after Krisciunas &
+    Schaefer (1991).
+
+    alpha: moon phase angle, rho: moon-object distance, zmoon, zobj: zenith
+    distances (all degrees); moondist in Earth radii.
+    """
+    alpha = np.abs(alpha)
+    istar = 10.**(-0.4 * (3.84 + 0.026 * alpha + 4.e-9 * alpha**4))
+    istar = np.where(alpha < 7., istar * (1.35 - 0.05 * alpha), istar)
+    istar *= (60.27 / moondist)**2
+
+    rho = np.maximum(rho, 1.e-3)
+    with np.errstate(over='ignore'):
+        fofrho = np.where(rho > 10.,
+                          229087. * (1.06 + _cosd(rho)**2) +
+                          10.**(6.15 - rho / 40.),
+                          6.2e7 / rho**2)
+
+    xzm = 1. / np.sqrt(1. - 0.96 * _sind(zmoon)**2)
+    xzo = 1. / np.sqrt(1. - 0.96 * _sind(zobj)**2)
+    bmoon = (fofrho * istar * 10.**(-0.4 * kzen * xzm) *
+             (1. - 10.**(-0.4 * kzen * xzo)))  # nanoLamberts
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return 22.50 - 1.08574 * np.log(bmoon / 34.08)
+
+
+def skycalc(jd, ra, dec, latitude=LATITUDE, longitude=LONGITUDE,
+            elevation=ELEVATION):
+    """Observing circumstances of objects at given times.
+
+    Parameters
+    ----------
+    jd : array_like
+        Julian dates (UTC), e.g., exposure mid-times.
+    ra, dec : array_like
+        J2000 coordinates of the objects in degrees. Broadcast with `jd`.
+    latitude, longitude : float, optional
+        Site latitude and east longitude in degrees. Default is Mauna Kea.
+    elevation : float, optional
+        Site elevation in meters.
+
+    Returns
+    -------
+    result : dict of `~numpy.ndarray`
+        Keyed by `~snfpipe.logs.Exposure` attribute name:
+
+        - ``AltSun``, ``AltMoon``: sun and (topocentric) moon altitude
+          (degrees).
+        - ``MoonIllFrac``: illuminated fraction of the moon.
+        - ``ObjMoon``: angular distance between object and moon (degrees).
+        - ``MidAirMass``: airmass of the object (NaN below the horizon).
+        - ``MidHa``: hour angle of the object (degrees, -180 to 180).
+        - ``ParAng``: parallactic angle of the object (degrees).
+        - ``LunSky``: moonlight sky brightness at the object position in V
+          mag / arcsec^2 (NaN when moon or object is below the horizon).
+    """
+    jd, ra, dec = np.broadcast_arrays(np.atleast_1d(jd).astype(np.float64),
+                                      np.atleast_1d(ra).astype(np.float64),
+                                      np.atleast_1d(dec).astype(np.float64))
+    shape = jd.shape
+    jd = jd.ravel()
+    ra = ra.ravel()
+    dec = dec.ravel()
+    result = dict((name, np.full(shape, np.nan)) for name in
+                  ("AltSun", "AltMoon", "MoonIllFrac", "ObjMoon",
+                   "MidAirMass", "MidHa", "ParAng", "LunSky"))
+    good = np.isfinite(jd)
+    if not good.any():
+        return result
+    jd = jd[good]
+    ra = ra[good]
+    dec = dec[good]
+
+    lst = (_gmst(jd) + longitude) % 360.
+    lat = latitude
+
+    # observer position (Earth radii), for the topocentric moon.
+    u = np.arctan(0.99664719 * np.tan(np.radians(lat)))
+    h = elevation / _EARTH_RADIUS
+    rho_sin = 0.99664719 * np.sin(u) + h * _sind(lat)
+    rho_cos = np.cos(u) + h * _cosd(lat)
+    observer = np.column_stack((rho_cos * _cosd(lst), rho_cos * _sind(lst),
+                                np.full(len(jd), rho_sin)))
+
+    sun, moon_geo = sun_moon_positions(jd)
+    moon = moon_geo - observer
+    sun_ra, sun_dec = _radec(sun)
+    moon_ra, moon_dec = _radec(moon)
+
+    # phase angle of the moon: angle sun-moon-earth.
+    phase = _angle(sun - moon_geo, -moon_geo)
+    moondist = np.sqrt((moon**2).sum(axis=1))
+
+    ra_d, dec_d = _precess_from_j2000(ra, dec, jd)
+    ha = (lst - ra_d + 180.) % 360. - 180.
+    alt = _altitude(ha, dec_d, lat)
+    alt_moon = _altitude(lst - moon_ra, moon_dec, lat)
+    obj_moon = _angle(_unit(ra_d, dec_d), moon)
+
+    with np.errstate(divide='ignore'):
+        secz = np.where(alt > 0., 1. / _sind(alt), 0.)
+    parang = np.degrees(np.arctan2(
+        _sind(ha), np.tan(np.radians(lat)) * _cosd(dec_d) -
+        _sind(dec_d) * _cosd(ha)))
+
+    lunsky = _lunar_sky_brightness(phase, obj_moon, EXTINCTION_V, moondist,
+                                   90. - alt_moon, 90. - alt)
+    lunsky[(alt_moon <= 0.) | (alt <= 0.)] = np.nan
+
+    for name, value in (("AltSun", _altitude(lst - sun_ra, sun_dec, lat)),
+                        ("AltMoon", alt_moon),
+                        ("MoonIllFrac", (1. + _cosd(phase)) / 2.),
+                        ("ObjMoon", obj_moon),
+                        ("MidAirMass", true_airmass(secz)),
+                        ("MidHa", ha),
+                        ("ParAng", parang),
+                        ("LunSky", lunsky)):
+        result[name].ravel()[good] = value
+
+    return result
+
+
+def annotate_exposures(exposures):
+    """Set the skycalc attributes of exposures.
+
+    ``AltSun``, ``AltMoon``, ``MoonIllFrac``, ``ObjMoon``, ``MidAirMass``,
+    ``MidHa``, ``ParAng`` and ``LunSky`` of each `~snfpipe.logs.Exposure`
+    are computed at ``MidTime`` for the target position (``Ra``, ``Dec``)
+    in one call to `skycalc`. Attributes are set to None where they can't
+    be computed (e.g., missing coordinates, or object below the horizon
+    for the airmass).
+
+    Parameters
+    ----------
+    exposures : list of Exposure
+    """
+    def values(name):
+        return np.array([np.nan if v is None else v
+                         for v in (getattr(e, name) for e in exposures)],
+                        dtype=np.float64)
+
+    result = skycalc(values("MidTime"), values("Ra"), values("Dec"))
+    for name, column in result.items():
+        for e, v in zip(exposures, column.tolist()):
+            setattr(e, name, None if v != v else v)
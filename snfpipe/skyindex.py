@@ -0,0 +1,176 @@
+"""Spatial index on the sky for fast positional cross-matching."""
+
+import numpy as np
+
+from .utils import catalog_radec
+
+__all__ = ["SkyIndex", "crossmatch"]
+
+# Smallest grid cell size (in units of the unit sphere). Limits the number
+# of cells along each axis so that cell keys fit in an int64; ~3 arcsec.
+MIN_CELL_SIZE = 2.**-16
+
+# Number of query positions processed at a time.
+QUERY_CHUNK_SIZE = 65536
+
+# Offsets to the 27 grid cells surrounding (and including) a cell.
+_NEIGHBORS = np.array([(i, j, k) for i in (-1, 0, 1) for j in (-1, 0, 1)
+                       for k in (-1, 0, 1)], dtype=np.int64)
+
+
+def _unit_vectors(ra, dec):
+    """Unit vectors of shape (n, 3) from RA, Dec in degrees."""
+    ra = np.radians(np.asarray(ra, dtype=np.float64))
+    dec = np.radians(np.asarray(dec, dtype=np.float64))
+    cos_dec = np.cos(dec)
+    return np.column_stack((cos_dec * np.cos(ra), cos_dec * np.sin(ra),
+                            np.sin(dec)))
+
+
+def _chord(radius):
+    """Chord length on the unit sphere for an angle in degrees."""
+    return 2. * np.sin(np.radians(radius) / 2.)
+
+
+class SkyIndex(object):
+    """Index of sky positions for radius queries.
+
+    Positions are converted to unit vectors and bucketed in a 3-d grid
+    whose cells are at least as large as `max_radius`, so all matches to a
+    query lie in the 27 cells around it. Building the index is a sort;
+    each query is a binary search per neighbouring cell, so cross-matching
+    two catalogs costs about O((n + m) log n) rather than O(n m).
+
+    Parameters
+    ----------
+    ra, dec : array_like
+        Positions in degrees.
+    max_radius : float
+        Largest radius (degrees) that will be used in queries.
+
+    Examples
+    --------
+    >>> index = SkyIndex(ra, dec, max_radius=5./3600.)
+    >>> iq, icat, dist = index.query_radius(qra, qdec, 2./3600.)
+    """
+
+    def __init__(self, ra, dec, max_radius):
+        self.max_radius = float(max_radius)
+        self._vec = _unit_vectors(ra, dec)
+        self._cell_size = max(_chord(min(self.max_radius, 180.)),
+                              MIN_CELL_SIZE)
+        self._ncells = int(2. / self._cell_size) + 3
+
+        keys = self._keys(self._cells(self._vec))
+        self._order = np.argsort(keys, kind='stable')
+        self._keys_sorted = keys[self._order]
+
+    def __len__(self):
+        return len(self._vec)
+
+    def _cells(self, vec):
+        # shift by one so that neighbours of edge cells are non-negative.
+        return np.floor((vec + 1.) / self._cell_size).astype(np.int64) + 1
+
+    def _keys(self, cells):
+        n = self._ncells
+        return (cells[..., 0] * n + cells[..., 1]) * n + cells[..., 2]
+
+    def _query_chunk(self, vec, chord):
+        # keys of all neighbouring cells of each query: shape (m, 27)
+        cells = self._cells(vec)[:, None, :] + _NEIGHBORS
+        keys = self._keys(cells)
+        start = np.searchsorted(self._keys_sorted, keys, side='left').ravel()
+        end = np.searchsorted(self._keys_sorted, keys, side='right').ravel()
+        counts = end - start
+        total = counts.sum()
+
+        # expand (query, cell) ranges into flat candidate pairs.
+        iq = np.repeat(np.repeat(np.arange(len(vec)), len(_NEIGHBORS)),
+                       counts)
+        pos = (np.arange(total) - np.repeat(np.cumsum(counts) - counts,
+                                            counts) +
+               np.repeat(start, counts))
+        icat = self._order[pos]
+
+        d2 = ((vec[iq] - self._vec[icat])**2).sum(axis=1)
+        keep = d2 <= chord**2
+        iq = iq[keep]
+        icat = icat[keep]
+        dist = np.degrees(2. * np.arcsin(np.minimum(np.sqrt(d2[keep]) / 2.,
+                                                    1.)))
+        return iq, icat, dist
+
+    def query_radius(self, ra, dec, radius=None):
+        """Find all indexed positions within a radius of query positions.
+
+        Parameters
+        ----------
+        ra, dec : array_like
+            Query positions in degrees.
+        radius : float, optional
+            Search radius in degrees; must not exceed ``max_radius``.
+            Default is ``max_radius``.
+
+        Returns
+        -------
+        iq : `~numpy.ndarray` (int)
+            Index of the query position for each match.
+        icat : `~numpy.ndarray` (int)
+            Index of the indexed position for each match.
+        dist : `~numpy.ndarray`
+            Angular distance in degrees for each match.
+
+        Matches are sorted by ``iq``, then by distance.
+        """
+        if radius is None:
+            radius = self.max_radius
+        elif radius > self.max_radius:
+            raise ValueError("radius larger than max_radius of index")
+
+        vec = _unit_vectors(np.atleast_1d(ra), np.atleast_1d(dec))
+        chord = _chord(radius)
+
+        results = [self._query_chunk(vec[s:s + QUERY_CHUNK_SIZE], chord)
+                   for s in range(0, len(vec), QUERY_CHUNK_SIZE)]
+        if not results:
+            return (np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp),
+                    np.zeros(0))
+        offsets = np.arange(0, len(vec), QUERY_CHUNK_SIZE)
+        iq = np.concatenate([r[0] + off for r, off in zip(results, offsets)])
+        icat = np.concatenate([r[1] for r in results])
+        dist = np.concatenate([r[2] for r in results])
+
+        order = np.lexsort((dist, iq))
+        return iq[order], icat[order], dist[order]
+
+
+def crossmatch(catalog_a, catalog_b, radius):
+    """Find all pairs of positions in two catalogs within a radius.
+
+    Parameters
+    ----------
+    catalog_a, catalog_b : sequence or (ra, dec) tuple
+        Catalogs: either sequences of objects with ``Ra`` and ``Dec``
+        attributes in degrees (e.g., lists of `IAUCTarget` or `SNFTarget`)
+        or ``(ra, dec)`` tuples of arrays (e.g., telescope pointings).
+    radius : float
+        Match radius in degrees.
+
+    Returns
+    -------
+    ia, ib : `~numpy.ndarray` (int)
+        Indices into `catalog_a` and `catalog_b` of each matched pair.
+    dist : `~numpy.ndarray`
+        Angular distance of each pair in degrees.
+
+    Examples
+    --------
+    Find IAUC supernovae within 5 arcsec of SNF targets:
+
+    >>> ia, ib, dist = crossmatch(snf_targets, iauc_targets, 5./3600.)
+    """
+    ra_a, dec_a = catalog_radec(catalog_a)
+    ra_b, dec_b = catalog_radec(catalog_b)
+    index = SkyIndex(ra_b, dec_b, radius)
+    return index.query_radius(ra_a, dec_a)
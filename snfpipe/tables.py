@@ -0,0 +1,355 @@
+"""Columnar (NumPy-backed) tables of runs and exposures.
+
+`ExposureTable` and `RunTable` hold the same information as lists of
+`snfpipe.logs.Exposure` and `snfpipe.logs.Run` instances, but with one
+typed array per attribute. Missing values (``None`` in the object
+representation) are stored as NaN for float columns and masked for integer
+columns. Columns are accessed as attributes (``table.Fclass``), and
+individual rows through lightweight views that expose the same attribute
+names as the original classes.
+"""
+
+import numpy as np
+
+from .logs import Run, Exposure
+
+__all__ = ["ExposureTable", "RunTable"]
+
+# Column kinds:
+#   'f' : float64, NaN for missing
+#   'i' : int64, masked for missing
+#   'U' : unicode string, '' for missing
+
+EXPOSURE_COLUMNS = (
+    ("IdExp", 'U'), ("Event", 'i'), ("Run", 'i'), ("Channel", 'i'),
+    ("Date", 'f'), ("MidTime", 'f'), ("Fclass", 'i'), ("OpenTime", 'f'),
+    ("Quality", 'i'), ("QualityS", 'U'),
+    # guiding
+    ("Guide", 'i'), ("GuideX", 'f'), ("GuideY", 'f'), ("SeeingInst", 'f'),
+    ("Seeing", 'f'), ("GuideF", 'f'), ("GuideS", 'f'), ("Interrupt", 'i'),
+    # pointing
+    ("Ra", 'f'), ("Dec", 'f'), ("RaPoint", 'f'), ("DecPoint", 'f'),
+    ("RaTel", 'f'), ("DecTel", 'f'), ("AirMass", 'f'), ("Ha", 'f'),
+    ("Zd", 'f'), ("Azimuth", 'f'), ("Altitude", 'f'),
+    # skycalc
+    ("AltSun", 'f'), ("AltMoon", 'f'), ("MoonIllFrac", 'f'),
+    ("ObjMoon", 'f'), ("MidAirMass", 'f'), ("MidHa", 'f'), ("ParAng", 'f'),
+    ("LunSky", 'f'),
+    # SNIFS state
+    ("Filter", 'U'), ("LampConB", 'i'), ("LampConR", 'i'),
+    ("LampArcB", 'i'), ("LampArcR", 'i'), ("LampDome", 'i'),
+    ("SnifsTemp", 'f'), ("Pop", 'i'), ("FocusB", 'i'), ("FocusR", 'i'),
+    ("FilterReq", 'i'), ("FilterPos", 'i'), ("FocusReqB", 'i'),
+    ("FocusReqR", 'i'),
+    # telescope & weather
+    ("Pressure", 'f'), ("Humidity", 'i'), ("Temp", 'f'), ("SnifsHumid", 'f'),
+    ("SnifsHTemp", 'f'), ("LightFlu", 'f'), ("LightInc", 'f'),
+    ("WindDir", 'i'), ("WindSpeed", 'f'), ("TelTemp", 'f'),
+    ("TelFocus", 'f'), ("TelHumidIn", 'f'), ("TelHumidOut", 'f'),
+    ("TelWind", 'f'))
+
+RUN_COLUMNS = (
+    ("idrun", 'U'), ("year", 'i'), ("day", 'i'), ("run", 'i'),
+    ("nbexp", 'i'), ("target", 'U'), ("kind", 'U'), ("type_", 'U'),
+    ("date", 'f'), ("script", 'U'), ("option", 'U'), ("quality", 'i'),
+    ("qualitys", 'U'))
+
+
+def _to_array(values, kind):
+    """Convert a list of Python values (possibly None) to (array, mask)."""
+    if kind == 'f':
+        return np.array([np.nan if v is None else v for v in values],
+                        dtype=np.float64), None
+    elif kind == 'i':
+        mask = np.fromiter((v is None for v in values), dtype=bool,
+                           count=len(values))
+        data = np.array([0 if v is None else v for v in values],
+                        dtype=np.int64)
+        return data, (mask if mask.any() else None)
+    else:
+        data = np.array(['' if v is None else v for v in values],
+                        dtype=np.str_)
+        if len(values) == 0:
+            data = data.astype('U1')
+        return data, None
+
+
+def _to_python(value, kind, missing):
+    """Convert a single array element back to a Python value."""
+    if kind == 'f':
+        value = float(value)
+        return None if value != value else value
+    elif kind == 'i':
+        return None if missing else int(value)
+    else:
+        return str(value)
+
+
+class _Row(object):
+    """View of a single row of a table."""
+
+    __slots__ = ("_table", "_index")
+
+    def __init__(self, table, index):
+        self._table = table
+        self._index = index
+
+    def __getattr__(self, name):
+        return self._table._get_value(name, self._index)
+
+    def __dir__(self):
+        return [name for name, _ in self._table.columns]
+
+    def __repr__(self):
+        return "<{} row {} of {}>".format(type(self._table).__name__,
+                                          self._index, len(self._table))
+
+
+class _ColumnTable(object):
+    """Base class for column tables. Subclasses define `columns`."""
+
+    columns = ()
+
+    def __init__(self, data, masks=None):
+        self._kinds = dict(self.columns)
+        self._data = data
+        self._masks = {} if masks is None else masks
+        lengths = set(len(a) for a in data.values())
+        if len(lengths) > 1:
+            raise ValueError("columns have different lengths")
+        self._len = lengths.pop() if lengths else 0
+
+    @classmethod
+    def _from_objects(cls, objects):
+        objects = list(objects)
+        data = {}
+        masks = {}
+        for name, kind in cls.columns:
+            data[name], mask = _to_array([getattr(o, name) for o in objects],
+                                         kind)
+            if mask is not None:
+                masks[name] = mask
+        return cls(data, masks)
+
+    @classmethod
+    def concatenate(cls, tables):
+        """Concatenate several tables into one."""
+        tables = list(tables)
+        data = {}
+        masks = {}
+        for name, kind in cls.columns:
+            data[name] = np.concatenate([t._data[name] for t in tables])
+            if kind == 'i' and any(name in t._masks for t in tables):
+                masks[name] = np.concatenate([t._mask(name) for t in tables])
+        return cls(data, masks)
+
+    def _mask(self, name):
+        mask = self._masks.get(name)
+        if mask is None:
+            mask = np.zeros(self._len, dtype=bool)
+        return mask
+
+    def _get_value(self, name, i):
+        try:
+            kind = self._kinds[name]
+        except KeyError:
+            raise AttributeError(name)
+        mask = self._masks.get(name)
+        return _to_python(self._data[name][i], kind,
+                          mask is not None and mask[i])
+
+    def column(self, name):
+        """Return a column as an array.
+
+        Integer columns with missing values are returned as masked arrays.
+        """
+        kind = self._kinds[name]
+        data = self._data[name]
+        if kind == 'i':
+            return np.ma.MaskedArray(data, mask=self._masks.get(name,
+                                                                np.ma.nomask))
+        return data
+
+    def __getattr__(self, name):
+        # only called for names not found normally: look up columns.
+        if name.startswith('_') or name not in self._kinds:
+            raise AttributeError(name)
+        return self.column(name)
+
+    def __dir__(self):
+        return sorted(set(object.__dir__(self)) |
+                      set(name for name, _ in self.columns))
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        for i in range(self._len):
+            yield _Row(self, i)
+
+    def __getitem__(self, key):
+        """Row view for an integer, or a new table for a slice, index array
+        or boolean mask."""
+        if isinstance(key, (int, np.integer)):
+            if key < 0:
+                key += self._len
+            if not 0 <= key < self._len:
+                raise IndexError("row index out of range")
+            return _Row(self, int(key))
+
+        if isinstance(key, str):
+            return self.column(key)
+
+        if isinstance(key, np.ma.MaskedArray):
+            key = key.filled(False)
+        data = dict((name, a[key]) for name, a in self._data.items())
+        masks = dict((name, m[key]) for name, m in self._masks.items())
+        return type(self)(data, masks)
+
+    def __repr__(self):
+        return "<{} with {} rows>".format(type(self).__name__, self._len)
+
+
+class ExposureTable(_ColumnTable):
+    """Columnar table of exposures.
+
+    Columns have the names of the `snfpipe.logs.Exposure` attributes
+    (except ``Pose``). Float columns use NaN and integer columns use a mask
+    for values that are ``None`` in `Exposure`.
+
+    Examples
+    --------
+    >>> runs, exposures = read_run_logfile(fname)
+    >>> t = ExposureTable.from_exposures(exposures)
+    >>> t.Date  # array of Julian dates
+    >>> sub = t.select(fclass=17, channel=4)
+    >>> sub[0].IdExp
+    """
+
+    columns = EXPOSURE_COLUMNS
+
+    @classmethod
+    def from_exposures(cls, exposures):
+        """Create table from an iterable of `Exposure` instances."""
+        return cls._from_objects(exposures)
+
+    def to_exposures(self, runs=None):
+        """Convert to a list of `Exposure` instances.
+
+        Parameters
+        ----------
+        runs : list of Run, optional
+            If given, each exposure is appended to the ``exp`` attribute of
+            the run with matching ``idrun``.
+
+        Returns
+        -------
+        exposures : list of Exposure
+        """
+        runs_by_id = None
+        if runs is not None:
+            runs_by_id = dict((run.idrun, run) for run in runs)
+
+        exposures = []
+        for i in range(self._len):
+            exp = Exposure.__new__(Exposure)
+            for name, _ in self.columns:
+                setattr(exp, name, self._get_value(name, i))
+            exp.Pose = []
+            if runs_by_id is not None:
+                runs_by_id[exp.IdExp[:8]].exp.append(exp)
+            exposures.append(exp)
+
+        return exposures
+
+    def idrun(self):
+        """Array of the 8-character run ids (YYDDDRRR) of each exposure."""
+        return self._data["IdExp"].astype('U8')
+
+    def select(self, fclass=None, channel=None, date_min=None,
+               date_max=None):
+        """Return a table of the exposures matching all given criteria.
+
+        Parameters
+        ----------
+        fclass : int or sequence of int, optional
+            Keep exposures with Fclass equal to (one of) these values.
+        channel : int, optional
+            Keep exposures including all channel bits in ``channel``
+            (B=4, R=2, P=1).
+        date_min, date_max : float, optional
+            Keep exposures with ``date_min <= Date < date_max``.
+        """
+        keep = np.ones(self._len, dtype=bool)
+        if fclass is not None:
+            keep &= (np.isin(self._data["Fclass"], fclass) &
+                     ~self._mask("Fclass"))
+        if channel is not None:
+            keep &= (self._data["Channel"] & channel) == channel
+        if date_min is not None:
+            keep &= self._data["Date"] >= date_min
+        if date_max is not None:
+            keep &= self._data["Date"] < date_max
+        return self[keep]
+
+
+class RunTable(_ColumnTable):
+    """Columnar table of runs.
+
+    Columns have the names of the `snfpipe.logs.Run` attributes, except
+    ``targetid`` and ``exp``. Exposures are kept separately in an
+    `ExposureTable` and related to runs through ``idrun``.
+    """
+
+    columns = RUN_COLUMNS
+
+    @classmethod
+    def from_runs(cls, runs):
+        """Create table from an iterable of `Run` instances."""
+        return cls._from_objects(runs)
+
+    def to_runs(self, exposures=None):
+        """Convert to a list of `Run` instances.
+
+        Parameters
+        ----------
+        exposures : ExposureTable, optional
+            If given, exposures are converted too and attached to the
+            ``exp`` attribute of their runs.
+
+        Returns
+        -------
+        runs : list of Run
+        """
+        runs = []
+        for i in range(self._len):
+            v = dict((name, self._get_value(name, i))
+                     for name, _ in self.columns)
+            del v["idrun"]
+            runs.append(Run(**v))
+        if exposures is not None:
+            exposures.to_exposures(runs)
+        return runs
+
+    def select(self, type_=None, kind=None, date_min=None, date_max=None):
+        """Return a table of the runs matching all given criteria.
+
+        Parameters
+        ----------
+        type_ : str or sequence of str, optional
+            Keep runs with this type (or one of these types).
+        kind : str or sequence of str, optional
+            Keep runs of this kind (or one of these kinds).
+        date_min, date_max : float, optional
+            Keep runs with ``date_min <= date < date_max``.
+        """
+        keep = np.ones(self._len, dtype=bool)
+        if type_ is not None:
+            keep &= np.isin(self._data["type_"], type_)
+        if kind is not None:
+            keep &= np.isin(self._data["kind"], kind)
+        if date_min is not None:
+            keep &= self._data["date"] >= date_min
+        if date_max is not None:
+            keep &= self._data["date"] < date_max
+        return self[keep]
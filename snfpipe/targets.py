@@ -1,12 +1,19 @@
 """Parsing the HTML page for IAUC supernovae and the SNF target file."""
 
+import json
 import os
 import re
 import string
+import tempfile
 
-from .utils import RADec, utc_to_jd
+import numpy as np
 
-__all__ = ["IAUCTarget", "SNFTarget", "read_iauc_targets", "read_snf_targets"]
+from .skyindex import crossmatch
+from .utils import (RADec, parse_radec_array, utc_to_jd, load_pickle,
+                    dump_pickle)
+
+__all__ = ["IAUCTarget", "SNFTarget", "TargetCatalog", "read_iauc_targets",
+           "read_snf_targets", "update_iauc_targets"]
 
 
 class IAUCTarget(object):
@@ -45,27 +52,40 @@ class SNFTarget(object):
                         self.Type, self.Kind, self.File, self.x, self.y))
 
 
-def read_iauc_line(l):
+#RP - welcome to regex hell
+_IAUC_LINE_RE = re.compile(r'(?P<sn>\d{4}[A-Z]?[a-z]{0,2})\s{2,3}'
+                           # this may happen to be only whitespace
+                           r'(?P<galinfo>.+)'
+                           # CBET / IAUC
+                           r'(?P<galref>[A-Z]{4}\s+\d{1,})\s+'
+                           r'(?P<ra>\d+\s+\d+\s+\d+(\.\d+)?)\s+'
+                           r'(?P<dec>[\+\-\_]?\s?\d+\s+(\d+\s+)?\d+(\.\d+)?)'
+                           r'\s+'
+                           r'(?P<ref>([A-Z]{4}\s+\d{1,})\s+|\s+)'
+                           r'(?P<type>.+(?=\d{4}[A-Z]?[a-z]{0,2}))')
+_IAUC_HASDATE_RE = re.compile(r'(.+(?=\d{4}\s+\d{2}))')
+_IAUC_GALINFO_RE = re.compile(r'(?P<galaxy>.+)'
+                              r'(?P<date>\d{4}\s+\d{2}\s+\d{2})\s+'
+                              r'(?P<galra>\d{1,}\s+\d{1,}\.\d)\s+'
+                              r'(?P<galdec>\+?\-?\s?\d+\s+\d+)\s+'
+                              r'(?P<offmag>.+)')
+_HTML_TAG_RE = re.compile('<.+?>')
+
+
+def _parse_iauc_line(l):
+    """Parse a line of the IAUC list, leaving RA, Dec as strings.
+
+    Returns
+    -------
+    galaxy, mag, name, ra_str, dec_str, type, iauc
+    """
+
+    m = _IAUC_LINE_RE.search(l).group
 
-    #RP - welcome to regex hell
-    m = re.search('(?P<sn>\d{4}[A-Z]?[a-z]{0,2})\s{2,3}'
-                  # this may happen to be only whitespace
-                  '(?P<galinfo>.+)'
-                  # CBET / IAUC
-                  '(?P<galref>[A-Z]{4}\s+\d{1,})\s+'
-                  '(?P<ra>\d+\s+\d+\s+\d+(\.\d+)?)\s+'
-                  '(?P<dec>[\+\-\_]?\s?\d+\s+(\d+\s+)?\d+(\.\d+)?)\s+'
-                  '(?P<ref>([A-Z]{4}\s+\d{1,})\s+|\s+)'
-                  '(?P<type>.+(?=\d{4}[A-Z]?[a-z]{0,2}))', l).group
-    
     # test is the galaxy info is filled (ie. we can find a date)
-    if re.search('(.+(?=\d{4}\s+\d{2}))', m('galinfo')) is not None:
+    if _IAUC_HASDATE_RE.search(m('galinfo')) is not None:
 
-        m2 = re.search('(?P<galaxy>.+)'
-                       '(?P<date>\d{4}\s+\d{2}\s+\d{2})\s+'
-                       '(?P<galra>\d{1,}\s+\d{1,}\.\d)\s+'
-                       '(?P<galdec>\+?\-?\s?\d+\s+\d+)\s+'
-                       '(?P<offmag>.+)', m('galinfo')).group
+        m2 = _IAUC_GALINFO_RE.search(m('galinfo')).group
 
         galaxy = m2('galaxy').strip()
         try:
@@ -82,8 +102,6 @@ def read_iauc_line(l):
     #make proper RA DEC for RaDec usage
     ra_str = ' '.join(m('ra').strip().split())
     dec_str = ' '.join(m('dec').strip().split()).replace('_','-')
-    ra = RADec(ra_str, "RA").Deg()
-    dec = RADec(dec_str, "DEC").Deg()
 
     type = m('type').strip()
     try:
@@ -91,10 +109,17 @@ def read_iauc_line(l):
     except (ValueError, IndexError):
         iauc = 0
 
+    return galaxy, mag, name, ra_str, dec_str, type, iauc
+
+
+def read_iauc_line(l):
+    galaxy, mag, name, ra_str, dec_str, type, iauc = _parse_iauc_line(l)
+    ra = RADec(ra_str, "RA").Deg()
+    dec = RADec(dec_str, "DEC").Deg()
     return IAUCTarget(galaxy, mag, name, ra, dec, type, iauc)
 
 
-def validate_iauc_targets(targets):
+def validate_iauc_targets(targets, dup_radius=1./3600.):
     """Check that there are no weird entries in the IAUC list
 
     One should add tests here for improperly formatted IAUC entries.
@@ -102,14 +127,20 @@ def validate_iauc_targets(targets):
     Parameters
     ----------
     targets: list of IAUCTarget instances
+    dup_radius : float, optional
+        SNe closer than this (in degrees) to each other are considered
+        duplicates. Default is 1 arcsec.
     """
 
-    # are there SNe with exactly the same RA,Dec? (True if all locations are
-    # unique)
-    same_radec = (len([(tgt.Ra, tgt.Dec) for tgt in targets]) ==
-                  len(set([(tgt.Ra, tgt.Dec) for tgt in targets])))
-    if not same_radec:
-        raise RuntimeError("two or more SNe with exactly the same RA, Dec")
+    # are there SNe with (nearly) the same RA,Dec?
+    ia, ib, _ = crossmatch(targets, targets, dup_radius)
+    pairs = [(targets[i].Name, targets[j].Name)
+             for i, j in zip(ia, ib) if i < j]
+    if pairs:
+        raise RuntimeError("two or more SNe within {:.2f} arcsec of each "
+                           "other: {}".format(dup_radius * 3600.,
+                                              ", ".join("/".join(p)
+                                                        for p in pairs)))
 
     # are there SNe with a galaxy name starting with a digit?
     galaxy_name = len([tgt for tgt in targets
@@ -118,29 +149,166 @@ def validate_iauc_targets(targets):
         raise RuntimeError('there are galaxy names starting with a digit')
 
 
+def _iter_iauc_pre_lines(f, offset=0):
+    """Iterate over lines in the <pre> block of the IAUC HTML page.
+
+    Parameters
+    ----------
+    f : file
+        IAUC page, opened in binary mode.
+    offset : int, optional
+        Byte offset at which to start. If nonzero, it must be the start
+        of a line inside the <pre> block.
+
+    Yields
+    ------
+    end : int or None
+        Byte offset of the end of the line, or None for the last line
+        of the block (which may still be appended to).
+    raw : bytes
+        Raw line.
+    text : str
+        Part of the line inside the <pre> block.
+    """
+    f.seek(offset)
+    in_pre = offset > 0
+    for raw in f:
+        offset += len(raw)
+        text = raw.decode('utf-8', 'replace')
+        if not in_pre:
+            i = text.find('<pre>')
+            if i < 0:
+                continue
+            in_pre = True
+            text = text[i+6:]
+        i = text.find('</pre>')
+        if i >= 0:
+            yield None, raw, text[:i]
+            return
+        yield offset, raw, text.rstrip('\r\n')
+
+
+def _iauc_text_to_row(text):
+    """Parse a line of the <pre> block, or return None if it is not a
+    SN from >= 2000."""
+
+    # remove HTML tags and get only SNe from >= 2000
+    line = _HTML_TAG_RE.sub('', text)
+    if not (line and line[0] in string.digits and int(line[:4]) >= 2000):
+        return None
+    line = line.strip()
+    if not line or line.startswith("#"):
+        return None
+    return _parse_iauc_line(line)
+
+
+def _iauc_rows_to_targets(rows):
+    # convert all coordinates at once
+    ras = parse_radec_array([row[3] for row in rows], "RA")
+    decs = parse_radec_array([row[4] for row in rows], "DEC")
+    return [IAUCTarget(galaxy, mag, name, float(ra), float(dec), type, iauc)
+            for (galaxy, mag, name, _, _, type, iauc), ra, dec
+            in zip(rows, ras, decs)]
+
+
 def read_iauc_targets(fname):
     """Parse IAUCTargets from HTML page"""
 
-    html_doc = open(fname).read()
+    rows = []
+    with open(fname, 'rb') as f:
+        for _, _, text in _iter_iauc_pre_lines(f):
+            row = _iauc_text_to_row(text)
+            if row is not None:
+                rows.append(row)
 
-    html_doc = html_doc[html_doc.find('<pre>')+6 : html_doc.find('</pre>')]
+    targets = _iauc_rows_to_targets(rows)
 
-    # remove HTML tags and get only SNe from >= 2000
-    lines = [i for i in re.sub('<.+?>', '', html_doc).split('\n')
-             if i and i[0] in string.digits and int(i[:4]) >= 2000]
+    validate_iauc_targets(targets)
 
-    targets = []
-    for line in lines:
-        line = line.strip()
-        if line and not line.startswith("#"):
-            targets.append(read_iauc_line(line))
+    return targets
+
+
+# Bump when the format of the IAUC state file changes.
+IAUC_STATE_VERSION = 1
+
+
+def update_iauc_targets(fname, state_fname):
+    """Incrementally parse IAUCTargets from the HTML page.
+
+    The IAUC page is append-only in practice: new SNe are added at the
+    end of the <pre> block. This function keeps the parsed targets in
+    `state_fname` along with the byte offset and content of the last
+    parsed line. On subsequent calls, if that line is unchanged, only the
+    lines after it are parsed and merged into the stored targets (an
+    entry with the name of an existing target replaces it). Otherwise the
+    whole page is parsed again.
+
+    Parameters
+    ----------
+    fname : str
+        IAUC HTML page (e.g., ``Supernovae.html``).
+    state_fname : str
+        File in which parsed targets and the resume position are stored.
+        Created if it doesn't exist.
+
+    Returns
+    -------
+    targets : list of IAUCTarget
+    """
+
+    state = load_pickle(state_fname, IAUC_STATE_VERSION)
+
+    rows = []
+    with open(fname, 'rb') as f:
+        offset = 0
+        last = None
+        targets = []
+
+        # check that we can resume from the stored position.
+        if state is not None and state["last"] is not None:
+            start = state["offset"] - len(state["last"])
+            f.seek(start)
+            if f.readline() == state["last"]:
+                offset = state["offset"]
+                last = state["last"]
+                targets = state["targets"]
+
+        for end, raw, text in _iter_iauc_pre_lines(f, offset):
+            row = _iauc_text_to_row(text)
+            if row is not None:
+                rows.append(row)
+            if end is not None:
+                offset, last = end, raw
+
+    # merge new targets
+    if rows:
+        targets = list(targets)
+        index = dict((t.Name, i) for i, t in enumerate(targets))
+        for target in _iauc_rows_to_targets(rows):
+            i = index.get(target.Name)
+            if i is None:
+                index[target.Name] = len(targets)
+                targets.append(target)
+            else:
+                targets[i] = target
 
     validate_iauc_targets(targets)
 
+    dump_pickle({"version": IAUC_STATE_VERSION,
+                  "offset": offset,
+                  "last": last,
+                  "targets": targets}, state_fname)
+
     return targets
 
 
-def read_snf_target_line(words, kind):
+def _parse_snf_target_line(words, kind):
+    """Parse a line of the SNF target list, leaving RA, Dec as strings.
+
+    Returns
+    -------
+    name, oname, ra_str, dec_str, vmag, type_, kind, file_, x, y
+    """
     words = [word.strip() for word in words]
 
     if kind in ("StdStar", "DbleStar"):
@@ -159,10 +327,6 @@ def read_snf_target_line(words, kind):
     else:
         raise ValueError("unknown kind: {}".format(kind))
 
-    # parse RA, Dec to decimal
-    ra = RADec(ra_str, "RA").Deg()
-    dec = RADec(dec_str, "Dec").Deg()
-
     # parse x, y location
     try:
         x = float(x_str)
@@ -171,15 +335,25 @@ def read_snf_target_line(words, kind):
         x = -1
         y = -1
 
-    return SNFTarget(name, oname, ra, dec, float(vmag), type_, kind, file_,
-                     x, y)
+    return name, oname, ra_str, dec_str, float(vmag), type_, kind, file_, x, y
+
+
+def read_snf_target_line(words, kind):
+    (name, oname, ra_str, dec_str, vmag, type_, kind, file_, x,
+     y) = _parse_snf_target_line(words, kind)
+
+    # parse RA, Dec to decimal
+    ra = RADec(ra_str, "RA").Deg()
+    dec = RADec(dec_str, "Dec").Deg()
+
+    return SNFTarget(name, oname, ra, dec, vmag, type_, kind, file_, x, y)
 
 
 def read_snf_targets(fname):
     """Read the FindingChart format file """
 
     f = open(fname)
-    targets = []
+    rows = []
 
     # loop on the file
     kind = ""
@@ -190,8 +364,201 @@ def read_snf_targets(fname):
         else:
             words = line.split('|')
             if len(words) > 4 and words[1].strip() != "^":
-                    targets.append(read_snf_target_line(words[1:], kind))
+                    rows.append(_parse_snf_target_line(words[1:], kind))
 
     f.close()
 
+    # convert all coordinates at once
+    ras = parse_radec_array([row[2] for row in rows], "RA")
+    decs = parse_radec_array([row[3] for row in rows], "Dec")
+    targets = [SNFTarget(name, oname, float(ra), float(dec), vmag, type_,
+                         kind, file_, x, y)
+               for (name, oname, _, _, vmag, type_, kind, file_, x, y), ra,
+               dec in zip(rows, ras, decs)]
+
     return targets
+
+
+# Bump when the layout of the TargetCatalog cache changes.
+TARGET_CACHE_VERSION = 1
+
+_SN_PREFIX_RE = re.compile(r'^sn\s*(?=\d)')
+
+
+def normalize_target_name(name):
+    """Normalize a target name for lookups.
+
+    Names are lowercased, whitespace is removed, and a leading "SN" before
+    a year is dropped, so that e.g. ``'PTF09fox'`` and ``'ptf09fox'``, or
+    ``'SN 2005ab'`` and ``'2005ab'``, are equivalent.
+    """
+    name = ''.join(name.split()).lower()
+    return _SN_PREFIX_RE.sub('', name)
+
+
+def _source_stat(fname):
+    """(absolute path, size, mtime) identifying a source file version."""
+    st = os.stat(fname)
+    return [os.path.abspath(fname), st.st_size, st.st_mtime_ns]
+
+
+class TargetCatalog(object):
+    """IAUC and SNF targets in a single compact table with name lookup.
+
+    Targets are stored in a NumPy structured array with one row per target
+    and fields ``Source`` ('IAUC' or 'SNF'), ``Name``, ``OName``, ``Ra``,
+    ``Dec``, ``Mag`` (IAUC magnitude or SNF VMag), ``Type``, ``Galaxy``,
+    ``Iauc``, ``Kind``, ``File``, ``x`` and ``y``. Lookups by ``Name`` or
+    ``OName`` go through a hash table of normalized names (see
+    `normalize_target_name`).
+
+    Catalogs can be cached on disk with `read`; the cache is a ``.npy``
+    file that is memory-mapped when loaded.
+
+    Examples
+    --------
+    >>> cat = TargetCatalog.read(iauc_fname=IAUC_FNAME,
+    ...                          snf_fname=SNF_TARGETS_FNAME,
+    ...                          cache="targets.npy")
+    >>> cat.get("ptf09fox")
+    SNFTarget('PTF09fox', ...)
+    >>> cat.data["Ra"][cat.find("SN 2005ab")]
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self._index = None
+
+    def __len__(self):
+        return len(self.data)
+
+    def __repr__(self):
+        return "<TargetCatalog with {} targets>".format(len(self.data))
+
+    @classmethod
+    def from_targets(cls, iauc_targets=(), snf_targets=()):
+        """Create a catalog from lists of IAUCTarget and SNFTarget."""
+        rows = [("IAUC", t.Name, "", t.Ra, t.Dec, t.Mag, t.Type or "",
+                 t.Galaxy or "", t.Iauc, "", "", -1., -1.)
+                for t in iauc_targets]
+        rows += [("SNF", t.Name, t.OName or "", t.Ra, t.Dec, t.VMag,
+                  t.Type or "", "", 0, t.Kind or "", t.File or "", t.x, t.y)
+                 for t in snf_targets]
+
+        # size string fields to the longest value
+        def width(i):
+            return max([len(row[i]) for row in rows] + [1])
+
+        dtype = [("Source", "U4"), ("Name", "U%d" % width(1)),
+                 ("OName", "U%d" % width(2)), ("Ra", "f8"), ("Dec", "f8"),
+                 ("Mag", "f8"), ("Type", "U%d" % width(6)),
+                 ("Galaxy", "U%d" % width(7)), ("Iauc", "i8"),
+                 ("Kind", "U%d" % width(9)), ("File", "U%d" % width(10)),
+                 ("x", "f8"), ("y", "f8")]
+        return cls(np.array(rows, dtype=dtype))
+
+    @classmethod
+    def read(cls, iauc_fname=None, snf_fname=None, cache=None):
+        """Read IAUC and/or SNF target files, using a cache if possible.
+
+        Parameters
+        ----------
+        iauc_fname : str, optional
+            IAUC HTML page.
+        snf_fname : str, optional
+            SNF target list (``snifs_target.list``).
+        cache : str, optional
+            Cache file name (``.npy``). If it exists and was made from the
+            same versions (size and mtime) of the source files, it is
+            memory-mapped instead of parsing the sources. Otherwise the
+            sources are parsed and the cache is (re)written.
+
+        Returns
+        -------
+        catalog : TargetCatalog
+        """
+        sources = {}
+        if iauc_fname is not None:
+            sources["iauc"] = _source_stat(iauc_fname)
+        if snf_fname is not None:
+            sources["snf"] = _source_stat(snf_fname)
+        meta = {"version": TARGET_CACHE_VERSION, "sources": sources}
+
+        if cache is not None:
+            try:
+                with open(cache + ".json") as f:
+                    cached_meta = json.load(f)
+            except (OSError, ValueError):
+                cached_meta = None
+            if cached_meta == meta:
+                try:
+                    return cls(np.load(cache, mmap_mode='r'))
+                except (OSError, ValueError):
+                    pass
+
+        iauc_targets = ([] if iauc_fname is None else
+                        read_iauc_targets(iauc_fname))
+        snf_targets = [] if snf_fname is None else read_snf_targets(snf_fname)
+        catalog = cls.from_targets(iauc_targets, snf_targets)
+
+        if cache is not None:
+            catalog.save(cache, meta)
+
+        return catalog
+
+    def save(self, fname, meta=None):
+        """Write the catalog to a ``.npy`` file (and metadata to
+        ``fname + '.json'``)."""
+        dirname = os.path.dirname(os.path.abspath(fname))
+        fd, tmpname = tempfile.mkstemp(dir=dirname, suffix=".npy")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, np.asarray(self.data))
+            os.replace(tmpname, fname)
+        except:
+            os.remove(tmpname)
+            raise
+        with open(fname + ".json", "w") as f:
+            json.dump(meta, f)
+
+    def _build_index(self):
+        index = {}
+        for i, (name, oname) in enumerate(zip(self.data["Name"].tolist(),
+                                              self.data["OName"].tolist())):
+            aliases = set(normalize_target_name(n) for n in (name, oname)
+                          if n)
+            for alias in aliases:
+                index.setdefault(alias, []).append(i)
+        self._index = index
+
+    def find(self, name):
+        """Indices of targets whose Name or OName matches `name`.
+
+        Matching is done on normalized names, so it is case-insensitive
+        and ignores an "SN" prefix. Returns an empty list if not found.
+        """
+        if self._index is None:
+            self._build_index()
+        return self._index.get(normalize_target_name(name), [])
+
+    def __contains__(self, name):
+        return len(self.find(name)) > 0
+
+    def target(self, i):
+        """Return row `i` as an IAUCTarget or SNFTarget."""
+        row = self.data[i]
+        if row["Source"] == "IAUC":
+            return IAUCTarget(str(row["Galaxy"]), float(row["Mag"]),
+                              str(row["Name"]), float(row["Ra"]),
+                              float(row["Dec"]), str(row["Type"]),
+                              int(row["Iauc"]))
+        return SNFTarget(str(row["Name"]), str(row["OName"]) or None,
+                         float(row["Ra"]), float(row["Dec"]),
+                         float(row["Mag"]), str(row["Type"]),
+                         str(row["Kind"]) or None, str(row["File"]) or None,
+                         float(row["x"]), float(row["y"]))
+
+    def get(self, name, default=None):
+        """Return the first target matching `name`, or `default`."""
+        idx = self.find(name)
+        return self.target(idx[0]) if idx else default
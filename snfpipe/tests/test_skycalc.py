@@ -0,0 +1,133 @@
+"""Accuracy tests of snfpipe.skycalc against published reference values.
+
+Event times are from the USNO phases of the moon and seasons tables and
+from the NASA eclipse catalog (Espenak), in UT. Tolerances reflect the
+low-precision solar (~0.01 deg) and lunar (~0.3 deg) formulas used.
+"""
+
+import numpy as np
+from numpy.testing import assert_allclose
+
+from snfpipe.skycalc import (skycalc, sun_moon_positions, true_airmass,
+                             LATITUDE, LONGITUDE, EPHEM_STEP, _sun, _moon)
+from snfpipe.utils import calendar_to_jd
+
+# Greenwich mean sidereal time at J2000.0 (JD 2451545.0):
+# 18h41m50.54841s (IAU 1982).
+J2000 = 2451545.0
+GMST_J2000 = 15. * (18. + 41. / 60. + 50.54841 / 3600.)
+
+# Obliquity of the ecliptic near 2015.
+OBLIQUITY = 23.4374
+
+
+def _jd(*args):
+    return float(calendar_to_jd(*args))
+
+
+def _sun_transit_altitude(jd_start):
+    """Highest sun altitude at Mauna Kea within 3 hours of `jd_start`."""
+    jd = jd_start + np.arange(0., 3. / 24., 1. / 1440.)
+    return skycalc(jd, 0., 0.)["AltSun"].max()
+
+
+def test_sun_altitude_at_transit():
+    # 2015 March equinox (Mar 20 22:45) and solstices (Jun 21 16:38,
+    # Dec 22 04:48): the sun transits Mauna Kea within a day of each, at
+    # declination 0 and +/- the obliquity.
+    assert_allclose(_sun_transit_altitude(_jd(2015, 3, 20, 21)),
+                    90. - LATITUDE, atol=0.02)
+    assert_allclose(_sun_transit_altitude(_jd(2015, 6, 21, 21)),
+                    90. - (OBLIQUITY - LATITUDE), atol=0.02)
+    assert_allclose(_sun_transit_altitude(_jd(2015, 12, 22, 21)),
+                    90. - (OBLIQUITY + LATITUDE), atol=0.02)
+
+
+def test_moon_illuminated_fraction():
+    # (time of phase, illuminated fraction)
+    cases = [((2005, 10, 17, 12, 14), 1.),   # full moon
+             ((2005, 11, 2, 1, 25), 0.),     # new moon
+             ((2015, 9, 21, 8, 59), 0.5),    # first quarter
+             ((2015, 10, 4, 21, 6), 0.5),    # last quarter
+             ((2015, 9, 28, 2, 50), 1.)]     # full moon
+    jd = [_jd(*t) for t, _ in cases]
+    expected = [f for _, f in cases]
+    assert_allclose(skycalc(jd, 0., 0.)["MoonIllFrac"], expected,
+                    atol=0.005)
+
+
+def test_moon_during_lunar_eclipse():
+    # Greatest eclipse of the 2010 Dec 21 total lunar eclipse (08:17),
+    # visible from Mauna Kea. The moon is then within ~0.3 deg of the
+    # antisolar point, here in J2000 coordinates: ecliptic longitude
+    # 89.22 deg (the sun reaches 270 deg of date at the solstice, Dec 21
+    # 23:38), latitude 0.
+    jd = _jd(2010, 12, 21, 8, 17)
+    r = skycalc(jd, 89.147, 23.437)
+
+    # geocentric separation plus topocentric parallax (< 1 deg).
+    assert r["ObjMoon"][0] < 1.
+    assert r["MoonIllFrac"][0] > 0.999
+
+    # opposite the sun, lowered by the horizontal parallax of the moon
+    # (~0.92 deg at this distance) times cos(altitude).
+    parallax = 0.92 * np.cos(np.radians(r["AltMoon"][0]))
+    assert_allclose(r["AltMoon"][0], -r["AltSun"][0] - parallax, atol=0.4)
+
+
+def test_hour_angle_airmass_parallactic_angle():
+    # At J2000.0 coordinates of date are J2000 coordinates, and the local
+    # sidereal time at Mauna Kea is GMST + east longitude.
+    lst = (GMST_J2000 + LONGITUDE) % 360.
+    sidereal_day = 1. / 1.00273790935
+
+    # on the meridian, 60 deg south of the zenith: altitude 30 deg,
+    # sec(z) = 2, and Hardie's airmass 1.99450.
+    r = skycalc(J2000, lst, LATITUDE - 60.)
+    assert_allclose(r["MidHa"], 0., atol=1.e-3)
+    assert_allclose(r["MidAirMass"], 1.99450, atol=1.e-4)
+    assert_allclose(r["ParAng"], 0., atol=1.e-3)
+
+    # on the meridian north of the zenith.
+    r = skycalc(J2000, lst, LATITUDE + 10.)
+    assert_allclose(np.abs(r["ParAng"]), 180., atol=1.e-3)
+
+    # on the equator, 6 sidereal hours west and east of the meridian: the
+    # parallactic angle is +/-(90 deg - latitude).
+    jd = [J2000 + sidereal_day / 4., J2000 - sidereal_day / 4.]
+    r = skycalc(jd, lst, 0.)
+    assert_allclose(r["MidHa"], [90., -90.], atol=1.e-3)
+    assert_allclose(r["ParAng"], [90. - LATITUDE, LATITUDE - 90.],
+                    atol=1.e-3)
+
+    # at the zenith.
+    r = skycalc(J2000, lst, LATITUDE)
+    assert_allclose(r["MidAirMass"], 1., atol=1.e-6)
+
+
+def test_true_airmass():
+    assert_allclose(true_airmass([1., 2.]), [1., 1.99450], atol=1.e-5)
+    assert np.isnan(true_airmass(0.))
+
+
+def _angle(v1, v2):
+    cos = (v1 * v2).sum(axis=1) / np.sqrt((v1**2).sum(axis=1) *
+                                          (v2**2).sum(axis=1))
+    return np.degrees(np.arccos(np.clip(cos, -1., 1.)))
+
+
+def test_grid_interpolation():
+    rng = np.random.RandomState(0)
+    jd = 2455000. + 3000. * rng.random_sample(1000)
+    # include grid points and day boundaries.
+    jd = np.concatenate([jd, 2455000. + EPHEM_STEP * np.arange(300)])
+    sun, moon = sun_moon_positions(jd)
+    sun_ref = _sun(jd)
+    moon_ref = _moon(jd)
+
+    assert np.all(_angle(sun, sun_ref) < 1.e-5)
+    assert np.all(_angle(moon, moon_ref) < 1.e-4)
+    assert_allclose(np.sqrt((sun**2).sum(axis=1)),
+                    np.sqrt((sun_ref**2).sum(axis=1)), rtol=1.e-7)
+    assert_allclose(np.sqrt((moon**2).sum(axis=1)),
+                    np.sqrt((moon_ref**2).sum(axis=1)), rtol=1.e-5)
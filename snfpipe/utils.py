@@ -1,6 +1,12 @@
 # Various legacy utilities from SNFactory cvs Tasks/Processing/database/SnfObj
 
+import functools
 from math import pi, sin, cos, acos
+import os
+import pickle
+import tempfile
+
+import numpy as np
     
 class RADec(object):
     "Class build a RA DEC object from any kind of RA DEC"
@@ -126,6 +132,133 @@ class RADec(object):
         self.S = new.S
 
 
+def _split_radec(value):
+    """Split one RA or Dec value into (sign, fields) like RADec does.
+
+    `fields` is a list of 1 (decimal degrees), 2 (H M.m) or 3 (H M S)
+    strings.
+    """
+    coor = value.strip()
+    parts = coor.split("-")
+    if len(parts) == 1:
+        sign = 1.
+    elif len(parts) == 2:
+        coor = parts[1]
+        sign = -1.
+    else:
+        raise ValueError("Format for Given RA or DEC incorect : %s" % value)
+    fields = coor.replace(":", " ").replace("+", " ").split()
+    if not 1 <= len(fields) <= 3:
+        raise ValueError("RA or DEC incorrect : %s" % value)
+    return sign, fields
+
+
+def _deg_to_hms(deg, is_ra):
+    """Split decimal degrees into rounded (sign, H, M, S) arrays.
+
+    This reproduces the rounding (to 0.01 s) that RADec applies to decimal
+    input.
+    """
+    deg = np.asarray(deg, dtype=np.float64)
+    sign = np.where(deg < 0, -1., 1.)
+    hour = np.abs(deg) / 15 if is_ra else np.abs(deg)
+    H = np.trunc(hour)
+    M = np.trunc((hour - H) * 60.)
+    S = np.trunc(((hour - H) * 3600. - M * 60.) * 100. + 0.5) / 100.
+    over = np.trunc(S) >= 60
+    S = np.where(over, S - 60., S)
+    M = np.where(over, M + 1, M)
+    over = M > 60
+    M = np.where(over, M - 60, M)
+    H = np.where(over, H + 1, H)
+    H = np.where(H >= (24 if is_ra else 90), H - (24 if is_ra else 90), H)
+    return sign, H, M, S
+
+
+def _hms_to_deg(sign, H, M, S, is_ra):
+    """Degrees from (sign, H, M, S) arrays, as in RADec.Deg()."""
+    deg = np.abs(H) + (M + S / 60.) / 60.
+    if is_ra:
+        deg = deg * 15.
+    return np.where(sign < 0, -deg, deg)
+
+
+def parse_radec_array(values, xtype):
+    """Convert a sequence of RA or Dec values to decimal degrees.
+
+    Accepts the same formats as `RADec` (``HH:MM:SS.s``, ``HH MM SS.s``,
+    ``HH MM.m``, decimal degrees as a string or number, each optionally
+    signed) and gives identical results to ``RADec(value, xtype).Deg()``
+    element-wise, but converts all values in a few array operations.
+
+    Parameters
+    ----------
+    values : sequence of str or float
+    xtype : {'RA', 'DEC'}
+
+    Returns
+    -------
+    deg : `~numpy.ndarray` (float64)
+    """
+    ltype = xtype.upper()
+    if ltype not in ("RA", "DEC"):
+        raise ValueError('Given Type is not RA or DEC')
+    is_ra = ltype == "RA"
+
+    n = len(values)
+    sign = np.ones(n)
+    nfields = np.zeros(n, dtype=np.int8)
+    fields = np.zeros((n, 3))
+    numeric = []  # indicies of values given as numbers
+    for i, value in enumerate(values):
+        if isinstance(value, str):
+            sign[i], f = _split_radec(value)
+            nfields[i] = len(f)
+            fields[i, :len(f)] = [float(x) for x in f]
+        else:
+            numeric.append(i)
+            nfields[i] = 1
+            fields[i, 0] = value
+
+    # sexagesimal input: (H, M, S) or (H, M.m)
+    H = np.trunc(fields[:, 0])
+    M = np.where(nfields == 2, np.trunc(fields[:, 1]), fields[:, 1])
+    S = np.where(nfields == 2, (fields[:, 1] - M) * 60., fields[:, 2])
+    deg = _hms_to_deg(sign, H, M, S, is_ra)
+
+    # decimal degrees input gets rounded like RADec does.
+    dec = np.flatnonzero(nfields == 1)
+    if len(dec):
+        d = fields[dec, 0]
+        # for numbers, the sign is part of the value.
+        d = np.where(np.isin(dec, numeric), d, d * sign[dec])
+        deg[dec] = _hms_to_deg(*_deg_to_hms(d, is_ra), is_ra=is_ra)
+
+    return deg
+
+
+def format_radec_array(deg, xtype):
+    """Format decimal degrees as ``[-]HH:MM:SS.ss`` strings.
+
+    Equivalent to ``str(RADec(d, xtype))`` for each element.
+
+    Parameters
+    ----------
+    deg : array_like
+    xtype : {'RA', 'DEC'}
+
+    Returns
+    -------
+    strings : list of str
+    """
+    ltype = xtype.upper()
+    if ltype not in ("RA", "DEC"):
+        raise ValueError('Given Type is not RA or DEC')
+    sign, H, M, S = _deg_to_hms(np.atleast_1d(deg), ltype == "RA")
+    return [("%02d:%02d:%05.2f" if s > 0 else "-%02d:%02d:%05.2f") % (h, m, x)
+            for s, h, m, x in zip(sign, H, M, S)]
+
+
 def AngDist(r,d,r1,d1):
     "Angular distance between 2 directions ra,dec , ra1,dec1 given in radian"
 
@@ -155,52 +288,176 @@ def AngDistD(r0, d0, r01, d01):
     return AngDist(r, d, r1, d1) * 180. / pi
 
 
-def utc_to_jd(time):
-    """Transform a UTC time string to Julian date.
+def ang_dist(r, d, r1, d1):
+    """Angular distance between directions given in radians.
 
-    example inputs:
-    - result of `date --utc`: "Wed Sep 28 08:47:17 UTC 2005"
-    - B channel header: "2005-02-23T15:40:3"
+    Array version of `AngDist` using the Vincenty formula, which is
+    accurate for all separations (in particular arcsecond-level ones,
+    where the arccos of the dot product loses precision). Inputs are
+    broadcast against each other.
+
+    Parameters
+    ----------
+    r, d, r1, d1 : array_like
+        RA and Dec of the first and second directions, in radians.
+
+    Returns
+    -------
+    dist : `~numpy.ndarray` or float
+        Angular distance in radians.
     """
+    sin_d, cos_d = np.sin(d), np.cos(d)
+    sin_d1, cos_d1 = np.sin(d1), np.cos(d1)
+    dr = np.subtract(r1, r)
+    sin_dr, cos_dr = np.sin(dr), np.cos(dr)
+    num1 = cos_d1 * sin_dr
+    num2 = cos_d * sin_d1 - sin_d * cos_d1 * cos_dr
+    den = sin_d * sin_d1 + cos_d * cos_d1 * cos_dr
+    return np.arctan2(np.hypot(num1, num2), den)
 
-    # the UTC parsing has a problem : I have some time 2 space between
-    # month and day
-    # split generate a none string with it ... python should have
-    # a nicer way arround this problem than what I did here  ....
-    #exp=string.split(string.strip(time)," ")
 
-    # which kind of format?
-    buff = time.strip().split(" ", 1)
+def ang_dist_deg(r0, d0, r01, d01):
+    """Angular distance between directions given in degrees.
 
-    if len(buff) > 1:
-        # this is a Wed Sep 28 08:47:17 UTC 200 kind of string
-        exp = []
-        while len(buff) > 1:
-            exp.append(buff[0])
-            buff = buff[1].strip().split(" ",1)
-        exp.append(buff[0])
+    Array version of `AngDistD`; see `ang_dist`. Result is in degrees.
+    """
+    return np.degrees(ang_dist(np.radians(r0), np.radians(d0),
+                               np.radians(r01), np.radians(d01)))
+
+
+def _iter_chunks(n, chunk_size):
+    for start in range(0, n, chunk_size):
+        yield slice(start, min(start + chunk_size, n))
+
+
+def ang_dist_matrix(ra1, dec1, ra2, dec2, chunk_size=1024):
+    """Matrix of angular distances between two sets of positions (degrees).
+
+    The computation is done in blocks of `chunk_size` rows so that
+    temporary memory stays bounded by ``chunk_size * len(ra2)`` elements,
+    independent of ``len(ra1)``.
+
+    Parameters
+    ----------
+    ra1, dec1 : array_like (1-d)
+        First set of positions, in degrees.
+    ra2, dec2 : array_like (1-d)
+        Second set of positions, in degrees.
+    chunk_size : int, optional
+        Number of rows of the first set processed at a time.
+
+    Returns
+    -------
+    dist : `~numpy.ndarray`
+        Array of shape ``(len(ra1), len(ra2))``, in degrees.
+    """
+    ra1, dec1 = np.radians(ra1), np.radians(dec1)
+    ra2, dec2 = np.radians(ra2), np.radians(dec2)
+    out = np.empty((len(ra1), len(ra2)), dtype=np.float64)
+    for s in _iter_chunks(len(ra1), chunk_size):
+        out[s] = ang_dist(ra1[s, None], dec1[s, None], ra2, dec2)
+    return np.degrees(out, out=out)
+
+
+def ang_dist_nearest(ra1, dec1, ra2, dec2, chunk_size=1024):
+    """For each position in the first set, find the nearest in the second.
+
+    Works in blocks of `chunk_size` rows, so memory use is bounded by
+    ``chunk_size * len(ra2)`` elements rather than the full distance
+    matrix.
+
+    Parameters
+    ----------
+    ra1, dec1, ra2, dec2 : array_like (1-d)
+        Positions in degrees.
+    chunk_size : int, optional
+        Number of rows of the first set processed at a time.
+
+    Returns
+    -------
+    idx : `~numpy.ndarray` (int)
+        Index into the second set of the nearest position.
+    dist : `~numpy.ndarray`
+        Distance to the nearest position, in degrees.
+    """
+    ra1, dec1 = np.radians(ra1), np.radians(dec1)
+    ra2, dec2 = np.radians(ra2), np.radians(dec2)
+    if len(ra2) == 0:
+        raise ValueError("second set of positions is empty")
+    idx = np.empty(len(ra1), dtype=np.intp)
+    dist = np.empty(len(ra1), dtype=np.float64)
+    for s in _iter_chunks(len(ra1), chunk_size):
+        block = ang_dist(ra1[s, None], dec1[s, None], ra2, dec2)
+        idx[s] = np.argmin(block, axis=1)
+        dist[s] = block[np.arange(len(block)), idx[s]]
+    return idx, np.degrees(dist, out=dist)
+
+
+# Rotation from J2000 equatorial to Galactic unit vectors.
+_GALACTIC_MATRIX = np.array([[-0.0548755604, -0.8734370902, -0.4838350155],
+                             [0.4941094279, -0.4448296300, 0.7469822445],
+                             [-0.8676661490, -0.1980763734, 0.4559837762]])
+
+
+def radec_to_galactic(ra, dec):
+    """Convert J2000 RA, Dec arrays (degrees) to Galactic l, b (degrees).
+    """
+    ra = np.radians(np.asarray(ra, dtype=np.float64))
+    dec = np.radians(np.asarray(dec, dtype=np.float64))
+    cd = np.cos(dec)
+    vec = np.stack((cd * np.cos(ra), cd * np.sin(ra), np.sin(dec)))
+    x, y, z = np.tensordot(_GALACTIC_MATRIX, vec, axes=1)
+    return (np.degrees(np.arctan2(y, x)) % 360.,
+            np.degrees(np.arcsin(np.clip(z, -1., 1.))))
+
+
+_MONTHS = {'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4, 'May': 5, 'Jun': 6,
+           'Jul': 7, 'Aug': 8, 'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12}
 
+
+def _parse_utc(time):
+    """Split a UTC time string into (yyyy, mm, dd, hh, min, sec).
+
+    See `utc_to_jd` for accepted formats.
+    """
+    time = time.strip()
+
+    # which kind of format?
+    if " " in time:
+        # this is a Wed Sep 28 08:47:17 UTC 200 kind of string
+        # (there are sometimes 2 spaces between month and day)
+        exp = time.split()
         if exp[4] != "UTC" :
             raise ValueError("we only handle UTC and not " + exp[4])
-
-        month = {'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4, 'May': 5, 'Jun': 6,
-                 'Jul': 7, 'Aug': 8, 'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec':12}
         hour = exp[3].split(":")
         dd = int(exp[2])
-        mm = int(month[exp[1]])
+        mm = _MONTHS[exp[1]]
         yyyy = int(exp[5])
     else:
         # this is a 2005-02-23T15:40:3 kind of time string
-        buff = time.strip().split("T", 1)
+        buff = time.split("T", 1)
         exp = buff[0].split("-")
         hour = buff[1].split(":")
         yyyy = int(exp[0])
         dd = int(exp[2])
         mm = int(exp[1])
 
-    hh = float(hour[0])
-    min = float(hour[1])
-    sec = float(hour[2])
+    return yyyy, mm, dd, float(hour[0]), float(hour[1]), float(hour[2])
+
+
+@functools.lru_cache(maxsize=4096)
+def utc_to_jd(time):
+    """Transform a UTC time string to Julian date.
+
+    example inputs:
+    - result of `date --utc`: "Wed Sep 28 08:47:17 UTC 2005"
+    - B channel header: "2005-02-23T15:40:3"
+
+    Results are memoized (for the most recent 4096 distinct strings), as
+    the same time string is typically converted for each event of a run.
+    """
+
+    yyyy, mm, dd, hh, min, sec = _parse_utc(time)
     ut = hh + min / 60 + sec / 3600
 
     if (100 * yyyy + mm - 190002.5) > 0:
@@ -210,3 +467,90 @@ def utc_to_jd(time):
 
     return (367 * yyyy - int(7 * (yyyy + int((mm + 9) / 12)) / 4) +
             int(275 * mm / 9) + dd + 1721013.5 + ut / 24 - 0.5 * sig + 0.5)
+
+
+def utc_to_jd_array(times):
+    """Transform a sequence of UTC time strings to Julian dates.
+
+    Array version of `utc_to_jd`, accepting the same formats (which may be
+    mixed). Each string is split once and the date arithmetic is done on
+    arrays; results are identical to those of `utc_to_jd`.
+
+    Parameters
+    ----------
+    times : sequence of str
+
+    Returns
+    -------
+    jd : `~numpy.ndarray` (float64)
+    """
+
+    parts = np.array([_parse_utc(t) for t in times],
+                     dtype=np.float64).reshape(-1, 6)
+    return calendar_to_jd(*parts.T)
+
+
+def calendar_to_jd(yyyy, mm, dd, hh=0., min=0., sec=0.):
+    """Transform arrays of calendar dates and times to Julian dates.
+
+    Uses the same formula as `utc_to_jd`.
+
+    Parameters
+    ----------
+    yyyy, mm, dd : array_like
+        Year (4 digits), month and day.
+    hh, min, sec : array_like, optional
+        Hours, minutes and seconds.
+
+    Returns
+    -------
+    jd : `~numpy.ndarray` (float64)
+    """
+
+    yyyy, mm, dd, hh, min, sec = (np.asarray(a, dtype=np.float64)
+                                  for a in (yyyy, mm, dd, hh, min, sec))
+    ut = hh + min / 60 + sec / 3600
+    sig = np.where((100 * yyyy + mm - 190002.5) > 0, 1., -1.)
+
+    return (367 * yyyy - np.trunc(7 * (yyyy + np.trunc((mm + 9) / 12)) / 4) +
+            np.trunc(275 * mm / 9) + dd + 1721013.5 + ut / 24 - 0.5 * sig +
+            0.5)
+
+
+def load_pickle(fname, version):
+    """Load a versioned pickle, returning None if missing or outdated."""
+    try:
+        with open(fname, 'rb') as f:
+            state = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+    if not isinstance(state, dict) or state.get("version") != version:
+        return None
+    return state
+
+
+def dump_pickle(obj, fname):
+    """Atomically write `obj` to a pickle file."""
+    dirname = os.path.dirname(os.path.abspath(fname))
+    fd, tmpname = tempfile.mkstemp(dir=dirname, suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(obj, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmpname, fname)
+    except:
+        os.remove(tmpname)
+        raise
+
+
+def catalog_radec(catalog):
+    """Get (ra, dec) arrays from a catalog.
+
+    `catalog` can be a sequence of objects with ``Ra`` and ``Dec``
+    attributes (such as `IAUCTarget` or `SNFTarget`) or a pair of arrays.
+    """
+    if (isinstance(catalog, tuple) and len(catalog) == 2 and
+            not hasattr(catalog[0], "Ra")):
+        return (np.asarray(catalog[0], dtype=np.float64),
+                np.asarray(catalog[1], dtype=np.float64))
+    return (np.array([t.Ra for t in catalog], dtype=np.float64),
+            np.array([t.Dec for t in catalog], dtype=np.float64))
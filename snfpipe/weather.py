@@ -0,0 +1,346 @@
+"""Mauna Kea weather from the CFHT weather station files.
+
+The Mauna Kea Weather Center publishes one text file per year,
+``cfht-wx.YYYY.dat``, with a line per measurement::
+
+    year month day hour minute wind_speed wind_dir temperature humidity pressure
+
+Times are HST; wind speed is in knots, wind direction in degrees,
+temperature in Celsius, relative humidity in percent and pressure in mb.
+
+`WeatherArchive` converts these files into a single time-sorted binary
+file that is memory-mapped for lookups, and updates it incrementally as
+lines are added to the text files.
+"""
+
+import glob
+import os
+import re
+
+import numpy as np
+
+from .utils import calendar_to_jd, load_pickle, dump_pickle
+
+__all__ = ["WeatherArchive", "parse_weather_lines", "annotate_exposures"]
+
+# Record type of the binary archive. Missing values are NaN.
+WEATHER_DTYPE = np.dtype([("jd", "<f8"), ("WindSpeed", "<f8"),
+                          ("WindDir", "<f8"), ("Temp", "<f8"),
+                          ("Humidity", "<f8"), ("Pressure", "<f8")])
+
+# Hours to add to the (HST) times in the weather files to get UTC.
+WX_UTC_OFFSET = 10.
+
+# Default largest time between two measurements (days) across which
+# values are interpolated.
+DEFAULT_MAX_GAP = 30. / 1440.
+
+# Bump when the layout of the archive changes.
+WEATHER_ARCHIVE_VERSION = 1
+
+_WX_FNAME_RE = re.compile(r'cfht-wx\.(\d{4})\.dat$')
+
+# Number of columns in a weather line.
+_NCOLS = 10
+
+
+def _line_values(words):
+    values = []
+    for w in words[:_NCOLS]:
+        try:
+            values.append(float(w))
+        except ValueError:
+            values.append(np.nan)
+    return values
+
+
+def parse_weather_lines(lines):
+    """Parse lines of a cfht-wx.YYYY.dat file.
+
+    Parameters
+    ----------
+    lines : iterable of str or bytes
+
+    Returns
+    -------
+    data : `~numpy.ndarray`
+        Structured array with dtype `WEATHER_DTYPE`, in file order. Lines
+        with too few columns or an invalid time are skipped; other
+        unparsable values (e.g., missing measurements) are NaN.
+    """
+    words = [line.split() for line in lines]
+    words = [w[:_NCOLS] for w in words if len(w) >= _NCOLS]
+
+    try:
+        values = np.array(words, dtype=np.float64).reshape(-1, _NCOLS)
+    except ValueError:
+        # some values are not numbers: convert line by line.
+        values = np.array([_line_values(w) for w in words],
+                          dtype=np.float64).reshape(-1, _NCOLS)
+
+    year, month, day, hour, minute = values[:, :5].T
+    jd = calendar_to_jd(year, month, day, hour + WX_UTC_OFFSET, minute)
+
+    data = np.empty(len(values), dtype=WEATHER_DTYPE)
+    data["jd"] = jd
+    for i, name in enumerate(WEATHER_DTYPE.names[1:]):
+        data[name] = values[:, 5 + i]
+    return data[np.isfinite(jd)]
+
+
+def _sort_unique(data):
+    """Sort records by time, keeping the last of records with equal time."""
+    data = data[np.argsort(data["jd"], kind='stable')]
+    keep = np.ones(len(data), dtype=bool)
+    keep[:-1] = data["jd"][1:] != data["jd"][:-1]
+    return data[keep]
+
+
+class WeatherArchive(object):
+    """Time-sorted binary archive of weather measurements.
+
+    The archive is a directory holding ``weather.bin``, the raw records
+    (dtype `WEATHER_DTYPE`) sorted by Julian date, and ``weather.state``,
+    the number of records and the read position in each source file.
+
+    `update` reads only the lines added to each source file since the
+    last update. New records later than all archived ones (the usual case:
+    lines appended to the current year's file) are appended to
+    ``weather.bin`` in place; otherwise the archive is merged and
+    rewritten. Lookups memory-map ``weather.bin``, so only the pages
+    around the requested times are read.
+
+    Parameters
+    ----------
+    archive_dir : str
+        Directory of the archive. Created if it doesn't exist.
+
+    Examples
+    --------
+    >>> archive = WeatherArchive("/tmp/snf-weather")
+    >>> archive.update("/project/projectdirs/snfactry/raw/weather")
+    >>> wx = archive.weather_at(exposure_table.MidTime)
+    >>> wx["Temp"]
+    """
+
+    def __init__(self, archive_dir):
+        self.archive_dir = archive_dir
+        if not os.path.isdir(archive_dir):
+            os.makedirs(archive_dir)
+        self.data_fname = os.path.join(archive_dir, "weather.bin")
+        self.state_fname = os.path.join(archive_dir, "weather.state")
+        self._data = None
+
+    def __repr__(self):
+        return "WeatherArchive({!r})".format(self.archive_dir)
+
+    def _state(self):
+        state = load_pickle(self.state_fname, WEATHER_ARCHIVE_VERSION)
+        if state is None:
+            state = {"version": WEATHER_ARCHIVE_VERSION, "nrows": 0,
+                     "sources": {}}
+        return state
+
+    def __len__(self):
+        return self._state()["nrows"]
+
+    @property
+    def data(self):
+        """All records, memory-mapped (read-only)."""
+        if self._data is None:
+            nrows = len(self)
+            if nrows == 0:
+                return np.zeros(0, dtype=WEATHER_DTYPE)
+            self._data = np.memmap(self.data_fname, dtype=WEATHER_DTYPE,
+                                   mode='r', shape=(nrows,))
+        return self._data
+
+    def _read_new_lines(self, fname, source):
+        """Parse lines of `fname` after the stored position.
+
+        Returns (records, source state, complete) where `complete` is
+        False if the file changed before the stored position, in which
+        case all its lines are returned.
+        """
+        with open(fname, 'rb') as f:
+            complete = True
+            offset = 0
+            if source is not None:
+                f.seek(source["offset"] - len(source["last"]))
+                if f.readline() == source["last"]:
+                    offset = source["offset"]
+                else:
+                    complete = False
+            f.seek(offset)
+            lines = f.readlines()
+
+        # keep an incomplete last line for the next update.
+        if lines and not lines[-1].endswith(b"\n"):
+            lines.pop()
+        if lines:
+            source = {"offset": offset + sum(len(l) for l in lines),
+                      "last": lines[-1]}
+        elif offset == 0:
+            source = None
+        return parse_weather_lines(lines), source, complete
+
+    def update(self, weather_dir):
+        """Add new measurements from the cfht-wx.YYYY.dat files in a
+        directory.
+
+        Returns
+        -------
+        nnew : int
+            Number of records read.
+        """
+        state = self._state()
+        nrows = state["nrows"]
+        sources = dict(state["sources"])
+
+        fnames = sorted(f for f in glob.glob(os.path.join(weather_dir,
+                                                          "cfht-wx.*.dat"))
+                        if _WX_FNAME_RE.search(f))
+        new = []
+        rewrite = False
+        for fname in fnames:
+            key = os.path.basename(fname)
+            records, source, complete = self._read_new_lines(
+                fname, sources.get(key))
+            if not complete:
+                # drop the old records of this file's year before merging.
+                rewrite = True
+                sources.pop(key)
+                year = int(_WX_FNAME_RE.search(fname).group(1))
+                jd_min, jd_max = calendar_to_jd([year, year + 1], 1, 1,
+                                                WX_UTC_OFFSET)
+                new.append(("drop", jd_min, jd_max))
+            if source is not None:
+                sources[key] = source
+            if len(records):
+                new.append(("add", records))
+
+        added = [item[1] for item in new if item[0] == "add"]
+        records = (_sort_unique(np.concatenate(added)) if added
+                   else np.zeros(0, dtype=WEATHER_DTYPE))
+        old = self.data
+        if not rewrite and len(old) and len(records):
+            rewrite = records["jd"][0] <= old["jd"][-1]
+
+        if rewrite:
+            keep = np.ones(len(old), dtype=bool)
+            for item in new:
+                if item[0] == "drop":
+                    keep &= ~((old["jd"] >= item[1]) &
+                              (old["jd"] < item[2]))
+            records = _sort_unique(np.concatenate([old[keep], records]))
+            self._write(records)
+            nrows = len(records)
+        elif len(records):
+            self._append(records, nrows)
+            nrows += len(records)
+
+        self._data = None
+        dump_pickle({"version": WEATHER_ARCHIVE_VERSION, "nrows": nrows,
+                      "sources": sources}, self.state_fname)
+        return sum(len(a) for a in added)
+
+    def _write(self, records):
+        """Atomically replace the records file."""
+        tmpname = self.data_fname + ".tmp"
+        records.astype(WEATHER_DTYPE).tofile(tmpname)
+        os.replace(tmpname, self.data_fname)
+
+    def _append(self, records, nrows):
+        """Append records after the first `nrows` records."""
+        # Records after nrows are left over from an interrupted update
+        # (the state is written last), so they are overwritten.
+        mode = 'r+b' if os.path.exists(self.data_fname) else 'wb'
+        with open(self.data_fname, mode) as f:
+            f.truncate(nrows * WEATHER_DTYPE.itemsize)
+            f.seek(nrows * WEATHER_DTYPE.itemsize)
+            f.write(records.astype(WEATHER_DTYPE).tobytes())
+
+    def weather_at(self, jd, max_gap=DEFAULT_MAX_GAP):
+        """Weather at given times, interpolated between measurements.
+
+        Parameters
+        ----------
+        jd : array_like
+            Julian dates (UTC).
+        max_gap : float, optional
+            Values are NaN for times that are not between two measurements
+            at most this far apart (days).
+
+        Returns
+        -------
+        wx : `~numpy.ndarray`
+            Structured array (dtype `WEATHER_DTYPE`) with the shape of
+            `jd`. Values are linearly interpolated (wind direction along
+            the shorter arc); if one of the two measurements is missing,
+            the other is used.
+        """
+        jd = np.asarray(jd, dtype=np.float64)
+        result = np.empty(jd.shape, dtype=WEATHER_DTYPE)
+        result["jd"] = jd
+        for name in WEATHER_DTYPE.names[1:]:
+            result[name] = np.nan
+
+        data = self.data
+        if len(data) < 2:
+            return result
+
+        # binary search in the time column; only the touched pages of the
+        # other columns are read.
+        t = data["jd"]
+        lo = np.clip(np.searchsorted(t, jd, side='right') - 1, 0,
+                     len(t) - 2)
+        hi = lo + 1
+        t_lo = t[lo]
+        t_hi = t[hi]
+        valid = (jd >= t_lo) & (jd <= t_hi) & (t_hi - t_lo <= max_gap)
+        frac = (jd - t_lo) / (t_hi - t_lo)
+
+        rec_lo = data[lo]
+        rec_hi = data[hi]
+        for name in WEATHER_DTYPE.names[1:]:
+            a = rec_lo[name]
+            b = rec_hi[name]
+            if name == "WindDir":
+                diff = (b - a + 180.) % 360. - 180.
+                value = (a + frac * diff) % 360.
+            else:
+                value = a + frac * (b - a)
+            value = np.where(np.isnan(a), b, np.where(np.isnan(b), a, value))
+            result[name] = np.where(valid, value, np.nan)
+
+        return result
+
+
+def annotate_exposures(exposures, archive, max_gap=DEFAULT_MAX_GAP):
+    """Set the weather attributes of exposures from a weather archive.
+
+    ``Pressure``, ``Humidity``, ``Temp``, ``WindDir`` and ``WindSpeed`` of
+    each `~snfpipe.logs.Exposure` are set from the weather at ``MidTime``
+    (or ``Date`` if ``MidTime`` is None), in the units of the weather
+    files. Attributes are left as None where no weather is available.
+
+    Parameters
+    ----------
+    exposures : list of Exposure
+    archive : WeatherArchive
+    max_gap : float, optional
+        See `WeatherArchive.weather_at`.
+    """
+    jd = np.array([np.nan if t is None else t for t in
+                   (e.Date if e.MidTime is None else e.MidTime
+                    for e in exposures)], dtype=np.float64)
+    wx = archive.weather_at(jd, max_gap=max_gap)
+    for name, integer in (("Pressure", False), ("Humidity", True),
+                          ("Temp", False), ("WindDir", True),
+                          ("WindSpeed", False)):
+        for e, v in zip(exposures, wx[name].tolist()):
+            if v != v:
+                v = None
+            elif integer:
+                v = int(round(v))
+            setattr(e, name, v)
@@ -0,0 +1,163 @@
+"""Persistent, content-hash based build state for workflow rules.
+
+Deciding staleness by mtime alone reruns rules whenever a timestamp
+changes without the content changing (``rsync -t``, a config file
+rewritten with the same content, ...). `BuildState` instead records, for
+every rule that ran successfully, its command line and the content
+hashes of its inputs and outputs, in an SQLite database. A rule is up to
+date if its command is unchanged, its inputs have the recorded hashes and
+its outputs still exist with the recorded hashes. A rule whose inputs
+were regenerated with identical content is therefore also skipped.
+
+Hashing large FITS cubes is expensive, so file hashes are cached in the
+same database keyed by (size, mtime, inode): a file is only re-hashed if
+one of those changed.
+
+A BuildState can be shared by threads (e.g., by the cluster coordinator's
+server threads): database access is serialized, but files are hashed
+concurrently.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+
+# Read size used when hashing files.
+HASH_BLOCKSIZE = 1 << 20
+
+
+def hash_file(fname):
+    """Content hash of a file (hex string)."""
+    h = hashlib.blake2b(digest_size=20)
+    with open(fname, 'rb') as f:
+        while True:
+            block = f.read(HASH_BLOCKSIZE)
+            if not block:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+
+class BuildState(object):
+    """Database of file hashes and of the last successful run of rules.
+
+    Parameters
+    ----------
+    dbname : str
+        SQLite database file. Created if it doesn't exist.
+
+    Examples
+    --------
+    >>> state = BuildState(".workflow-state.db")
+    >>> workflow.run(state=state)
+    """
+
+    def __init__(self, dbname):
+        self.dbname = dbname
+        # may be used from several threads, serialized by _lock.
+        self.conn = sqlite3.connect(dbname, check_same_thread=False)
+        self._lock = threading.Lock()
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS file_hashes "
+                          "(path text PRIMARY KEY, size integer, "
+                          "mtime_ns integer, inode integer, hash text)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS rules "
+                          "(name text PRIMARY KEY, command text, "
+                          "inputs text, outputs text)")
+        self.conn.commit()
+
+    def __repr__(self):
+        return "BuildState({!r})".format(self.dbname)
+
+    def commit(self):
+        """Write cached file hashes to the database."""
+        with self._lock:
+            self.conn.commit()
+
+    def close(self):
+        with self._lock:
+            self.conn.commit()
+            self.conn.close()
+
+    def file_hash(self, fname):
+        """Content hash of a file, or None if it doesn't exist.
+
+        The hash is only computed if the file's size, mtime or inode
+        changed since it was last hashed.
+        """
+        try:
+            st = os.stat(fname)
+        except OSError:
+            return None
+        key = (st.st_size, st.st_mtime_ns, st.st_ino)
+        with self._lock:
+            row = self.conn.execute("SELECT size, mtime_ns, inode, hash "
+                                    "FROM file_hashes WHERE path = ?",
+                                    (fname,)).fetchone()
+        if row is not None and tuple(row[:3]) == key:
+            return row[3]
+        h = hash_file(fname)  # without the lock: other threads go on
+        with self._lock:
+            self.conn.execute("INSERT OR REPLACE INTO file_hashes "
+                              "VALUES (?, ?, ?, ?, ?)", (fname,) + key + (h,))
+        return h
+
+    def _hashes(self, fnames):
+        return dict((f, self.file_hash(f)) for f in fnames)
+
+    @staticmethod
+    def _command(rule):
+        return "\n".join(rule.commands)
+
+    def is_up_to_date(self, rule):
+        """Whether the rule's command, inputs and outputs are unchanged
+        since it last ran successfully."""
+        with self._lock:
+            row = self.conn.execute("SELECT command, inputs, outputs "
+                                    "FROM rules WHERE name = ?",
+                                    (rule.name,)).fetchone()
+        if row is None or row[0] != self._command(rule):
+            return False
+        inputs = json.loads(row[1])
+        outputs = json.loads(row[2])
+
+        # outputs first: missing outputs are the cheapest check.
+        if sorted(outputs) != sorted(rule.produces):
+            return False
+        for fname in rule.produces:
+            h = self.file_hash(fname)
+            if h is None or h != outputs[fname]:
+                return False
+
+        if sorted(inputs) != sorted(rule.depends):
+            return False
+        for fname in rule.depends:
+            if self.file_hash(fname) != inputs[fname]:
+                return False
+        return True
+
+    def has_record(self, rule):
+        with self._lock:
+            return self.conn.execute("SELECT 1 FROM rules WHERE name = ?",
+                                     (rule.name,)).fetchone() is not None
+
+    def record(self, rule):
+        """Record a successful run of a rule (or that its existing outputs
+        are up to date)."""
+        row = (rule.name, self._command(rule),
+               json.dumps(self._hashes(rule.depends)),
+               json.dumps(self._hashes(rule.produces)))
+        with self._lock:
+            self.conn.execute("INSERT OR REPLACE INTO rules "
+                              "VALUES (?, ?, ?, ?)", row)
+            self.conn.commit()
+
+    def forget(self, rule):
+        """Remove the record of a rule, so that it runs next time."""
+        with self._lock:
+            self.conn.execute("DELETE FROM rules WHERE name = ?",
+                              (rule.name,))
+            self.conn.commit()
@@ -0,0 +1,570 @@
+#!/usr/bin/env python
+"""Run workflow rules on a pool of worker processes on several hosts,
+without a batch system.
+
+A coordinator holds the dependency graph and hands out rules; workers
+(one per host, each running several rules at once) connect to it over a
+socket, ask for rules that fit their free cores and memory, run them and
+report back the result. All hosts must share the filesystem holding the
+inputs and outputs, as the coordinator checks which rules are up to date
+and workers create the outputs.
+
+Work is pulled, so a host that finishes early simply asks for more.
+Rules are handed out in order of decreasing critical-path length (see
+`workflow.Scheduler`), with some locality: rules that become ready when a
+worker finishes a rule (e.g., the cubefit-subtract following a cubefit)
+are queued for that worker, which takes them before anything else. An
+idle worker with an empty queue takes from the global ready queue, and
+when that is empty too, it steals from the back of the longest queue of
+another worker. This balances the uneven cubefit run times without any
+estimate being exact.
+
+A worker that hasn't contacted the coordinator for `lease` seconds is
+considered lost; its running and queued rules are handed out again.
+
+Usage::
+
+    makemake.py --coordinator :PORT          # on one host
+    cluster.py worker --address HOST:PORT    # on each host
+
+Workers and coordinator authenticate with the key in
+``$SNF_WORKFLOW_AUTHKEY``; if it isn't set, the coordinator makes one up
+and prints it.
+"""
+
+from __future__ import print_function
+
+import argparse
+import collections
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from multiprocessing.managers import BaseManager
+import os
+import secrets
+import socket
+import sys
+import threading
+import time
+
+from workflow import (READY, DONE, UPTODATE, FAILED, CANCELLED,
+                      _Processes, run_rule, missing_sources, needs_run,
+                      remove_outputs, total_memory)
+
+AUTHKEY_ENV = "SNF_WORKFLOW_AUTHKEY"
+
+# Default time in seconds after which a silent worker is considered lost.
+DEFAULT_LEASE = 300.
+
+
+def parse_address(address):
+    """Parse ``HOST:PORT`` into (host, port). An empty host means all
+    interfaces (for the coordinator) or this host (for workers)."""
+    host, _, port = address.rpartition(":")
+    return host, int(port)
+
+
+def get_authkey(generate=False):
+    """Authentication key from ``$SNF_WORKFLOW_AUTHKEY``, or a new random
+    one if `generate` is true and the variable isn't set."""
+    key = os.environ.get(AUTHKEY_ENV)
+    if key:
+        return key.encode()
+    if not generate:
+        raise RuntimeError("set ${} to the coordinator's key"
+                           .format(AUTHKEY_ENV))
+    key = secrets.token_hex(16)
+    print("authkey: {}={}".format(AUTHKEY_ENV, key))
+    return key.encode()
+
+
+class _Worker(object):
+    """What the coordinator knows about a worker."""
+
+    def __init__(self, name, cores, memory):
+        self.name = name
+        self.cores = cores
+        self.memory = memory
+        self.queue = collections.deque()  # claimed rules, by priority
+        self.running = set()
+        self.last_seen = time.time()
+        self.nrun = 0
+
+
+class Coordinator(object):
+    """Hands out the rules of a workflow to workers.
+
+    Public methods are called by workers through a
+    `multiprocessing.managers` proxy, from one server thread per worker.
+    Scheduler bookkeeping is serialized by a lock; checking whether a rule
+    is up to date and recording its result (which hash files) are done
+    without it, so that one worker's hashing doesn't hold up the others.
+
+    Parameters
+    ----------
+    workflow : `workflow.Workflow`
+    state : `buildstate.BuildState`, optional
+        See `workflow.Workflow.run`.
+    telemetry : `telemetry.TelemetryStore`, optional
+        See `workflow.Workflow.run`. Commands are recorded with the host
+        they ran on.
+    keep_going : bool, optional
+        See `workflow.Workflow.run`.
+    lease : float, optional
+        Seconds after which a silent worker is considered lost.
+    verbose : bool, optional
+        Print commands as they are handed out, and worker events.
+    """
+
+    def __init__(self, workflow, state=None, telemetry=None,
+                 keep_going=False, lease=DEFAULT_LEASE, verbose=True):
+        for name, depth in workflow.pools.items():
+            if depth < 1:
+                raise ValueError("pool depth must be at least 1: " + name)
+        self.sched = workflow.scheduler()
+        self.pool_free = dict(workflow.pools)
+        self.state = state
+        self.telemetry = telemetry
+        self.keep_going = keep_going
+        self.lease = lease
+        self.verbose = verbose
+        self.workers = {}
+        self.failed = False
+        self.stalled = False
+        self.nstolen = 0
+        self.finished = threading.Event()
+        self._lock = threading.Lock()
+        self._telemetry_lock = threading.Lock()
+        if telemetry is not None:
+            telemetry.add_rules(workflow.rules)
+
+    # methods called by workers --------------------------------------------
+
+    def register(self, name, cores, memory):
+        """Announce a worker with its total cores and memory (MB)."""
+        with self._lock:
+            if name in self.workers:
+                self._lose(self.workers[name])
+            self.workers[name] = _Worker(name, cores, memory)
+            self._log("worker {} joined ({} cores, {:.0f} MB)"
+                      .format(name, cores, memory))
+
+    def heartbeat(self, name):
+        """Tell the coordinator a worker is alive. Returns False if the
+        worker was considered lost and must stop."""
+        with self._lock:
+            worker = self.workers.get(name)
+            if worker is None:
+                return False
+            worker.last_seen = time.time()
+            return True
+
+    def get_work(self, name, cores, memory):
+        """Get a rule that fits in the given free cores and memory.
+
+        Returns
+        -------
+        reply : tuple
+            ``("run", i, rule)`` to run rule `i`; ``("wait",)`` if no rule
+            fits now; ``("done",)`` if no rule will be handed out anymore.
+        """
+        while True:
+            with self._lock:
+                worker = self.workers.get(name)
+                if worker is None or self.finished.is_set():
+                    return ("done",)
+                worker.last_seen = time.time()
+                i = None
+                if not self._stopped():
+                    i = self._take(worker, cores, memory)
+                if i is None:
+                    return self._idle(worker, cores, memory)
+                # the rule counts as running while it is checked.
+                self._start(i, worker)
+
+            rule = self.sched.rules[i]
+            missing = missing_sources(rule, self.sched.producers)
+            stale = not missing and needs_run(rule, self.state)
+
+            with self._lock:
+                if self.workers.get(name) is not worker:
+                    continue  # lost meanwhile: the rule was requeued
+                if missing or not stale or self._stopped():
+                    self._release(i, worker)
+                    if missing:
+                        print("error: no rule to make {} (needed by {})"
+                              .format(missing[0], rule.name))
+                        self._fail(i, worker)
+                    elif not stale:
+                        self._finish(i, UPTODATE, worker)
+                    else:
+                        self.sched.requeue(i)
+                    continue
+                if self.verbose:
+                    for command in rule.commands:
+                        print("[{}] {}".format(name, command))
+                return ("run", i, rule)
+
+    def report(self, name, i, result):
+        """Report the `workflow.RuleResult` of rule `i`."""
+        with self._lock:
+            worker = self.workers.get(name)
+            if worker is None or i not in worker.running:
+                # lost worker coming back: its rules were handed out
+                # again, so ignore the result.
+                return
+            worker.last_seen = time.time()
+
+        # hashing outputs is slow: record the result without the lock.
+        rule = self.sched.rules[i]
+        if self.telemetry is not None:
+            with self._telemetry_lock:
+                self.telemetry.record_result(rule, result)
+        if result.returncode == 0:
+            if self.state is not None:
+                self.state.record(rule)
+        else:
+            print("error: [{}] command failed with exit status {}: {}"
+                  .format(name, result.returncode, result.command))
+            if self.state is not None:
+                self.state.forget(rule)
+            remove_outputs(rule)
+
+        with self._lock:
+            if self.workers.get(name) is not worker:
+                return  # lost meanwhile: the rule was requeued
+            self._release(i, worker)
+            worker.nrun += 1
+            if result.returncode == 0:
+                self._finish(i, DONE, worker)
+            else:
+                self._fail(i, worker)
+            self._check_finished()
+
+    # internals (called with the lock held) --------------------------------
+
+    def _log(self, message):
+        if self.verbose:
+            print(message)
+
+    def _fits(self, i, worker, cores, memory, full_pools):
+        rule = self.sched.rules[i]
+        # rules needing more than a whole worker run alone on it.
+        return (min(rule.cores, worker.cores) <= cores and
+                min(rule.memory, worker.memory) <= memory and
+                rule.pool not in full_pools)
+
+    def _idle(self, worker, cores, memory):
+        """Reply to a worker for which no rule fits."""
+        if (not self._stopped() and cores >= worker.cores and
+                memory >= worker.memory and
+                not any(w.running for w in self.workers.values())):
+            # a fully free worker takes any rule (see _fits) and no rule
+            # can become ready: what is left can never start.
+            self._stall()
+        self._check_finished()
+        if self._stopped() or self.finished.is_set():
+            return ("done",)
+        return ("wait",)
+
+    def _start(self, i, worker):
+        worker.running.add(i)
+        rule = self.sched.rules[i]
+        if rule.pool is not None:
+            self.pool_free[rule.pool] -= 1
+
+    def _release(self, i, worker):
+        worker.running.discard(i)
+        rule = self.sched.rules[i]
+        if rule.pool is not None:
+            self.pool_free[rule.pool] += 1
+
+    def _take(self, worker, cores, memory):
+        """Next rule for a worker: from its own queue, else the global
+        ready queue, else stolen from another worker's queue."""
+        full_pools = [p for p, n in self.pool_free.items() if n <= 0]
+        for i in worker.queue:
+            if self._fits(i, worker, cores, memory, full_pools):
+                worker.queue.remove(i)
+                return i
+
+        # a fully free worker takes anything (see _fits).
+        i = self.sched.pop_ready(None if cores >= worker.cores else cores,
+                                 None if memory >= worker.memory else memory,
+                                 full_pools)
+        if i is not None:
+            return i
+
+        victims = sorted((w for w in self.workers.values()
+                          if w is not worker and w.queue),
+                         key=lambda w: len(w.queue), reverse=True)
+        for victim in victims:
+            # take from the back: the victim works from the front.
+            for i in reversed(victim.queue):
+                if self._fits(i, worker, cores, memory, full_pools):
+                    victim.queue.remove(i)
+                    self.nstolen += 1
+                    return i
+        return None
+
+    def _finish(self, i, state, worker):
+        """Finish rule `i` and queue the rules it made ready for `worker`,
+        by decreasing priority."""
+        sched = self.sched
+        sched.finish(i, state)
+        ready = [c for c in sched.children[i] if sched.state[c] == READY]
+        ready.sort(key=lambda c: sched.priority[c], reverse=True)
+        for c in ready:
+            sched.claim(c)
+            worker.queue.append(c)
+
+    def _fail(self, i, worker):
+        self.failed = True
+        cancelled = self.sched.finish(i, FAILED)
+        if cancelled and self.verbose:
+            print("cancelled {} dependent rule(s): {}{}".format(
+                len(cancelled),
+                ", ".join(self.sched.rules[c].name for c in cancelled[:3]),
+                ", ..." if len(cancelled) > 3 else ""))
+
+    def _stall(self):
+        stuck = self.sched.ready()
+        if stuck:
+            print("error: {} ready rule(s) can't be started: {}{}".format(
+                len(stuck),
+                ", ".join(self.sched.rules[i].name for i in stuck[:3]),
+                ", ..." if len(stuck) > 3 else ""))
+            self.failed = True
+            self.stalled = True
+
+    def _stopped(self):
+        return self.stalled or (self.failed and not self.keep_going)
+
+    def _check_finished(self):
+        running = any(w.running for w in self.workers.values())
+        if self._stopped():
+            if not running:
+                for w in self.workers.values():
+                    for i in w.queue:
+                        self.sched.requeue(i)
+                    w.queue.clear()
+                self.sched.cancel_all()
+                self.finished.set()
+        elif (not running and self.sched.nready == 0 and
+              not any(w.queue for w in self.workers.values())):
+            # nothing can become ready anymore.
+            self.finished.set()
+
+    def _lose(self, worker):
+        """Hand out again the running and queued rules of a worker."""
+        for i in sorted(worker.running | set(worker.queue)):
+            rule = self.sched.rules[i]
+            if i in worker.running and rule.pool is not None:
+                self.pool_free[rule.pool] += 1
+            self.sched.requeue(i)
+        del self.workers[worker.name]
+
+    def expire(self):
+        """Drop workers silent for longer than the lease."""
+        with self._lock:
+            now = time.time()
+            for worker in list(self.workers.values()):
+                if now - worker.last_seen > self.lease:
+                    self._log("worker {} lost; requeueing {} rule(s)".format(
+                        worker.name, len(worker.running) + len(worker.queue)))
+                    self._lose(worker)
+            self._check_finished()
+
+    def summary(self):
+        counts = self.sched.counts()
+        return ", ".join(["{} {}".format(counts[s], s)
+                          for s in (DONE, UPTODATE, FAILED, CANCELLED)
+                          if s in counts] +
+                         ["{} stolen".format(self.nstolen)])
+
+
+class CoordinatorManager(BaseManager):
+    """Manager giving workers a proxy to the coordinator."""
+
+
+CoordinatorManager.register("coordinator")
+
+
+def serve(workflow, address, authkey=None, state=None, telemetry=None,
+          keep_going=False, lease=DEFAULT_LEASE, verbose=True):
+    """Run a workflow on the workers connecting to `address`.
+
+    Parameters
+    ----------
+    workflow : `workflow.Workflow`
+    address : (str, int)
+        Host and port to listen on. An empty host listens on all
+        interfaces; port 0 picks a free port (printed).
+    authkey : bytes, optional
+        Default is `get_authkey(generate=True)`.
+    state, telemetry, keep_going, lease, verbose
+        See `Coordinator`.
+
+    Returns
+    -------
+    success : bool
+        True if no rule failed.
+    """
+    if authkey is None:
+        authkey = get_authkey(generate=True)
+    coordinator = Coordinator(workflow, state=state, telemetry=telemetry,
+                              keep_going=keep_going, lease=lease,
+                              verbose=verbose)
+
+    # register on a subclass, so each call serves its own coordinator.
+    class Manager(CoordinatorManager):
+        pass
+
+    Manager.register("coordinator", callable=lambda: coordinator)
+    server = Manager(address=tuple(address), authkey=authkey).get_server()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    host, port = server.address
+    print("coordinator listening on {}:{}".format(host, port))
+
+    coordinator.expire()  # an empty workflow is finished already
+    while not coordinator.finished.wait(min(coordinator.lease / 4., 10.)):
+        coordinator.expire()
+
+    # let polling workers receive "done" before the server goes away.
+    time.sleep(2 * WORKER_POLL)
+    if state is not None:
+        state.commit()
+    if verbose:
+        print(coordinator.summary())
+    return not coordinator.failed
+
+
+# Seconds between polls of a worker waiting for rules.
+WORKER_POLL = 1.
+
+
+def work(address, authkey=None, jobs=None, memory=None, name=None,
+         verbose=True):
+    """Run rules handed out by the coordinator at `address` until it has
+    none left.
+
+    Parameters
+    ----------
+    address : (str, int)
+        Coordinator host and port.
+    authkey : bytes, optional
+        Default is ``$SNF_WORKFLOW_AUTHKEY``.
+    jobs : int, optional
+        Number of cores to use. Default is the number of CPUs.
+    memory : float, optional
+        Memory available to rules in MB. Default is the physical memory.
+    name : str, optional
+        Worker name. Default is ``host:pid``.
+
+    Returns
+    -------
+    nfailed : int
+        Number of rules that failed on this worker.
+    """
+    if authkey is None:
+        authkey = get_authkey()
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    if memory is None:
+        memory = total_memory()
+    if name is None:
+        name = "{}:{}".format(socket.gethostname(), os.getpid())
+
+    manager = CoordinatorManager(address=tuple(address), authkey=authkey)
+    manager.connect()
+    coordinator = manager.coordinator()
+    coordinator.register(name, jobs, memory)
+
+    processes = _Processes()
+    running = {}  # future: (rule index, cores, memory)
+    done = False
+    nfailed = 0
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        try:
+            while True:
+                while not done:
+                    # recomputed rather than updated, so that a free
+                    # worker reports exactly its full size.
+                    free_cores = jobs - sum(r[1] for r in running.values())
+                    free_memory = memory - sum(r[2] for r in
+                                               running.values())
+                    if free_cores <= 0:
+                        break
+                    reply = coordinator.get_work(name, free_cores,
+                                                 free_memory)
+                    if reply[0] == "done":
+                        done = True
+                    elif reply[0] == "wait":
+                        break
+                    else:
+                        _, i, rule = reply
+                        cores = min(rule.cores, jobs)
+                        mem = min(rule.memory, memory)
+                        if verbose:
+                            for command in rule.commands:
+                                print(command)
+                        future = executor.submit(run_rule, rule, processes)
+                        running[future] = (i, cores, mem)
+
+                if done and not running:
+                    break
+
+                if running:
+                    finished, _ = wait(running, timeout=WORKER_POLL,
+                                       return_when=FIRST_COMPLETED)
+                else:
+                    finished = ()
+                    time.sleep(WORKER_POLL)
+                for future in finished:
+                    i = running.pop(future)[0]
+                    result = future.result()
+                    if result.returncode != 0:
+                        nfailed += 1
+                    coordinator.report(name, i, result)
+                if not finished and not coordinator.heartbeat(name):
+                    raise RuntimeError("coordinator dropped this worker")
+        except (KeyboardInterrupt, RuntimeError):
+            processes.terminate()
+            raise
+    return nfailed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Run workflow rules handed out by a coordinator "
+        "(started with 'makemake.py --coordinator').")
+    subparsers = parser.add_subparsers(dest="cmd")
+    subparsers.required = True
+
+    p = subparsers.add_parser("worker", help="run rules")
+    p.add_argument("--address", required=True, metavar="HOST:PORT",
+                   help="coordinator address")
+    p.add_argument("-j", "--jobs", type=int, default=None,
+                   help="number of cores to use. Default is the number of "
+                   "CPUs.")
+    p.add_argument("--memory", type=float, default=None,
+                   help="memory available to rules in MB. Default is the "
+                   "physical memory.")
+    p.add_argument("--name", default=None,
+                   help="worker name. Default is HOST:PID.")
+    p.add_argument("-q", "--quiet", action="store_true",
+                   help="don't print commands")
+    args = parser.parse_args(argv)
+
+    try:
+        nfailed = work(parse_address(args.address), jobs=args.jobs,
+                       memory=args.memory, name=args.name,
+                       verbose=not args.quiet)
+    except (RuntimeError, ConnectionError, EOFError) as e:
+        print("error: {}".format(e), file=sys.stderr)
+        return 1
+    return 1 if nfailed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
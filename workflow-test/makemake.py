@@ -1,77 +1,97 @@
 #!/usr/bin/env python
-"""Define a snf pipeline workflow in Python and create a makefile
-that will execute it"""
+"""Define a snf pipeline workflow in Python and create a makefile (or
+ninja file) that will execute it, or execute it directly"""
 
+import argparse
 import itertools
 import json
 import os
 from os.path import join
 
-
-
-class Makefile(object):
-    def __init__(self, path):
-        self._file = open(path, 'w')
-
-        # keep track of product directories that need rules
-        self._dirs = set()
-
-    def add_comment(self, comment):
-        self._file.write('# {}\n\n'.format(comment))
-
-    def add_rule(self, command, produces, depends=None):
-        """Add rule(s) to a makefile."""
-
-        if type(produces) not in (list, tuple):
-            produces = (produces,)
-
-        # get depends as a string
-        if depends is None:
-            depends = ''
-        elif type(depends) in (list, tuple):
-            depends = ' '.join(depends)
-
-        # get commands as a string
-        if type(command) not in (list, tuple):
-            command = (command,)
-        cmd = '\t' + '\n\t'.join(command) + '\n'
-
-        # get directory dependencies
-        dirnames = set()
-        for product in produces:
-            dirname = os.path.dirname(product)
-            if dirname != '':
-                dirnames.add(dirname)
-        
-        # add directory names to globals
-        self._dirs.update(dirnames)
-
-        # add directories (if any) to depenencies
-        depends += ' '.join(dirnames)
-
-        self._file.write('{} : {}\n{}\n'
-                         .format(' '.join(produces), depends, cmd))
+from buildstate import BuildState
+import cluster
+from telemetry import TelemetryStore, command_wrapper
+from workflow import Workflow
+
+
+class Makefile(Workflow):
+    """Workflow written to a build file when closed.
+
+    Parameters
+    ----------
+    path : str
+        Output file name.
+    backend : str, optional
+        ``'make'`` (default) or ``'ninja'``. See `writers.WRITERS`.
+    telemetry : str, optional
+        If given, commands are wrapped to record their execution in this
+        telemetry database (see `telemetry`).
+    """
+
+    def __init__(self, path, backend="make", telemetry=None):
+        super(Makefile, self).__init__()
+        self.path = path
+        self.backend = backend
+        self.telemetry = telemetry
+        self._closed = False
 
     def close(self):
-        # directory rules
-        for dirname in self._dirs:
-            self._file.write('{} :\n\tmkdir -p {}\n\n'
-                             .format(dirname, dirname))
-
-        # default rule
-        #self._file.write('.DEFAULT_GOAL: {}\n\n')
-                         
-        self._file.close()
+        if not self._closed:
+            if self.telemetry is None:
+                self.write(self.path, self.backend)
+            else:
+                self.write(self.path, self.backend,
+                           wrap=command_wrapper(self.telemetry))
+                store = TelemetryStore(self.telemetry)
+                store.add_rules(self.rules)
+                store.close()
+            self._closed = True
 
     def __del__(self):
         # call close if we didn't already
-        if not self._file.closed:
-            self.close()
+        self.close()
 
-                            
 
 if __name__ == "__main__":
 
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--backend", choices=["make", "ninja"],
+                        default="make",
+                        help=("build file to write: 'makefile' for make "
+                              "(default) or 'build.ninja' for ninja"))
+    parser.add_argument("--cubefit-jobs", type=int, default=16,
+                        help=("maximum number of cubefit rules running at "
+                              "once (ninja pool depth and with --run). "
+                              "Default is 16."))
+    parser.add_argument("--run", action="store_true",
+                        help=("run the workflow in-process instead of "
+                              "writing a makefile"))
+    parser.add_argument("--coordinator", default=None, metavar="HOST:PORT",
+                        help=("run the workflow on workers connecting to "
+                              "this address (see cluster.py) instead of "
+                              "writing a makefile"))
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="number of cores to use (with --run)")
+    parser.add_argument("--memory", type=float, default=None,
+                        help="memory available to rules in MB (with --run)")
+    parser.add_argument("-k", "--keep-going", action="store_true",
+                        help="keep running independent rules after a failure")
+    parser.add_argument("-n", "--dry-run", action="store_true",
+                        help=("print commands without running them (with "
+                              "--run or --coordinator)"))
+    parser.add_argument("--state", default=".workflow-state.db",
+                        help=("build state database used to skip rules whose "
+                              "inputs didn't change (with --run). Default is "
+                              "'.workflow-state.db'"))
+    parser.add_argument("--mtime", action="store_true",
+                        help=("decide which rules to run by mtime, like make, "
+                              "instead of by content (with --run)"))
+    parser.add_argument("--telemetry", default=None, metavar="DB",
+                        help=("record run time and resource usage of every "
+                              "command in this database. Report with "
+                              "'telemetry.py report --db DB'"))
+    args = parser.parse_args()
+
     ROOTDIR = "/project/projectdirs/snfactry/processing/0203-CABALLO"
     TAG = "0203-CABALLO"
     CUBEFIT_MODEL = ROOTDIR + "/cubefit-model"
@@ -80,7 +100,14 @@ if __name__ == "__main__":
     os.chdir(ROOTDIR)
 
     # TODO: write to tempfile by default
-    mf = Makefile('makefile')
+    if args.run or args.coordinator:
+        mf = Workflow()
+    elif args.backend == "ninja":
+        mf = Makefile('build.ninja', backend="ninja",
+                      telemetry=args.telemetry)
+    else:
+        mf = Makefile('makefile', telemetry=args.telemetry)
+    mf.add_pool("cubefit", args.cubefit_jobs)
 
     for sn, channel in itertools.product(sne, 'BR'):
 
@@ -101,18 +128,40 @@ if __name__ == "__main__":
         cubefit_output = ("cubefit-model/{}/{}_{}.fits"
                           .format(sn, sn, channel))
         logfile = "cubefit-model/{}/{}_{}.log".format(sn, sn, channel)
-        cmd = ('cubefit {} {} --dataprefix=cubes-cal-corr --logfile={}'
+        cmd = ('cubefit {} {} --dataprefix=cubes-cal-corr --logfile={} '
                '--mu_wave=0.07 --mu_xy=0.001 '
                '--psftype=gaussian-moffat --loglevel=info'
                .format(config, cubefit_output, logfile))
 
-        mf.add_rule(cmd, cubefit_output, cubefit_inputs + [config])
+        # run time grows with the number of epochs.
+        mf.add_rule(cmd, cubefit_output, cubefit_inputs + [config],
+                    cores=1, memory=4000., cost=len(cubefit_inputs),
+                    pool="cubefit")
 
         # cubefit-subtract
-        cmd = ('cubefit-subtract {} {} --dataprefix=cubes-cal-corr'
+        cmd = ('cubefit-subtract {} {} --dataprefix=cubes-cal-corr '
                '--outprefix={}'
                .format(config, cubefit_output, cubefit_subtract_outprefix))
         mf.add_rule(cmd, cubefit_subtract_outputs,
                     cubefit_inputs + [config, cubefit_output])
 
     mf.close()
+
+    if args.coordinator and not args.dry_run:
+        state = None if args.mtime else BuildState(args.state)
+        telemetry = (None if args.telemetry is None else
+                     TelemetryStore(args.telemetry))
+        ok = cluster.serve(mf, cluster.parse_address(args.coordinator),
+                           state=state, telemetry=telemetry,
+                           keep_going=args.keep_going)
+        raise SystemExit(0 if ok else 1)
+    elif args.run or args.coordinator:
+        # a dry run needs no workers: it only checks which rules are up
+        # to date, so it is done in-process.
+        state = None if args.mtime else BuildState(args.state)
+        telemetry = (None if args.telemetry is None else
+                     TelemetryStore(args.telemetry))
+        ok = mf.run(jobs=args.jobs, memory=args.memory,
+                    keep_going=args.keep_going, dry_run=args.dry_run,
+                    state=state, telemetry=telemetry)
+        raise SystemExit(0 if ok else 1)
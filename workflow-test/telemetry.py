@@ -0,0 +1,404 @@
+#!/usr/bin/env python
+"""Execution telemetry for workflow rules.
+
+Every command run for a rule is recorded in an SQLite database with its
+start and end time, user and system CPU time, peak resident memory, block
+I/O and exit status. Commands are recorded either by the in-process
+executor (``Workflow.run(telemetry=...)``) or, for makefiles and ninja
+files, by wrapping each command with this script (``Workflow.write(...,
+wrap=command_wrapper(dbname))``).
+
+Resource usage is that of the command and all its descendants, as
+reported by ``wait4``. I/O is counted in blocks actually read from or
+written to storage, so reads served from the page cache are not included.
+
+Usage::
+
+    telemetry.py run --db DB --rule NAME COMMAND
+    telemetry.py report --db DB [--session SESSION] [--top N] [--bins N]
+
+The report shows the slowest commands, the critical path through the
+rules that ran, and the number of rules running and cores busy over time.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import shlex
+import socket
+import sqlite3
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+
+def default_session():
+    """Session label for recorded commands.
+
+    ``$SNF_TELEMETRY_SESSION`` if set; otherwise host and process group,
+    which is shared by all commands started by one make, ninja or
+    makemake.py invocation.
+    """
+    session = os.environ.get("SNF_TELEMETRY_SESSION")
+    if session:
+        return session
+    return "{}:{}".format(socket.gethostname(), os.getpgrp())
+
+
+class TelemetryStore(object):
+    """Database of rule definitions and command executions.
+
+    Parameters
+    ----------
+    dbname : str
+        SQLite database file. Created if it doesn't exist. Several
+        processes can write to it concurrently.
+    session : str, optional
+        Label of the records written. Default is `default_session()`.
+    """
+
+    def __init__(self, dbname, session=None):
+        self.dbname = dbname
+        self.session = default_session() if session is None else session
+        # may be used from several threads (e.g., by the cluster
+        # coordinator), which serialize their access.
+        self.conn = sqlite3.connect(dbname, timeout=60.,
+                                    check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS rules "
+                          "(name text PRIMARY KEY, produces text, "
+                          "depends text, cores integer)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS runs "
+                          "(id integer PRIMARY KEY, session text, "
+                          "rule text, command text, host text, "
+                          "start real, end real, utime real, stime real, "
+                          "maxrss integer, read_bytes integer, "
+                          "write_bytes integer, status integer)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS runs_session "
+                          "ON runs (session)")
+        self.conn.commit()
+
+    def __repr__(self):
+        return "TelemetryStore({!r}, session={!r})".format(self.dbname,
+                                                           self.session)
+
+    def close(self):
+        self.conn.close()
+
+    def add_rules(self, rules):
+        """Store rule definitions (used to find the critical path)."""
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO rules VALUES (?, ?, ?, ?)",
+            [(rule.name, json.dumps(rule.produces), json.dumps(rule.depends),
+              rule.cores) for rule in rules])
+        self.conn.commit()
+
+    def record(self, rule, command, status, start, end, rusage, host=None):
+        """Record one command execution.
+
+        Parameters
+        ----------
+        rule : str
+            Rule name.
+        command : str
+        status : int
+            Exit status (negative for a signal).
+        start, end : float
+            Unix times.
+        rusage : `resource.struct_rusage` or None
+        host : str, optional
+            Host the command ran on. Default is this host.
+        """
+        if host is None:
+            host = socket.gethostname()
+        if rusage is None:
+            usage = (None,) * 5
+        else:
+            usage = (rusage.ru_utime, rusage.ru_stime, rusage.ru_maxrss,
+                     512 * rusage.ru_inblock, 512 * rusage.ru_oublock)
+        self.conn.execute("INSERT INTO runs (session, rule, command, host, "
+                          "start, end, utime, stime, maxrss, read_bytes, "
+                          "write_bytes, status) "
+                          "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                          (self.session, rule, command, host, start, end) +
+                          usage + (status,))
+        self.conn.commit()
+
+    def record_result(self, rule, result):
+        """Record the commands of a `workflow.RuleResult`."""
+        for c in result.commands:
+            self.record(rule.name, c.command, c.returncode, c.start, c.end,
+                        c.rusage, result.host)
+
+    def sessions(self):
+        """List of (session, start, end, number of commands), oldest
+        first."""
+        return self.conn.execute("SELECT session, min(start), max(end), "
+                                 "count(*) FROM runs GROUP BY session "
+                                 "ORDER BY min(start)").fetchall()
+
+    def runs(self, session):
+        """Records of a session, as a list of dicts, by start time."""
+        cur = self.conn.execute("SELECT * FROM runs WHERE session = ? "
+                                "ORDER BY start", (session,))
+        names = [d[0] for d in cur.description]
+        return [dict(zip(names, row)) for row in cur]
+
+    def rules(self):
+        """Dictionary of rule name to (produces, depends, cores)."""
+        return dict((name, (json.loads(produces), json.loads(depends),
+                            cores))
+                    for name, produces, depends, cores in self.conn.execute(
+                        "SELECT name, produces, depends, cores FROM rules"))
+
+
+def run_command(command, store, rule):
+    """Run a shell command, record it in `store` and return its exit
+    status."""
+    start = time.time()
+    p = subprocess.Popen(command, shell=True)
+    while True:
+        try:
+            _, status, rusage = os.wait4(p.pid, 0)
+            break
+        except InterruptedError:
+            pass
+    end = time.time()
+    if os.WIFSIGNALED(status):
+        returncode = -os.WTERMSIG(status)
+    else:
+        returncode = os.WEXITSTATUS(status)
+    store.record(rule, command, returncode, start, end, rusage)
+    return returncode
+
+
+def command_wrapper(dbname):
+    """Return a ``wrap(rule, command)`` function for `Workflow.write` that
+    runs each command through this script, recording it in `dbname`."""
+    prefix = " ".join(shlex.quote(s) for s in
+                      (sys.executable, os.path.abspath(__file__), "run",
+                       "--db", os.path.abspath(dbname)))
+
+    def wrap(rule, command):
+        return "{} --rule {} {}".format(prefix, shlex.quote(rule.name),
+                                        shlex.quote(command))
+
+    return wrap
+
+
+# -----------------------------------------------------------------------------
+# Report
+
+def _fmt_time(seconds):
+    """Format seconds as h:mm:ss.s"""
+    tenths = int(round(10. * seconds))
+    return "{}:{:02d}:{:04.1f}".format(tenths // 36000, tenths // 600 % 60,
+                                       tenths % 600 / 10.)
+
+
+def _cpu(run):
+    return (run["utime"] or 0.) + (run["stime"] or 0.)
+
+
+def rule_spans(runs):
+    """Aggregate command records by rule.
+
+    Returns a dict of rule name to (start, end, cpu seconds, status) of
+    its commands in `runs`; status is the last non-zero exit status, if
+    any.
+    """
+    spans = {}
+    for run in runs:
+        span = spans.get(run["rule"])
+        if span is None:
+            spans[run["rule"]] = [run["start"], run["end"], _cpu(run),
+                                  run["status"]]
+        else:
+            span[1] = max(span[1], run["end"])
+            span[2] += _cpu(run)
+            if run["status"] != 0:
+                span[3] = run["status"]
+    return dict((k, tuple(v)) for k, v in spans.items())
+
+
+def critical_path(runs, rules):
+    """Longest chain of dependent rules in a session, by wall time.
+
+    Parameters
+    ----------
+    runs : list of dict
+        Records of a session (`TelemetryStore.runs`).
+    rules : dict
+        Rule definitions (`TelemetryStore.rules`).
+
+    Returns
+    -------
+    path : list of (rule name, start, end)
+        From the first rule of the chain to the last.
+    """
+    spans = rule_spans(runs)
+    producers = {}
+    for name, (produces, _, _) in rules.items():
+        for product in produces:
+            producers[product] = name
+
+    length = {}
+    previous = {}
+    for name in sorted(spans, key=lambda n: spans[n][0]):
+        start, end, _, _ = spans[name]
+        best = 0.
+        for dep in (rules[name][1] if name in rules else ()):
+            parent = producers.get(dep)
+            if (parent in length and parent != name and
+                    spans[parent][1] <= start + 1e-6 and
+                    length[parent] > best):
+                best = length[parent]
+                previous[name] = parent
+        length[name] = best + (end - start)
+
+    if not length:
+        return []
+    name = max(length, key=length.get)
+    path = []
+    while name is not None:
+        path.append((name,) + spans[name][:2])
+        name = previous.get(name)
+    return path[::-1]
+
+
+def utilization(runs, nbins=20):
+    """Average rules running and cores busy (CPU time / wall time) in
+    time bins spanning a session.
+
+    Returns
+    -------
+    edges : `~numpy.ndarray`
+        Bin edges (Unix time), length ``nbins + 1``.
+    running, busy : `~numpy.ndarray`
+        Average number of commands running and of cores busy in each bin.
+    """
+    start = np.array([r["start"] for r in runs])
+    end = np.array([r["end"] for r in runs])
+    cpu = np.array([_cpu(r) for r in runs])
+    edges = np.linspace(start.min(), max(end.max(), start.min() + 1e-3),
+                        nbins + 1)
+    overlap = np.clip(np.minimum(end[:, None], edges[None, 1:]) -
+                      np.maximum(start[:, None], edges[None, :-1]), 0., None)
+    width = edges[1] - edges[0]
+    wall = np.maximum(end - start, 1e-9)
+    running = overlap.sum(axis=0) / width
+    busy = (overlap * (cpu / wall)[:, None]).sum(axis=0) / width
+    return edges, running, busy
+
+
+def report(store, session=None, top=10, nbins=20, cores=None, f=sys.stdout):
+    """Print a report of a session (default: the most recent one)."""
+    sessions = store.sessions()
+    if not sessions:
+        print("no records in", store.dbname, file=f)
+        return
+    if session is None:
+        session = sessions[-1][0]
+    runs = store.runs(session)
+    if not runs:
+        print("no records for session", session, file=f)
+        return
+    if cores is None:
+        cores = os.cpu_count() or 1
+
+    t0 = min(r["start"] for r in runs)
+    t1 = max(r["end"] for r in runs)
+    nfailed = sum(1 for r in runs if r["status"] != 0)
+    print("session {}: {} commands ({} failed), {} to {} ({})"
+          .format(session, len(runs), nfailed,
+                  time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(t0)),
+                  time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(t1)),
+                  _fmt_time(t1 - t0)), file=f)
+
+    print("\nslowest commands:", file=f)
+    print("{:>10s} {:>10s} {:>5s} {:>9s} {:>9s} {:>9s} {:>6s}  rule"
+          .format("wall", "cpu", "cpu%", "rss[MB]", "read[MB]", "write[MB]",
+                  "status"), file=f)
+    for r in sorted(runs, key=lambda r: r["end"] - r["start"],
+                    reverse=True)[:top]:
+        wall = r["end"] - r["start"]
+        print("{:>10s} {:>10s} {:5.0f} {:9.0f} {:9.1f} {:9.1f} {:6d}  {}"
+              .format(_fmt_time(wall), _fmt_time(_cpu(r)),
+                      100. * _cpu(r) / max(wall, 1e-9),
+                      (r["maxrss"] or 0) / 1024.,
+                      (r["read_bytes"] or 0) / 1e6,
+                      (r["write_bytes"] or 0) / 1e6, r["status"],
+                      r["rule"]), file=f)
+
+    path = critical_path(runs, store.rules())
+    if path:
+        total = sum(end - start for _, start, end in path)
+        print("\ncritical path: {} rules, {} of {} elapsed"
+              .format(len(path), _fmt_time(total), _fmt_time(t1 - t0)),
+              file=f)
+        print("{:>10s} {:>10s}  rule".format("start", "wall"), file=f)
+        for name, start, end in path:
+            print("{:>10s} {:>10s}  {}".format(_fmt_time(start - t0),
+                                               _fmt_time(end - start), name),
+                  file=f)
+
+    edges, running, busy = utilization(runs, nbins)
+    print("\ncore utilization ({} cores): mean {:.0f}%"
+          .format(cores, 100. * busy.mean() / cores), file=f)
+    print("{:>10s} {:>8s} {:>8s}".format("time", "running", "busy"), file=f)
+    for t, n, b in zip(edges[:-1], running, busy):
+        bar = "#" * int(round(40. * min(b / cores, 1.)))
+        print("{:>10s} {:8.1f} {:8.1f}  {}".format(_fmt_time(t - t0), n, b,
+                                                   bar), file=f)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Run workflow commands with telemetry, or report on "
+        "recorded telemetry.")
+    subparsers = parser.add_subparsers(dest="cmd")
+    subparsers.required = True
+
+    p = subparsers.add_parser("run", help="run and record a command")
+    p.add_argument("--db", required=True, help="telemetry database")
+    p.add_argument("--rule", required=True, help="rule name")
+    p.add_argument("command", help="shell command")
+
+    p = subparsers.add_parser("report", help="report on a session")
+    p.add_argument("--db", required=True, help="telemetry database")
+    p.add_argument("--session", default=None,
+                   help="session to report on. Default is the most recent.")
+    p.add_argument("--sessions", action="store_true",
+                   help="list sessions instead")
+    p.add_argument("--top", type=int, default=10,
+                   help="number of slowest commands to show. Default is 10.")
+    p.add_argument("--bins", type=int, default=20,
+                   help="number of time bins. Default is 20.")
+    p.add_argument("--cores", type=int, default=None,
+                   help="number of cores available. Default is the number "
+                   "of CPUs of this machine.")
+    args = parser.parse_args(argv)
+
+    store = TelemetryStore(args.db)
+    if args.cmd == "run":
+        return run_command(args.command, store, args.rule)
+
+    if args.sessions:
+        for session, t0, t1, n in store.sessions():
+            print("{}  {}  {:>10s}  {} commands".format(
+                session, time.strftime("%Y-%m-%d %H:%M:%S",
+                                       time.localtime(t0)),
+                _fmt_time(t1 - t0), n))
+    else:
+        report(store, args.session, args.top, args.bins, args.cores)
+    return 0
+
+
+if __name__ == "__main__":
+    status = main()
+    # propagate signals like a shell does.
+    sys.exit(128 - status if status < 0 else status)
@@ -0,0 +1,628 @@
+"""In-process execution of workflow rules.
+
+`Workflow` has the same rule API as `makemake.Makefile`, but instead of
+writing a makefile it builds the dependency graph in memory and runs it
+with a bounded pool of processes. Each rule declares the cores and memory
+it needs and an estimated cost; ready rules are started in order of
+decreasing critical-path length (their cost plus the longest chain of
+rules depending on them), so that long chains such as the expensive
+cubefit -> cubefit-subtract pairs are started first and the cores stay
+busy until the end. When a rule fails, all rules that depend on it
+(directly or indirectly) are cancelled.
+"""
+
+from __future__ import print_function
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import heapq
+import os
+import signal
+import socket
+import subprocess
+import threading
+import time
+
+# Rule states
+WAITING = "waiting"
+READY = "ready"
+RUNNING = "running"
+DONE = "done"
+UPTODATE = "up-to-date"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+
+class Rule(object):
+    """A set of commands producing some files from others.
+
+    Parameters
+    ----------
+    command : str or list of str
+        Shell command(s), run in order; the rule fails at the first
+        command with non-zero exit status.
+    produces : str or list of str
+        Output files.
+    depends : str or list of str, optional
+        Input files.
+    cores : int, optional
+        Number of cores used by the commands. Default is 1.
+    memory : float, optional
+        Peak memory used by the commands, in MB. Default is 0.
+    cost : float, optional
+        Relative run time, used to prioritize rules. Default is 1.
+    pool : str, optional
+        Name of a pool (see `Workflow.add_pool`) limiting how many rules
+        of a kind run at once.
+    """
+
+    def __init__(self, command, produces, depends=None, cores=1, memory=0.,
+                 cost=1., pool=None):
+        self.commands = _as_tuple(command)
+        self.produces = _as_tuple(produces)
+        self.depends = () if depends is None else _as_tuple(depends)
+        self.cores = cores
+        self.memory = memory
+        self.cost = cost
+        self.pool = pool
+
+    @property
+    def name(self):
+        """Short name: the first output."""
+        return self.produces[0]
+
+    def __repr__(self):
+        return "<Rule {}>".format(self.name)
+
+
+def _as_tuple(x):
+    if type(x) in (list, tuple):
+        return tuple(x)
+    return (x,)
+
+
+class Scheduler(object):
+    """Dependency graph of rules and their execution state.
+
+    Rules depend on the rules producing their inputs. Building the graph
+    and updating it are linear in the number of rules and dependencies.
+
+    Parameters
+    ----------
+    rules : list of Rule
+
+    Attributes
+    ----------
+    priority : list of float
+        Critical-path length of each rule.
+    state : list of str
+        State of each rule.
+    """
+
+    def __init__(self, rules):
+        self.rules = list(rules)
+        n = len(self.rules)
+
+        producers = {}
+        for i, rule in enumerate(self.rules):
+            for product in rule.produces:
+                if product in producers:
+                    raise ValueError("multiple rules produce " + product)
+                producers[product] = i
+        self.producers = producers
+
+        self.parents = [sorted(set(producers[d] for d in rule.depends
+                                   if d in producers))
+                        for rule in self.rules]
+        self.children = [[] for _ in range(n)]
+        for i, parents in enumerate(self.parents):
+            for j in parents:
+                self.children[j].append(i)
+
+        # topological order (Kahn's algorithm)
+        npending = [len(p) for p in self.parents]
+        order = [i for i in range(n) if npending[i] == 0]
+        for i in order:  # order grows while iterating
+            for c in self.children[i]:
+                npending[c] -= 1
+                if npending[c] == 0:
+                    order.append(c)
+        if len(order) < n:
+            cycle = [self.rules[i].name for i in range(n) if npending[i] > 0]
+            raise ValueError("dependency cycle among rules: " +
+                             ", ".join(cycle[:5]))
+        self.order = order
+
+        # critical path length: own cost plus longest downstream chain.
+        self.priority = [0.] * n
+        for i in reversed(order):
+            self.priority[i] = self.rules[i].cost + max(
+                [self.priority[c] for c in self.children[i]] + [0.])
+
+        self._npending = [len(p) for p in self.parents]
+        self.state = [WAITING] * n
+        # one heap of ready rules per (pool, cores, memory): all rules of a
+        # heap fit or none does, and a full pool is skipped at once. Rules
+        # leaving the ready state are left in the heaps and dropped when
+        # they reach the top.
+        self._ready = {}
+        self._nready = 0
+        for i in range(n):
+            if self._npending[i] == 0:
+                self._push(i)
+        self.nrunning = 0
+
+    def __len__(self):
+        return len(self.rules)
+
+    def _push(self, i):
+        self.state[i] = READY
+        self._nready += 1
+        rule = self.rules[i]
+        key = (rule.pool, rule.cores, rule.memory)
+        heapq.heappush(self._ready.setdefault(key, []),
+                       (-self.priority[i], i))
+
+    @property
+    def nready(self):
+        """Number of ready rules."""
+        return self._nready
+
+    def ready(self):
+        """Indices of the ready rules, by decreasing priority."""
+        return sorted(set(i for heap in self._ready.values() for _, i in heap
+                          if self.state[i] == READY),
+                      key=lambda i: (-self.priority[i], i))
+
+    def pop_ready(self, cores=None, memory=None, full_pools=()):
+        """Remove and return the highest priority ready rule that fits in
+        the given free cores and memory and isn't in one of `full_pools`,
+        or None."""
+        best = None
+        for (pool, rcores, rmemory), heap in self._ready.items():
+            if (pool in full_pools or
+                    (cores is not None and rcores > cores) or
+                    (memory is not None and rmemory > memory)):
+                continue
+            while heap and self.state[heap[0][1]] != READY:
+                heapq.heappop(heap)  # claimed or cancelled
+            if heap and (best is None or heap[0] < best[0]):
+                best = heap[0], heap
+        if best is None:
+            return None
+        i = heapq.heappop(best[1])[1]
+        self.state[i] = RUNNING
+        self._nready -= 1
+        self.nrunning += 1
+        return i
+
+    def claim(self, i):
+        """Mark a ready rule as running without going through
+        `pop_ready`, e.g., to queue it for a particular worker."""
+        if self.state[i] != READY:
+            raise ValueError("rule {} is not ready".format(i))
+        self.state[i] = RUNNING
+        self._nready -= 1
+        self.nrunning += 1
+
+    def requeue(self, i):
+        """Make a running rule ready again (e.g., its worker was lost)."""
+        if self.state[i] != RUNNING:
+            raise ValueError("rule {} is not running".format(i))
+        self.nrunning -= 1
+        self._push(i)
+
+    def finish(self, i, state=DONE):
+        """Record that a rule popped with `pop_ready` (or claimed) has
+        finished.
+
+        Parameters
+        ----------
+        i : int
+            Rule index.
+        state : str
+            ``DONE``, ``UPTODATE`` or ``FAILED``.
+
+        Returns
+        -------
+        cancelled : list of int
+            Rules cancelled because they depend on a failed rule.
+        """
+        self.state[i] = state
+        self.nrunning -= 1
+        if state == FAILED:
+            return self._cancel_downstream(i)
+        for c in self.children[i]:
+            self._npending[c] -= 1
+            if self._npending[c] == 0 and self.state[c] == WAITING:
+                self._push(c)
+        return []
+
+    def _cancel_downstream(self, i):
+        cancelled = []
+        stack = list(self.children[i])
+        while stack:
+            c = stack.pop()
+            if self.state[c] in (WAITING, READY):
+                if self.state[c] == READY:
+                    self._nready -= 1
+                self.state[c] = CANCELLED
+                cancelled.append(c)
+                stack.extend(self.children[c])
+        return cancelled
+
+    def cancel_all(self):
+        """Cancel all rules that haven't started."""
+        for i, state in enumerate(self.state):
+            if state in (WAITING, READY):
+                self.state[i] = CANCELLED
+        self._ready = {}
+        self._nready = 0
+
+    def counts(self):
+        """Number of rules in each state."""
+        result = {}
+        for state in self.state:
+            result[state] = result.get(state, 0) + 1
+        return result
+
+
+def _mtime(fname):
+    try:
+        return os.stat(fname).st_mtime
+    except OSError:
+        return None
+
+
+def is_outdated(rule):
+    """Whether a rule's outputs are missing or older than its inputs (the
+    make criterion)."""
+    out_mtimes = [_mtime(f) for f in rule.produces]
+    if any(t is None for t in out_mtimes):
+        return True
+    oldest = min(out_mtimes)
+    for f in rule.depends:
+        t = _mtime(f)
+        if t is None or t > oldest:
+            return True
+    return False
+
+
+class CommandResult(object):
+    """Outcome of one command: exit status, start and end time and
+    resource usage (`resource.struct_rusage` of the command and its
+    children)."""
+
+    def __init__(self, command, returncode, start, end, rusage):
+        self.command = command
+        self.returncode = returncode
+        self.start = start
+        self.end = end
+        self.rusage = rusage
+
+
+class RuleResult(object):
+    """Outcome of running the commands of a rule."""
+
+    def __init__(self, returncode, start, end, command=None, commands=(),
+                 host=None):
+        self.returncode = returncode
+        self.start = start
+        self.end = end
+        self.command = command  # failed command, if any
+        self.commands = list(commands)  # CommandResult of each command run
+        self.host = host
+
+
+class _Processes(object):
+    """Running child processes, so they can be terminated on interrupt."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._procs = set()
+        self.terminated = False
+
+    def run(self, command):
+        """Run a shell command, returning (exit status, resource usage)."""
+        with self._lock:
+            if self.terminated:
+                return -signal.SIGTERM, None
+            # own process group, so the whole command can be killed.
+            p = subprocess.Popen(command, shell=True, start_new_session=True)
+            self._procs.add(p)
+        try:
+            _, status, rusage = os.wait4(p.pid, 0)
+            p.returncode = _exit_code(status)
+        finally:
+            with self._lock:
+                self._procs.discard(p)
+        return p.returncode, rusage
+
+    def terminate(self):
+        with self._lock:
+            self.terminated = True
+            for p in self._procs:
+                try:
+                    os.killpg(p.pid, signal.SIGTERM)
+                except OSError:
+                    pass
+
+
+def _exit_code(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def run_rule(rule, processes):
+    """Create output directories and run the commands of a rule."""
+    for product in rule.produces:
+        dirname = os.path.dirname(product)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+
+    host = socket.gethostname()
+    start = time.time()
+    results = []
+    for command in rule.commands:
+        t0 = time.time()
+        returncode, rusage = processes.run(command)
+        results.append(CommandResult(command, returncode, t0, time.time(),
+                                     rusage))
+        if returncode != 0:
+            return RuleResult(returncode, start, time.time(), command,
+                              results, host)
+    return RuleResult(0, start, time.time(), commands=results, host=host)
+
+
+def missing_sources(rule, producers):
+    """Inputs of a rule that don't exist and that no rule produces."""
+    return [f for f in rule.depends
+            if f not in producers and _mtime(f) is None]
+
+
+def needs_run(rule, state, dry_run=False):
+    """Decide whether a rule must run, by content hashes if `state` is
+    given and by mtimes otherwise. `state` is only written to if
+    `dry_run` is false."""
+    if state is None:
+        return is_outdated(rule)
+    if state.is_up_to_date(rule):
+        return False
+    if not state.has_record(rule) and not is_outdated(rule):
+        # outputs made before the state existed: adopt them rather than
+        # rerunning everything.
+        if not dry_run:
+            state.record(rule)
+        return False
+    return True
+
+
+def remove_outputs(rule):
+    # like make's .DELETE_ON_ERROR: don't leave partial outputs that would
+    # look up to date.
+    for product in rule.produces:
+        if os.path.isfile(product):
+            os.remove(product)
+
+
+def total_memory():
+    """Physical memory of this machine in MB."""
+    return (os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') /
+            2.**20)
+
+
+class Workflow(object):
+    """Collection of rules that can be executed in-process.
+
+    Examples
+    --------
+    >>> wf = Workflow()
+    >>> wf.add_rule("cubefit conf.json out.fits", "out.fits", ["conf.json"],
+    ...             cores=1, memory=4000, cost=30)
+    >>> wf.run(jobs=32)
+    """
+
+    def __init__(self):
+        self.rules = []
+        self.comments = []
+        self.pools = {}
+
+    def add_comment(self, comment):
+        self.comments.append((len(self.rules), comment))
+
+    def add_pool(self, name, depth):
+        """Declare a pool: at most `depth` rules in it run at once."""
+        if depth < 1:
+            raise ValueError("pool depth must be at least 1: " + name)
+        self.pools[name] = depth
+
+    def add_rule(self, command, produces, depends=None, cores=1, memory=0.,
+                 cost=1., pool=None):
+        """Add a rule. See `Rule` for parameters."""
+        if pool is not None and pool not in self.pools:
+            raise ValueError("undeclared pool: " + pool)
+        rule = Rule(command, produces, depends, cores=cores, memory=memory,
+                    cost=cost, pool=pool)
+        self.rules.append(rule)
+        return rule
+
+    def close(self):
+        pass
+
+    def write(self, path=None, backend="make", wrap=None):
+        """Write the rules to a build file for an external tool.
+
+        Parameters
+        ----------
+        path : str, optional
+            Output file. Default is the backend's usual name
+            (``makefile``, ``build.ninja``).
+        backend : str, optional
+            Key of `writers.WRITERS`.
+        wrap : callable, optional
+            ``wrap(rule, command)`` returns the command to write in place
+            of each command, e.g., `telemetry.command_wrapper`.
+        """
+        from writers import WRITERS
+
+        writer = WRITERS[backend](wrap=wrap)
+        if path is None:
+            path = writer.default_filename
+        with open(path, 'w') as f:
+            writer.write(self, f)
+
+    def scheduler(self):
+        return Scheduler(self.rules)
+
+    def run(self, jobs=None, memory=None, keep_going=False, dry_run=False,
+            verbose=True, state=None, telemetry=None):
+        """Run all outdated rules.
+
+        Parameters
+        ----------
+        jobs : int, optional
+            Number of cores to use. Default is the number of CPUs.
+        memory : float, optional
+            Memory available to rules in MB. Default is the physical memory.
+        keep_going : bool, optional
+            After a failure, keep running rules that don't depend on the
+            failed one (like ``make -k``). Default is to stop starting new
+            rules and wait for running ones.
+        dry_run : bool, optional
+            Only print the commands that would be run.
+        verbose : bool, optional
+            Print commands and a summary.
+        state : `buildstate.BuildState`, optional
+            If given, rules are skipped when their command and the content
+            of their inputs and outputs are unchanged since they last ran,
+            regardless of mtimes. Default is to compare mtimes like make.
+        telemetry : `telemetry.TelemetryStore`, optional
+            If given, the run time and resource usage of every command is
+            recorded in it.
+
+        Returns
+        -------
+        success : bool
+            True if no rule failed.
+        """
+        if jobs is None:
+            jobs = os.cpu_count() or 1
+        if memory is None:
+            memory = total_memory()
+
+        sched = self.scheduler()
+        if telemetry is not None:
+            telemetry.add_rules(self.rules)
+        processes = _Processes()
+        pool_free = dict(self.pools)
+        running = {}  # future: (rule index, cores, memory)
+        would_run = set()  # rules run in a dry run
+        failed = False
+
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            try:
+                while True:
+                    while not (failed and not keep_going):
+                        full_pools = [name for name, n in pool_free.items()
+                                      if n <= 0]
+                        # rules needing more than available run alone: with
+                        # nothing running, any rule fits.
+                        free_cores = jobs - sum(r[1] for r in
+                                                running.values())
+                        free_memory = memory - sum(r[2] for r in
+                                                   running.values())
+                        i = sched.pop_ready(
+                            free_cores if running else None,
+                            free_memory if running else None, full_pools)
+                        if i is None:
+                            break
+                        rule = sched.rules[i]
+                        missing = missing_sources(rule, sched.producers)
+                        if missing:
+                            print("error: no rule to make {} (needed by {})"
+                                  .format(missing[0], rule.name))
+                            failed = True
+                            self._report_cancelled(sched.finish(i, FAILED),
+                                                   sched, verbose)
+                            continue
+                        # in a dry run, outputs of rules that would run
+                        # aren't updated, so their dependents look up to
+                        # date: treat them as outdated, like make -n.
+                        outdated = (dry_run and any(p in would_run for p in
+                                                    sched.parents[i]) or
+                                    needs_run(rule, state, dry_run))
+                        if not outdated:
+                            sched.finish(i, UPTODATE)
+                            continue
+                        if verbose or dry_run:
+                            for command in rule.commands:
+                                print(command)
+                        if dry_run:
+                            would_run.add(i)
+                            sched.finish(i, DONE)
+                            continue
+                        future = executor.submit(run_rule, rule, processes)
+                        running[future] = (i, min(rule.cores, jobs),
+                                           min(rule.memory, memory))
+                        if rule.pool is not None:
+                            pool_free[rule.pool] -= 1
+
+                    if not running:
+                        stuck = sched.ready()
+                        if stuck and not (failed and not keep_going):
+                            # can't happen with valid pools, but don't
+                            # report success with rules left to run.
+                            print("error: {} ready rule(s) can't be started: "
+                                  "{}{}".format(
+                                      len(stuck), ", ".join(
+                                          sched.rules[i].name
+                                          for i in stuck[:3]),
+                                      ", ..." if len(stuck) > 3 else ""))
+                            failed = True
+                        break
+
+                    finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        i = running.pop(future)[0]
+                        rule = sched.rules[i]
+                        if rule.pool is not None:
+                            pool_free[rule.pool] += 1
+                        result = future.result()
+                        if telemetry is not None:
+                            telemetry.record_result(rule, result)
+                        if result.returncode == 0:
+                            if state is not None:
+                                state.record(rule)
+                            sched.finish(i, DONE)
+                            continue
+                        failed = True
+                        if state is not None:
+                            state.forget(rule)
+                        print("error: command failed with exit status {}: {}"
+                              .format(result.returncode, result.command))
+                        remove_outputs(rule)
+                        self._report_cancelled(sched.finish(i, FAILED),
+                                               sched, verbose)
+            except KeyboardInterrupt:
+                processes.terminate()
+                sched.cancel_all()
+                raise
+
+        if failed:
+            sched.cancel_all()
+        if state is not None:
+            state.commit()
+        if verbose:
+            counts = sched.counts()
+            print(", ".join("{} {}".format(counts[s], s)
+                            for s in (DONE, UPTODATE, FAILED, CANCELLED)
+                            if s in counts))
+        return not failed
+
+    @staticmethod
+    def _report_cancelled(cancelled, sched, verbose):
+        if cancelled and verbose:
+            print("cancelled {} dependent rule(s): {}{}".format(
+                len(cancelled),
+                ", ".join(sched.rules[c].name for c in cancelled[:3]),
+                ", ..." if len(cancelled) > 3 else ""))
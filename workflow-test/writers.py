@@ -0,0 +1,142 @@
+"""Writers turning a `workflow.Workflow` into a build file for an external
+tool.
+
+Each writer renders the rules in a single pass, so writing is linear in
+the total size of the rules. Available backends are listed in `WRITERS`:
+
+- ``make``: a GNU makefile, without implicit rules. Output directories
+  are order-only prerequisites, so adding files to a directory doesn't
+  make its dependents stale. Rules with several outputs run their
+  commands once. Pools are not supported by make and are ignored.
+- ``ninja``: a ``build.ninja`` file. Each workflow pool becomes a ninja
+  ``pool`` with its depth, so that expensive rules (e.g., cubefit) can be
+  throttled separately from cheap ones.
+"""
+
+import os
+
+
+class _Writer(object):
+    """Base class of writers.
+
+    Parameters
+    ----------
+    wrap : callable, optional
+        ``wrap(rule, command)`` returns the command to write in place of
+        each command of a rule.
+    """
+
+    default_filename = None
+
+    def __init__(self, wrap=None):
+        self.wrap = wrap
+
+    def commands(self, rule):
+        if self.wrap is None:
+            return rule.commands
+        return tuple(self.wrap(rule, command) for command in rule.commands)
+
+
+def _dirnames(rules):
+    dirs = set()
+    for rule in rules:
+        for product in rule.produces:
+            dirname = os.path.dirname(product)
+            if dirname:
+                dirs.add(dirname)
+    return dirs
+
+
+class MakefileWriter(_Writer):
+    """Write rules as a GNU makefile."""
+
+    default_filename = "makefile"
+
+    @staticmethod
+    def _escape_command(command):
+        return command.replace('$', '$$')
+
+    def write(self, workflow, f):
+        rules = workflow.rules
+        comments = dict(workflow.comments)
+        lines = []
+
+        # no implicit rules: make would otherwise try them for every
+        # file, which dominates its startup time on large graphs.
+        lines.append("MAKEFLAGS += --no-builtin-rules\n.SUFFIXES :\n\n")
+
+        # default target, so that `make` builds everything.
+        lines.append(".PHONY : all\nall :")
+        for rule in rules:
+            lines.append(" \\\n    {}".format(" ".join(rule.produces)))
+        lines.append("\n\n.DELETE_ON_ERROR :\n\n")
+
+        for i, rule in enumerate(rules):
+            if i in comments:
+                lines.append("# {}\n\n".format(comments[i]))
+            dirs = sorted(set(os.path.dirname(p) for p in rule.produces) -
+                          set(['']))
+            primary = rule.produces[0]
+            lines.append("{} : {}".format(primary, " ".join(rule.depends)))
+            if dirs:
+                lines.append(" | " + " ".join(dirs))
+            lines.append("\n")
+            for command in self.commands(rule):
+                lines.append("\t{}\n".format(self._escape_command(command)))
+            lines.append("\n")
+
+            # other outputs are made by the same commands.
+            if len(rule.produces) > 1:
+                lines.append("{} : {}\n\n".format(" ".join(rule.produces[1:]),
+                                                  primary))
+
+        for dirname in sorted(_dirnames(rules)):
+            lines.append("{} :\n\tmkdir -p {}\n\n".format(dirname, dirname))
+
+        f.write("".join(lines))
+
+
+class NinjaWriter(_Writer):
+    """Write rules as a ninja build file, with pools."""
+
+    default_filename = "build.ninja"
+
+    @staticmethod
+    def _escape_path(path):
+        return (path.replace('$', '$$').replace(' ', '$ ')
+                .replace(':', '$:'))
+
+    @staticmethod
+    def _escape_value(value):
+        return value.replace('$', '$$')
+
+    def write(self, workflow, f):
+        rules = workflow.rules
+        comments = dict(workflow.comments)
+        escape = self._escape_path
+        lines = ["ninja_required_version = 1.1\n\n"]
+
+        for name, depth in sorted(workflow.pools.items()):
+            lines.append("pool {}\n  depth = {}\n\n".format(name, depth))
+
+        # one generic rule; each build sets its own command.
+        lines.append("rule run\n  command = $cmd\n  description = $desc\n\n")
+
+        for i, rule in enumerate(rules):
+            if i in comments:
+                lines.append("# {}\n\n".format(comments[i]))
+            lines.append("build {}: run {}\n".format(
+                " ".join(escape(p) for p in rule.produces),
+                " ".join(escape(d) for d in rule.depends)))
+            lines.append("  cmd = {}\n".format(
+                self._escape_value(" && ".join(self.commands(rule)))))
+            lines.append("  desc = {}\n".format(
+                self._escape_value(rule.name)))
+            if rule.pool is not None:
+                lines.append("  pool = {}\n".format(rule.pool))
+            lines.append("\n")
+
+        f.write("".join(lines))
+
+
+WRITERS = {"make": MakefileWriter, "ninja": NinjaWriter}